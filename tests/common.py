@@ -0,0 +1,75 @@
+# Fixtures shared by the tests: the cleaner, as loaded by the benchmark, and
+# its simulated zpool. Run the tests from the repository root with
+#   python -m unittest discover -s tests
+
+import os, imp, logging
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+bench = imp.load_source("zfs_snapshots_cleaner_bench", os.path.join(root, "zfs-snapshots-cleaner-bench.py"))
+cleaner = bench.cleaner
+
+# The cleaner logs to the root logger, tests adding their own handlers
+logging.getLogger().addHandler(logging.NullHandler())
+
+retentionPolicy = "7 days and 4 sundays and 6 1st day of the month and 12 1st monday of the month"
+maxRetention = "26 weeks"
+
+def getSimulation(**kwargs):
+    simulation = {"datasets": 30, "snapshots": 3000, "days": 400}
+    simulation.update(kwargs)
+    return bench.SimulatedZfs(**simulation)
+
+def getConfig(simulation, bestEffortPolicy="morerem"):
+    return bench.getConfig(simulation.pool, bestEffortPolicy, retentionPolicy, maxRetention)
+
+def loadZpool(simulation, dryrun=True, bestEffortPolicy="morerem"):
+    return cleaner.loadZpool(getConfig(simulation, bestEffortPolicy), dryrun, simulation)
+
+def getCapacity(simulation):
+    return float(simulation.datasets[simulation.pool].used) / simulation.size
+
+def getState(simulation):
+    # Snapshots left with their holds, and the space used by the zpool
+    return sorted((name, sorted(snapshot.holds)) for name, snapshot in simulation.snapshots.items()), simulation.datasets[simulation.pool].used
+
+def traceCommands(simulation):
+    # List receiving every command answered by the simulation, run or
+    # streamed
+    commands = []
+    runCommand = simulation.runCommand
+    runStream = simulation.runStream
+    def traceRun(cmd, **kwargs):
+        commands.append(list(cmd))
+        return runCommand(cmd, **kwargs)
+    def traceStream(cmd):
+        # Streamed listings are the only commands not run
+        if cmd[1] == "list":
+            commands.append(list(cmd))
+        return runStream(cmd)
+    simulation.runCommand = traceRun
+    simulation.runStream = traceStream
+    return commands
+
+class LogCapture(logging.Handler):
+
+    # Messages logged while attached to the root logger
+
+    def __init__(self, level=logging.INFO):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self.loggerLevel = level
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+    def __enter__(self):
+        logger = logging.getLogger()
+        self.previous = logger.level
+        logger.addHandler(self)
+        logger.setLevel(self.loggerLevel)
+        return self
+
+    def __exit__(self, *args):
+        logger = logging.getLogger()
+        logger.removeHandler(self)
+        logger.setLevel(self.previous)
@@ -0,0 +1,48 @@
+import unittest
+
+from common import getSimulation, loadZpool, getCapacity
+
+class BestEffortTest(unittest.TestCase):
+
+    def test_nothing_destroyed_once_under_max_capacity(self):
+        # maxRetention alone brings the zpool under maxCapacity, the
+        # estimates of the tracker must not lead best effort on
+        simulation = getSimulation(capacity=0.9)
+        zpool = loadZpool(simulation, False)
+        zpool.classifySnapshots()
+        zpool.destroySnapshotsOutOfMaxRetention()
+        self.assertTrue(getCapacity(simulation) <= zpool.maxCapacity)
+        snapshots = len(simulation.snapshots)
+        zpool.destroySnapshotsWhileOverMaxCapacity()
+        self.assertEqual(len(simulation.snapshots), snapshots)
+
+    def test_stops_at_max_capacity(self):
+        for bestEffortPolicy in ("oldest", "biggest", "morerem", "more"):
+            simulation = getSimulation(capacity=0.97)
+            zpool = loadZpool(simulation, False, bestEffortPolicy)
+            zpool.clean()
+            capacity = getCapacity(simulation)
+            self.assertTrue(capacity <= zpool.maxCapacity, (bestEffortPolicy, capacity))
+            self.assertTrue(capacity > zpool.maxCapacity - 0.01, (bestEffortPolicy, capacity))
+
+    def test_decides_on_zfs_figures(self):
+        simulation = getSimulation(capacity=0.97)
+        zpool = loadZpool(simulation, False)
+        zpool.classifySnapshots()
+        zpool.destroySnapshotsOutOfMaxRetention()
+        self.assertTrue(zpool.capacityTracker.stale)
+        root = simulation.datasets[simulation.pool]
+        figures = []
+        destroySnapshots = zpool.destroySnapshots
+        def destroy(snapshots):
+            # Figures the snapshots were picked on, and those of zfs
+            figures.append(((zpool.capacityTracker.used, zpool.capacityTracker.available), (root.used, simulation.getAvailable(root))))
+            return destroySnapshots(snapshots)
+        zpool.destroySnapshots = destroy
+        zpool.destroySnapshotsWhileOverMaxCapacity()
+        self.assertTrue(figures)
+        for tracked, actual in figures:
+            self.assertEqual(tracked, actual)
+
+if __name__ == "__main__":
+    unittest.main()
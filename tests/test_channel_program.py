@@ -0,0 +1,69 @@
+import unittest
+
+from common import cleaner, getSimulation, loadZpool, traceCommands
+
+class ChannelProgramTest(unittest.TestCase):
+
+    def setUp(self):
+        self.simulation = getSimulation(datasets=3, snapshots=300)
+        self.zpool = loadZpool(self.simulation, False)
+        self.program = cleaner.ChannelProgram(self.zpool)
+        self.zpool.channelProgram = self.program
+        snapshots = [snapshot for dataset in self.zpool.datasets for snapshot in dataset.snapshots if not snapshot.userrefs]
+        self.doomed = snapshots[::3][:40]
+        self.commands = traceCommands(self.simulation)
+
+    def destroy(self):
+        self.zpool.destroySnapshots(self.doomed)
+        for snapshot in self.doomed:
+            self.assertFalse(snapshot.name in self.simulation.snapshots, snapshot.name)
+
+    def getProgramSizes(self):
+        # Snapshots of each program run, failed or not
+        return [program["script"].count('",\n') for program in self.simulation.programs]
+
+    def getDestroyed(self):
+        # Snapshots given to zfs destroy
+        names = []
+        for cmd in self.commands:
+            if cmd[1] == "destroy" and "-n" not in cmd:
+                name, items = cmd[-1].split("@", 1)
+                names.extend(["%s@%s" % (name, item) for item in items.split(",")])
+        return sorted(names)
+
+    def test_single_program(self):
+        self.destroy()
+        self.assertEqual(self.getProgramSizes(), [40])
+        self.assertEqual(self.getDestroyed(), [])
+
+    def test_instruction_limit(self):
+        self.program.instructionLimit = self.simulation.programInstructions * 10
+        self.destroy()
+        sizes = self.getProgramSizes()
+        # 40 snapshots: 40 and 20 over the limit, then 4 programs of 10
+        self.assertEqual(sorted(sizes), [10, 10, 10, 10, 20, 20, 40])
+        self.assertEqual(self.getDestroyed(), [])
+
+    def test_memory_limit(self):
+        self.program.memoryLimit = self.simulation.programMemory * 15
+        self.destroy()
+        self.assertEqual(sorted(self.getProgramSizes()), [10, 10, 10, 10, 20, 20, 40])
+        self.assertEqual(self.getDestroyed(), [])
+
+    def test_partial_failure(self):
+        failures = [self.doomed[0].name, self.doomed[-1].name]
+        self.simulation.programFailures.update(failures)
+        self.destroy()
+        self.assertEqual(self.getProgramSizes(), [40])
+        # Only the failed snapshots are left to the command line
+        self.assertEqual(self.getDestroyed(), sorted(failures))
+        self.assertTrue(self.program.available)
+
+    def test_unsupported(self):
+        self.simulation.channelPrograms = False
+        self.destroy()
+        self.assertFalse(self.program.available)
+        self.assertEqual(self.getDestroyed(), sorted([snapshot.name for snapshot in self.doomed]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest, os, tempfile, shutil
+from threading import Timer
+
+from common import cleaner, getSimulation, getState, getCapacity, LogCapture
+
+class DaemonTest(unittest.TestCase):
+
+    config = '<zpools><zpool name="tank" maxCapacity="0.8" pollInterval="0.1" cleanInterval="1000"><dataset name="tank" retentionPolicy="7 days" maxRetention="26 weeks" /></zpool></zpools>'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.conffile = os.path.join(self.directory, "zfs-snapshots-cleaner.conf")
+        open(self.conffile, "w").write(self.config)
+        self.simulation = getSimulation(datasets=10, snapshots=1000, capacity=0.97)
+        self.addCleanup(setattr, cleaner, "getRunner", cleaner.getRunner)
+        cleaner.getRunner = lambda: self.simulation
+        # Stopping the daemon cancels the commands of every runner
+        self.addCleanup(cleaner.CommandRunner.stopping.clear)
+
+    def runDaemon(self, dryrun, seconds):
+        daemon = cleaner.Daemon(self.conffile, dryrun)
+        timer = Timer(seconds, daemon.stop)
+        timer.start()
+        with LogCapture() as log:
+            daemon.run()
+        timer.join()
+        return log.messages
+
+    def test_dry_run(self):
+        state = getState(self.simulation)
+        messages = self.runDaemon(True, 1.5)
+        self.assertEqual(getState(self.simulation), state)
+        # Every best effort run would destroy the same snapshots
+        cycles = []
+        for message in messages:
+            if message.startswith("Zpool 'tank' is over maxCapacity"):
+                cycles.append([])
+            elif message.startswith("/sbin/zfs destroy") and cycles:
+                cycles[-1].append(message)
+        self.assertTrue(len(cycles) >= 2, messages)
+        self.assertTrue(cycles[0])
+        for cycle in cycles[1:]:
+            self.assertEqual(cycle, cycles[0])
+
+    def test_forced(self):
+        self.runDaemon(False, 1)
+        self.assertTrue(getCapacity(self.simulation) <= 0.8)
+
+if __name__ == "__main__":
+    unittest.main()
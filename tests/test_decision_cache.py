@@ -0,0 +1,46 @@
+import unittest, os, time, tempfile, shutil
+from datetime import datetime, timedelta
+
+from common import bench, cleaner, getSimulation
+
+class FixedDatetime(datetime):
+
+    # datetime whose today() is set by the test
+
+    current = None
+
+    @classmethod
+    def today(cls):
+        return cls.current
+
+class DecisionCacheTest(unittest.TestCase):
+
+    start = datetime(2026, 10, 17, 0, 30)
+    policy = "7 days and 4 sundays and 6 1st day of the month and 12 1st monday of the month and 4 1st day of the quarter and 36 hours and @auto-x"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(setattr, cleaner, "datetime", cleaner.datetime)
+        cleaner.datetime = FixedDatetime
+
+    def classify(self, now, cache):
+        # Decisions of a run at now, snapshots created up to start
+        FixedDatetime.current = now
+        simulation = getSimulation(now=int(time.mktime(self.start.timetuple())), datasets=10, snapshots=5000, days=600)
+        config = bench.getConfig(simulation.pool, "morerem", self.policy, "40 weeks")
+        if cache:
+            config[0]["decisionCache"] = os.path.join(self.directory, "decisions.sqlite")
+        zpool = cleaner.loadZpool(config, True, simulation)
+        zpool.classifySnapshots()
+        return dict((snapshot.name, snapshot.keep) for dataset in zpool.datasets for snapshot in dataset.snapshots)
+
+    def test_same_decisions(self):
+        # Runs over 200 days, each one compared to a run without cache
+        for hours in (0, 1, 23, 30, 24 * 6, 24 * 7 + 3, 24 * 33, 24 * 95, 24 * 200, 24 * 200 + 1):
+            now = self.start + timedelta(hours=hours)
+            cached = self.classify(now, True)
+            self.assertEqual(cached, self.classify(now, False), now)
+
+if __name__ == "__main__":
+    unittest.main()
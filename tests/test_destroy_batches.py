@@ -0,0 +1,43 @@
+import unittest
+
+from common import getSimulation, loadZpool
+
+class DestroyBatchesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.simulation = getSimulation(datasets=3, snapshots=600, holds=0.2)
+        zpool = loadZpool(self.simulation, False)
+        self.dataset = max(zpool.datasets, key=lambda dataset: len(dataset.snapshots))
+        self.dataset.destroyBatchSize = 200
+        # Runs of removable snapshots between kept and held ones
+        self.doomed = [snapshot for index, snapshot in enumerate(self.dataset.snapshots) if index % 7 not in (0, 4) and not snapshot.userrefs]
+        self.kept = [snapshot for snapshot in self.dataset.snapshots if snapshot not in set(self.doomed)]
+        self.assertTrue([snapshot for snapshot in self.kept if snapshot.userrefs])
+
+    def test_batches(self):
+        ranges = 0
+        destroyed = []
+        batches = list(self.dataset.getDestroyBatches(self.doomed))
+        self.assertTrue(len(batches) > 1)
+        for batch in batches:
+            self.assertTrue(len(",".join([item for item, run in batch])) <= self.dataset.destroyBatchSize)
+            for item, run in batch:
+                if "%" in item:
+                    ranges += 1
+                    first, last = run[0].timestamp, run[-1].timestamp
+                    covered = [snapshot for snapshot in self.dataset.snapshots if first <= snapshot.timestamp <= last]
+                    self.assertEqual(covered, run)
+                destroyed.extend(run)
+        self.assertTrue(ranges > 0)
+        self.assertEqual(sorted(destroyed, key=lambda snapshot: snapshot.timestamp), self.doomed)
+
+    def test_destroy(self):
+        # zfs destroys the ranges given, kept snapshots included if covered
+        self.dataset.destroySnapshots(self.doomed)
+        for snapshot in self.kept:
+            self.assertTrue(snapshot.name in self.simulation.snapshots, snapshot.name)
+        for snapshot in self.doomed:
+            self.assertFalse(snapshot.name in self.simulation.snapshots, snapshot.name)
+
+if __name__ == "__main__":
+    unittest.main()
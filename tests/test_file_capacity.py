@@ -0,0 +1,52 @@
+import unittest, time
+
+from common import getSimulation, loadZpool, LogCapture
+
+class FileCapacityTest(unittest.TestCase):
+
+    # Files deleted by age, oldest days first, until the dataset would be
+    # under its maxCapacity
+
+    def setUp(self):
+        self.simulation = getSimulation(datasets=3, snapshots=30)
+        zpool = loadZpool(self.simulation)
+        self.dataset = [dataset for dataset in zpool.datasets if dataset.name != self.simulation.pool][0]
+        self.used = self.simulation.datasets[self.dataset.name].used
+        self.simulation.datasets[self.dataset.name].refquota = self.used
+        self.dataset.maxCapacity = 0.5
+        self.sweepers = []
+        self.dataset.sweep = self.sweepers.append
+
+    def clean(self, histogram):
+        self.dataset.getAgeHistogram = lambda: dict((days, int(self.used * share)) for days, share in histogram.items())
+        with LogCapture() as log:
+            self.dataset.deleteOldestsFilesWhileNotUnderMaxCapacity()
+        return log.messages
+
+    def assertCutoff(self, days):
+        self.assertEqual(len(self.sweepers), 1)
+        sweeper = self.sweepers[0]
+        self.assertEqual(sweeper.attribute, "st_mtime")
+        self.assertTrue(abs(sweeper.cutoff - (time.time() - (days + 1) * 86400)) < 60, sweeper.cutoff)
+
+    def test_oldest_days_enough(self):
+        # Days 9 and 5 bring the dataset under half its quota
+        self.clean({0: 0.1, 2: 0.2, 5: 0.3, 9: 0.4})
+        self.assertCutoff(5)
+
+    def test_every_day(self):
+        self.clean({1: 0.1, 3: 0.1})
+        self.assertCutoff(1)
+
+    def test_under_max_capacity(self):
+        self.dataset.maxCapacity = 1.5
+        self.clean({0: 0.5, 9: 0.5})
+        self.assertEqual(self.sweepers, [])
+
+    def test_no_file(self):
+        messages = self.clean({})
+        self.assertEqual(self.sweepers, [])
+        self.assertTrue("No file to delete in '/%s'" % (self.dataset.name) in messages, messages)
+
+if __name__ == "__main__":
+    unittest.main()
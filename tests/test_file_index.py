@@ -0,0 +1,132 @@
+import unittest, os, time, tempfile, shutil
+
+from common import cleaner, LogCapture
+
+class DiffRunner(cleaner.CommandRunner):
+
+    # Answers zfs diff with the lines given, as zfs would report the changes
+    # made by the test
+
+    def __init__(self):
+        cleaner.CommandRunner.__init__(self)
+        self.diff = []
+
+    def runStream(self, cmd):
+        return iter(self.diff)
+
+class Snapshot(object):
+
+    def __init__(self, name, timestamp):
+        self.name = name
+        self.timestamp = timestamp
+
+class Filesystem(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.snapshots = []
+        self.zpool = self
+        self.runner = DiffRunner()
+
+class FileIndexTest(unittest.TestCase):
+
+    old = time.time() - 10 * 86400
+    cutoff = time.time() - 86400
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.root = os.path.join(self.directory, "tank")
+        for path in ("old", "a/old", "a/new", "a/b/old", "a/b/c/old", "c/old", "c/old 2", "e/f/old"):
+            self.makeFile(path, path != "a/new")
+        self.age("a", "a/b", "a/b/c", "c", "e", "e/f")
+        self.filesystem = Filesystem("tank")
+        self.filesystem.snapshots.append(Snapshot("tank@1", 1))
+        self.index = self.getIndex("index.sqlite")
+        self.index.update()
+
+    def getIndex(self, name):
+        index = cleaner.FileIndex(self.filesystem, os.path.join(self.directory, name))
+        index.root = self.root
+        return index
+
+    def getWalkedRows(self):
+        index = self.getIndex("walked.sqlite")
+        index.rebuild()
+        return self.getRows(index)
+
+    def makeFile(self, path, old):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, "w").write("x" * 10)
+        if old:
+            self.age(path)
+
+    def age(self, *paths):
+        for path in paths:
+            os.utime(os.path.join(self.root, path), (self.old, self.old))
+
+    def path(self, path):
+        # As zfs diff writes it, unprintable characters as \0ooo
+        return os.path.join(self.root, path).replace(" ", "\\0040")
+
+    def getRows(self, index):
+        return index.connection.execute("SELECT * FROM files ORDER BY path").fetchall()
+
+    def listTree(self, root):
+        paths = []
+        for directory, directories, files in os.walk(root):
+            for name in directories + files:
+                paths.append(os.path.relpath(os.path.join(directory, name), root))
+        return sorted(paths)
+
+    def test_diff(self):
+        # Modified, renamed, removed and created between two snapshots
+        open(os.path.join(self.root, "old"), "a").write("x")
+        os.rename(os.path.join(self.root, "a/b"), os.path.join(self.root, "a/moved"))
+        os.rename(os.path.join(self.root, "c/old 2"), os.path.join(self.root, "c/renamed"))
+        os.unlink(os.path.join(self.root, "c/old"))
+        self.makeFile("d/old", True)
+        self.age("a", "c", "d")
+        self.filesystem.runner.diff = ["%s\n" % "\t".join(fields) for fields in (
+            ("M", "F", self.path("old")),
+            ("M", "/", self.root),
+            ("R", "/", self.path("a/b"), self.path("a/moved")),
+            ("M", "/", self.path("a")),
+            ("R", "F", self.path("c/old 2"), self.path("c/renamed")),
+            ("-", "F", self.path("c/old")),
+            ("M", "/", self.path("c")),
+            ("+", "/", self.path("d")),
+            ("+", "F", self.path("d/old")))]
+        self.filesystem.snapshots.append(Snapshot("tank@2", 2))
+        self.index.update()
+        self.assertEqual(self.index.connection.execute("SELECT name FROM baseline").fetchone(), ("tank@2", ))
+
+        # The same entries as a full walk
+        self.assertEqual(self.getRows(self.index), self.getWalkedRows())
+        paths = [row[0] for row in self.getRows(self.index)]
+        self.assertTrue(os.path.join(self.root, "a/moved/c/old") in paths)
+        self.assertFalse([path for path in paths if path.startswith(os.path.join(self.root, "a/b")) or path == os.path.join(self.root, "c/old")])
+
+        # Deleting the same files and directories as the walk
+        walked = os.path.join(self.directory, "walked")
+        shutil.copytree(self.root, walked)
+        with LogCapture() as log:
+            self.index.sweep(cleaner.FileSweeper(self.root, self.cutoff, "st_mtime", True, 1))
+            cleaner.FileSweeper(self.root, self.cutoff, "st_mtime", True, 1).sweep()
+        self.assertEqual(sorted(log.messages[:len(log.messages) // 2]), sorted(log.messages[len(log.messages) // 2:]))
+        self.index.sweep(cleaner.FileSweeper(self.root, self.cutoff, "st_mtime", False, 1))
+        cleaner.FileSweeper(walked, self.cutoff, "st_mtime", False, 1).sweep()
+        self.assertEqual(self.listTree(self.root), self.listTree(walked))
+        self.assertEqual(self.listTree(self.root), ["a", "a/new", "c", "d", "e", "old"])
+
+    def test_baseline_gone(self):
+        # The table is rebuilt when the snapshot last indexed is gone
+        os.unlink(os.path.join(self.root, "c/old"))
+        self.filesystem.snapshots = [Snapshot("tank@2", 2)]
+        self.index.update()
+        self.assertEqual(self.getRows(self.index), self.getWalkedRows())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest, os, sys, time, tempfile, shutil, signal
+from subprocess import Popen, STDOUT
+
+# Cleans a simulated zpool through main, the configuration given as argv[1]
+# and the cleaner options following it. With DESTROY_DELAY set, each
+# destroy first runs a sleep of that many seconds.
+script = """
+import sys, os, logging
+sys.path.insert(0, %r)
+from common import cleaner, getSimulation
+simulation = getSimulation(datasets=10, snapshots=1000, capacity=0.97)
+cleaner.getRunner = lambda: simulation
+delay = os.environ.get("DESTROY_DELAY")
+if delay:
+    zfsDestroy = simulation.zfsDestroy
+    def destroy(cmd):
+        if "-nvp" not in cmd:
+            cleaner.CommandRunner.run(simulation, ["sleep", delay])
+        return zfsDestroy(cmd)
+    simulation.zfsDestroy = destroy
+# main sets up its own logging
+logging.getLogger().handlers = []
+try:
+    cleaner.main(["-c"] + sys.argv[1:])
+except SystemExit as e:
+    print "exit", e.code
+else:
+    print "exit", 0
+""" % os.path.dirname(os.path.abspath(__file__))
+
+class JobsTest(unittest.TestCase):
+
+    timeout = 60
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def runMain(self, zpools, *args, **kwargs):
+        # Output of main, SIGTERM being sent after terminate seconds if set
+        conffile = os.path.join(self.directory, "zfs-snapshots-cleaner.conf")
+        open(conffile, "w").write("<zpools>%s</zpools>" % "".join(zpools))
+        output = open(os.path.join(self.directory, "output"), "w+")
+        self.addCleanup(output.close)
+        environment = dict(os.environ)
+        environment.update(kwargs.get("environment", {}))
+        process = Popen([sys.executable, "-c", script, conffile] + list(args), stdout=output, stderr=STDOUT, preexec_fn=os.setsid, env=environment)
+        # A hung process is killed past the timeout, with its workers
+        start = time.time()
+        deadline = start + self.timeout
+        terminate = kwargs.get("terminate")
+        while process.poll() == None and time.time() < deadline:
+            if terminate != None and time.time() - start >= terminate:
+                os.kill(process.pid, signal.SIGTERM)
+                terminate = None
+            time.sleep(0.1)
+        if process.poll() == None:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            self.fail("%s did not finish in %d seconds" % (" ".join(args), self.timeout))
+        # Nor workers nor commands are left behind
+        self.assertRaises(OSError, os.killpg, process.pid, 0)
+        output.seek(0)
+        return output.read()
+
+    bad = '<zpool name="tank"><dataset name="tank" retentionPolicy="7 fortnights" /></zpool>'
+    good = '<zpool name="tank" maxCapacity="0.8"><dataset name="tank" retentionPolicy="7 days" maxRetention="26 weeks" /></zpool>'
+
+    def test_bad_policy(self):
+        for jobs in ("1", "2"):
+            output = self.runMain([self.bad, self.good], "-j", jobs)
+            self.assertTrue("Zpool 'tank' was NOT cleaned: unknown policy: 7 fortnights" in output, output)
+            # The other zpool is still cleaned
+            self.assertTrue("Used by snapshots" in output, output)
+            self.assertTrue(output.rstrip().endswith("exit 1"), output)
+
+    def test_exit_status(self):
+        output = self.runMain([self.good, self.good], "-j", "2")
+        self.assertTrue(output.rstrip().endswith("exit 0"), output)
+
+    def test_terminate(self):
+        # Two zpools stuck in destroys, cancelled on SIGTERM
+        for jobs in ("1", "2"):
+            start = time.time()
+            output = self.runMain([self.good, self.good], "-j", jobs, "-f", terminate=3, environment={"DESTROY_DELAY": "600"})
+            self.assertTrue(time.time() - start < 30, output)
+            self.assertTrue("Stopped on SIGTERM" in output, output)
+            self.assertTrue(output.rstrip().endswith("exit 1"), output)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest, os, time, tempfile, shutil, json, re
+from threading import Thread
+
+from common import cleaner, getSimulation, getConfig, loadZpool
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_concurrent_phases(self):
+        # Chains in the same phase at once count its wall time once
+        metrics = cleaner.Metrics(loadZpool(getSimulation(datasets=3, snapshots=30)))
+        def chain():
+            with metrics.phase("maxRetention"):
+                time.sleep(0.2)
+                with metrics.phase("maxFileAge"):
+                    time.sleep(0.2)
+        start = time.time()
+        threads = [Thread(target=chain) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        phases = metrics.getFigures()["phases"]
+        self.assertEqual(sorted(phases), ["maxFileAge", "maxRetention"])
+        for seconds in phases.values():
+            self.assertTrue(0.15 < seconds < 0.3, phases)
+        self.assertTrue(sum(phases.values()) <= elapsed, phases)
+
+    def test_output(self):
+        simulation = getSimulation(datasets=10, snapshots=1000, capacity=0.97)
+        self.addCleanup(setattr, cleaner, "getRunner", cleaner.getRunner)
+        cleaner.getRunner = lambda: simulation
+        start = time.time()
+        summary = cleaner.processZpool((getConfig(simulation), False, False, False, None, None))
+        elapsed = time.time() - start
+        figures = {simulation.pool: summary["metrics"]}
+        for phase, seconds in figures[simulation.pool]["phases"].items():
+            self.assertTrue(seconds <= elapsed, (phase, seconds, elapsed))
+        self.assertTrue(figures[simulation.pool]["reclaimed"]["bestEffort"]["snapshots"] > 0)
+
+        path = os.path.join(self.directory, "metrics.json")
+        cleaner.writeMetrics(path, figures)
+        self.assertEqual(json.load(open(path)), json.loads(json.dumps(figures)))
+
+        path = os.path.join(self.directory, "metrics.prom")
+        cleaner.writeMetrics(path, figures)
+        samples = {}
+        for line in open(path).read().splitlines():
+            if line.startswith("# TYPE "):
+                self.assertTrue(line.split()[3] in ("gauge", "histogram"), line)
+            elif not line.startswith("# HELP "):
+                name, labels, value = re.match(r'^(zfs_snapshots_cleaner_\w+)\{(.*)\} (\S+)$', line).groups()
+                samples.setdefault(name, []).append((dict(re.findall(r'(\w+)="([^"]*)"', labels)), float(value)))
+        self.assertEqual(samples["zfs_snapshots_cleaner_dryrun"], [({"zpool": simulation.pool}, 0)])
+        reclaimed = dict((labels["policy"], value) for labels, value in samples["zfs_snapshots_cleaner_reclaimed_snapshots"])
+        self.assertEqual(reclaimed["bestEffort"], figures[simulation.pool]["reclaimed"]["bestEffort"]["snapshots"])
+
+        # Cumulative buckets ending with the count of each command
+        counts = dict((labels["command"], value) for labels, value in samples["zfs_snapshots_cleaner_command_seconds_count"])
+        self.assertTrue(counts["zfs destroy"] > 0)
+        for command, count in counts.items():
+            buckets = [value for labels, value in samples["zfs_snapshots_cleaner_command_seconds_bucket"] if labels["command"] == command]
+            self.assertEqual(buckets, sorted(buckets))
+            self.assertEqual(buckets[-1], count)
+
+if __name__ == "__main__":
+    unittest.main()
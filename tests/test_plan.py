@@ -0,0 +1,40 @@
+import unittest, os, time, tempfile, shutil
+from datetime import datetime
+
+from common import cleaner, getSimulation, loadZpool, getState
+
+class PlanTest(unittest.TestCase):
+
+    # Snapshots created up to the start of the day, so that both runs of a
+    # test see the same policies
+    now = int(time.mktime(datetime.today().replace(hour=0, minute=5, second=0, microsecond=0).timetuple()))
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_apply_as_forced_run(self):
+        path = os.path.join(self.directory, "plan.jsonl")
+        for bestEffortPolicy in ("oldest", "biggest", "morerem", "more"):
+            simulation = getSimulation(now=self.now, capacity=0.97)
+            loadZpool(simulation, False, bestEffortPolicy).clean()
+            forced = getState(simulation)
+
+            simulation = getSimulation(now=self.now, capacity=0.97)
+            planned = getState(simulation)
+            zpool = loadZpool(simulation, True, bestEffortPolicy)
+            stream = open(path, "w")
+            zpool.plan = cleaner.Plan(stream)
+            zpool.plan.begin(zpool)
+            zpool.clean()
+            zpool.plan.end()
+            stream.close()
+            # Planning changes nothing
+            self.assertEqual(getState(simulation), planned)
+
+            zpool = cleaner.Zpool(simulation.pool, False, simulation, [])
+            zpool.applyPlan(path, list(cleaner.getPlanOffsets(path))[0])
+            self.assertEqual(getState(simulation), forced, bestEffortPolicy)
+
+if __name__ == "__main__":
+    unittest.main()
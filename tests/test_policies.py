@@ -0,0 +1,76 @@
+import unittest
+from datetime import datetime, timedelta
+
+from common import cleaner, getSimulation, loadZpool
+
+class CompilePolicyTest(unittest.TestCase):
+
+    # Wednesday
+    now = datetime(2026, 10, 14, 15, 30)
+    today = datetime(2026, 10, 14)
+
+    def compile(self, policy):
+        return cleaner.compilePolicy(policy, self.now)
+
+    def test_cutoffs(self):
+        self.assertEqual(self.compile("36 hours").cutoff, self.now - timedelta(hours=36))
+        self.assertEqual(self.compile("7 days").cutoff, self.today - timedelta(days=7))
+        self.assertEqual(self.compile("1 day").cutoff, self.today - timedelta(days=1))
+        self.assertEqual(self.compile("26 weeks").cutoff, self.today - timedelta(weeks=26))
+        self.assertEqual(self.compile("4 sundays").cutoff, self.today - timedelta(weeks=4))
+        self.assertEqual(self.compile("6 1st day of the month").cutoff, datetime(2026, 5, 1))
+        self.assertEqual(self.compile("4 1st day of the quarter").cutoff, datetime(2025, 10, 1))
+        self.assertEqual(self.compile("none").cutoff, datetime.max)
+        self.assertEqual(self.compile("all").cutoff, None)
+
+    def test_nth_weekday_of_the_month(self):
+        # The 1st monday of October is past, the current month counts
+        policy = self.compile("12 1st monday of the month")
+        self.assertEqual(policy.cutoff, datetime(2025, 11, 1))
+        self.assertTrue(policy.test(None, datetime(2026, 10, 5)))
+        self.assertFalse(policy.test(None, datetime(2026, 10, 12)))
+        self.assertFalse(policy.test(None, datetime(2026, 10, 6)))
+        # No monday yet in October, it does not
+        policy = cleaner.compilePolicy("2 1st monday of the month", datetime(2026, 10, 1, 12))
+        self.assertEqual(policy.cutoff, datetime(2026, 8, 1))
+
+    def test_unknown_policy(self):
+        for policy in ("7 fortnights", "days", "7 days and 4 sundays", ""):
+            self.assertRaises(ValueError, self.compile, policy)
+
+class ClassifySnapshotsTest(unittest.TestCase):
+
+    def getExpected(self, dataset, snapshot):
+        # Sequential evaluation of the policies, one snapshot at a time
+        keep = None
+        if dataset.maxRetention:
+            keep = False
+            if [policy for policy in dataset.maxRetention if policy.match(snapshot)]:
+                keep = None
+        if [policy for policy in dataset.retentionPolicy if policy.match(snapshot)]:
+            keep = True
+        return keep
+
+    def test_matches_sequential_evaluation(self):
+        zpool = loadZpool(getSimulation())
+        zpool.classifySnapshots()
+        counts = {}
+        for dataset in zpool.datasets:
+            for snapshot in dataset.snapshots:
+                self.assertEqual(snapshot.keep, self.getExpected(dataset, snapshot), snapshot.name)
+                counts[snapshot.keep] = counts.get(snapshot.keep, 0) + 1
+        # Every decision is exercised
+        self.assertEqual(sorted(counts), [None, False, True])
+
+    def test_snapshot_name(self):
+        simulation = getSimulation(datasets=3, snapshots=30)
+        zpool = loadZpool(simulation)
+        dataset = zpool.getDataset(simulation.pool)
+        oldest = min(dataset.snapshots, key=lambda snapshot: snapshot.timestamp)
+        dataset.retentionPolicy = "7 days and @%s" % oldest.shortname
+        zpool.resolvePolicies()
+        zpool.classifySnapshots()
+        self.assertEqual(oldest.keep, True)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+
+from common import getSimulation, loadZpool, getState, traceCommands
+
+class ReclaimTest(unittest.TestCase):
+
+    def getEstimates(self, commands):
+        # Number of zfs destroy -nvp by dataset
+        estimates = {}
+        for cmd in commands:
+            if cmd[1] == "destroy" and "-nvp" in cmd:
+                dataset = cmd[-1].split("@")[0]
+                estimates[dataset] = estimates.get(dataset, 0) + 1
+        return estimates
+
+    def test_one_estimate_per_dataset(self):
+        simulation = getSimulation(capacity=0.97)
+        zpool = loadZpool(simulation, False)
+        zpool.classifySnapshots()
+        zpool.destroySnapshotsOutOfMaxRetention()
+        commands = traceCommands(simulation)
+        zpool.destroySnapshotsWhileOverMaxCapacity()
+        estimates = self.getEstimates(commands)
+        self.assertTrue(estimates)
+        self.assertEqual(max(estimates.values()), 1)
+
+    def test_no_estimate_in_dry_run(self):
+        simulation = getSimulation(capacity=0.97)
+        state = getState(simulation)
+        zpool = loadZpool(simulation, True)
+        commands = traceCommands(simulation)
+        zpool.clean()
+        self.assertEqual(self.getEstimates(commands), {})
+        self.assertEqual(getState(simulation), state)
+
+    def test_prefix(self):
+        simulation = getSimulation(capacity=0.97)
+        zpool = loadZpool(simulation, False)
+        zpool.classifySnapshots()
+        order = list(zpool.getBestEffortOrder())[:100]
+        for snapshot in order:
+            zpool.reclaimRatios[snapshot.dataset] = 0.5
+        used = [snapshot.used for snapshot in order]
+        needed = sum(used) / 4
+        length = zpool.getReclaimPrefix(order, needed)
+        self.assertTrue(sum(used[:length]) * 0.5 >= needed)
+        self.assertTrue(sum(used[:length - 1]) * 0.5 < needed)
+        self.assertEqual(zpool.getReclaimPrefix(order, sum(used)), len(order))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest, os, sys, tempfile, shutil, gzip
+from StringIO import StringIO
+from subprocess import CalledProcessError
+
+from common import cleaner, getSimulation, getConfig, LogCapture, retentionPolicy, maxRetention
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.trace = os.path.join(self.directory, "trace.gz")
+        self.getRunner = cleaner.getRunner
+        self.addCleanup(setattr, cleaner, "getRunner", self.getRunner)
+        self.addCleanup(setattr, cleaner.CommandRunner, "recorder", None)
+        self.addCleanup(setattr, cleaner.ReplayRunner, "replay", None)
+
+    def process(self, config, channelPrograms):
+        # Summary and log of a forced run, datasets being cleaned
+        # concurrently
+        with LogCapture() as log:
+            summary = cleaner.processZpool((config, False, False, channelPrograms, None, None))
+        del summary["metrics"]
+        return summary, sorted(log.messages)
+
+    def test_replay(self):
+        for channelPrograms in (False, True):
+            simulation = getSimulation(datasets=10, snapshots=1000, capacity=0.97)
+            config = getConfig(simulation)
+            cleaner.getRunner = lambda: simulation
+            cleaner.CommandRunner.recorder = cleaner.Recorder(self.trace, ["-f"])
+            recorded = self.process(config, channelPrograms)
+            cleaner.CommandRunner.recorder.save()
+            cleaner.CommandRunner.recorder = None
+            self.assertTrue([message for message in recorded[1] if message.endswith("has been destroyed")])
+
+            # Replayed without the simulation
+            cleaner.getRunner = self.getRunner
+            cleaner.ReplayRunner.replay = cleaner.Replay(self.trace)
+            self.assertEqual(self.process(config, channelPrograms), recorded)
+            cleaner.ReplayRunner.replay = None
+
+    def test_main(self):
+        # The trace holds the options and configuration of the run
+        simulation = getSimulation(datasets=10, snapshots=1000, capacity=0.97)
+        conffile = os.path.join(self.directory, "zfs-snapshots-cleaner.conf")
+        open(conffile, "w").write('<zpools><zpool name="tank" maxCapacity="0.8" bestEffortPolicy="oldest"><dataset name="tank" retentionPolicy="%s" maxRetention="%s" /></zpool></zpools>' % (retentionPolicy, maxRetention))
+        cleaner.getRunner = lambda: simulation
+        with LogCapture() as log:
+            cleaner.main(["-c", conffile, "-f", "--record", self.trace])
+        recorded = [message for message in log.messages if message.startswith("Snapshot ")]
+        self.assertTrue([message for message in recorded if message.endswith("has been destroyed")])
+
+        os.remove(conffile)
+        cleaner.CommandRunner.recorder = None
+        cleaner.getRunner = self.getRunner
+        with LogCapture() as log:
+            cleaner.main(["--replay", self.trace])
+        self.assertEqual(sorted([message for message in log.messages if message.startswith("Snapshot ")]), sorted(recorded))
+        self.assertFalse(os.path.exists(conffile))
+
+    def test_not_in_trace(self):
+        gzip.open(self.trace, "wb").close()
+        cleaner.ReplayRunner.replay = cleaner.Replay(self.trace)
+        runner = cleaner.getRunner()
+        # Where zfs would have written the error
+        self.addCleanup(setattr, sys, "stderr", sys.stderr)
+        sys.stderr = StringIO()
+        self.assertRaises(CalledProcessError, runner.check_output, ["/sbin/zfs", "list", "tank"])
+        self.assertEqual(sys.stderr.getvalue(), "/sbin/zfs list tank: not in trace\n")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest, os, tempfile, shutil, json, csv
+
+from common import cleaner, getSimulation, getState, loadZpool, retentionPolicy, maxRetention
+
+class ReportTest(unittest.TestCase):
+
+    statuses = {True: "keep", False: "destroy", None: "removable"}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.simulation = getSimulation(capacity=0.97)
+        self.addCleanup(setattr, cleaner, "getRunner", cleaner.getRunner)
+        cleaner.getRunner = lambda: self.simulation
+        self.cache = os.path.join(self.directory, "decisions.sqlite")
+        self.conffile = os.path.join(self.directory, "zfs-snapshots-cleaner.conf")
+        open(self.conffile, "w").write('<zpools><zpool name="tank" maxCapacity="0.8" decisionCache="%s"><dataset name="tank" retentionPolicy="%s" maxRetention="%s" /></zpool></zpools>' % (self.cache, retentionPolicy, maxRetention))
+
+    def report(self, name, *args):
+        path = os.path.join(self.directory, name)
+        cleaner.main(["-c", self.conffile, "--report", path] + list(args))
+        return path
+
+    def test_read_only(self):
+        state = getState(self.simulation)
+        self.report("report.jsonl", "-f")
+        self.assertEqual(getState(self.simulation), state)
+        self.assertFalse(os.path.exists(self.cache))
+
+    def test_statuses(self):
+        rows = [json.loads(line) for line in open(self.report("report.jsonl"))]
+        snapshots = [row for row in rows if "snapshot" in row]
+        statuses = dict(("%s@%s" % (row["dataset"], row["snapshot"]), row["status"]) for row in snapshots)
+        order = [(row["dataset"], row["creation"]) for row in snapshots]
+        self.assertEqual(order, sorted(order))
+        expected = {}
+        for dataset in loadZpool(self.simulation).datasets:
+            for snapshot in dataset.snapshots:
+                expected[snapshot.name] = self.statuses[snapshot.keep]
+        self.assertEqual(statuses, expected)
+
+        # The same rows as CSV
+        path = self.report("report.csv")
+        self.assertEqual(len(list(csv.DictReader(open(path)))), len(rows))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest, time
+from StringIO import StringIO
+from subprocess import CalledProcessError
+from threading import Thread, Event
+
+from common import cleaner, getSimulation
+
+class ScriptedRunner(cleaner.CommandRunner):
+
+    # Fails each command with the given outputs before answering it, writes
+    # waiting for release to be set
+
+    backoff = 0.01
+
+    def __init__(self, failures=()):
+        cleaner.CommandRunner.__init__(self)
+        self.failures = list(failures)
+        self.attempts = 0
+        self.release = Event()
+
+    def run(self, cmd, **kwargs):
+        self.attempts += 1
+        if self.failures:
+            raise CalledProcessError(1, cmd, self.failures.pop(0))
+        if self.isWrite(cmd):
+            self.release.wait()
+        return "done\n"
+
+class CommandRunnerTest(unittest.TestCase):
+
+    destroy = ["/sbin/zfs", "destroy", "-d", "tank@auto"]
+
+    def test_timeout(self):
+        runner = cleaner.CommandRunner()
+        runner.timeout = 0.5
+        start = time.time()
+        self.assertRaises(cleaner.CommandTimeout, runner.check_output, ["sleep", "5"])
+        self.assertTrue(time.time() - start < 3)
+        self.assertEqual(runner.calls, {"sleep": 1})
+
+    def test_busy_retried(self):
+        runner = ScriptedRunner(["cannot destroy: dataset is busy\n"] * 2)
+        runner.release.set()
+        self.assertEqual(runner.check_output(self.destroy), "done\n")
+        self.assertEqual(runner.attempts, 3)
+        self.assertEqual(runner.calls, {"zfs destroy": 3})
+
+    def test_busy_retries_exhausted(self):
+        runner = ScriptedRunner(["cannot destroy: dataset is busy\n"] * 10)
+        self.assertRaises(CalledProcessError, runner.check_output, self.destroy)
+        self.assertEqual(runner.attempts, runner.retries + 1)
+
+    def test_error_not_retried(self):
+        runner = ScriptedRunner(["cannot destroy: dataset does not exist\n"])
+        self.assertRaises(CalledProcessError, runner.check_output, self.destroy)
+        self.assertEqual(runner.attempts, 1)
+
+    def test_query_not_queued_behind_writes(self):
+        runner = ScriptedRunner()
+        runner.setMaxCommands(2)
+        runner.setMaxWrites(1)
+        writers = [Thread(target=runner.check_output, args=(self.destroy,)) for i in range(3)]
+        answers = []
+        query = Thread(target=lambda: answers.append(runner.check_output(["/sbin/zfs", "list", "-Hp", "tank"])))
+        try:
+            for writer in writers:
+                writer.start()
+            time.sleep(0.1)
+            query.start()
+            query.join(5)
+            self.assertEqual(answers, ["done\n"])
+        finally:
+            runner.release.set()
+            for thread in writers + [query]:
+                thread.join()
+
+    def test_shared_limits(self):
+        # Writes of two zpools, one at a time over both
+        self.addCleanup(cleaner.CommandRunner.setSharedLimits)
+        cleaner.CommandRunner.setSharedLimits(4, 1)
+        runners = [ScriptedRunner(), ScriptedRunner()]
+        writers = [Thread(target=runner.check_output, args=(self.destroy,)) for runner in runners for i in range(2)]
+        try:
+            for writer in writers:
+                writer.start()
+            time.sleep(0.2)
+            self.assertEqual(sum([runner.attempts for runner in runners]), 1)
+        finally:
+            for runner in runners:
+                runner.release.set()
+            for writer in writers:
+                writer.join()
+        self.assertEqual(sum([runner.attempts for runner in runners]), 4)
+
+    def test_limits_configured(self):
+        simulation = getSimulation(datasets=3, snapshots=30)
+        config = cleaner.readConfig(StringIO('<zpool name="%s" maxCommands="3" maxWrites="1" commandTimeout="5" />' % simulation.pool)).next()
+        zpool = cleaner.loadZpool(config, True, simulation)
+        self.assertEqual((zpool.runner.maxCommands, zpool.runner.maxWrites, zpool.runner.timeout), (3, 1, 5))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+from StringIO import StringIO
+
+from common import cleaner, getSimulation, traceCommands
+
+class ScopeTest(unittest.TestCase):
+
+    subtrees = ["tank/ds3/ds4/ds13/ds22/ds27", "tank/ds3/ds4/ds24", "tank/ds3/ds4", "tank/ds3/ds4/ds13", "tank/ds3/ds4/ds13/ds22", "tank/ds14/ds20"]
+    ancestors = ["tank", "tank/ds14", "tank/ds3"]
+
+    def setUp(self):
+        self.simulation = getSimulation()
+        config = '<zpool name="tank" scope="configured"><dataset name="tank/ds3/ds4" retentionPolicy="7 days" /><dataset name="tank/ds14/ds20" maxRetention="26 weeks" /></zpool>'
+        self.zpool = cleaner.loadZpool(cleaner.readConfig(StringIO(config)).next(), False, self.simulation)
+
+    def test_load(self):
+        self.assertEqual(sorted([dataset.name for dataset in self.zpool.datasets]), sorted(self.subtrees + self.ancestors))
+        for dataset in self.zpool.datasets:
+            simulated = self.simulation.datasets[dataset.name]
+            if dataset.name in self.ancestors:
+                self.assertEqual(len(dataset.snapshots), 0, dataset.name)
+            else:
+                self.assertEqual(sorted([snapshot.name for snapshot in dataset.snapshots]), sorted([snapshot.name for snapshot in simulated.snapshots]))
+
+    def test_resync(self):
+        commands = traceCommands(self.simulation)
+        self.zpool.capacityTracker.invalidate()
+        self.zpool.capacityTracker.resync()
+        listed = []
+        for cmd in commands:
+            if cmd[1] == "list":
+                self.assertFalse([arg for arg in cmd if arg.startswith("-r")], cmd)
+                listed.extend(cmd[cmd.index("name,used,available,referenced") + 1:])
+        self.assertEqual(sorted(listed), sorted(self.subtrees + self.ancestors))
+        self.assertEqual(self.zpool.used, self.simulation.datasets["tank"].used)
+
+if __name__ == "__main__":
+    unittest.main()
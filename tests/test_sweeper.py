@@ -0,0 +1,79 @@
+import unittest, os, time, tempfile, shutil, logging
+
+from common import cleaner, LogCapture
+
+class FileSweeperTest(unittest.TestCase):
+
+    old = time.time() - 10 * 86400
+    cutoff = time.time() - 86400
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for path, old in (("old", True), ("a/old", True), ("a/new", False), ("a/b/old", True), ("a/b/c/old", True), ("a/d/new", False), ("e/f/old", True)):
+            self.makeFile(path, old)
+        # Directories are aged once their files are created
+        for path in ("a", "a/b", "a/b/c", "a/d", "e", "e/f"):
+            self.touch(path, True)
+
+    def touch(self, path, old):
+        if old:
+            os.utime(os.path.join(self.root, path), (self.old, self.old))
+
+    def makeFile(self, path, old):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, "w").write("x" * 10)
+        self.touch(path, old)
+
+    def listTree(self):
+        paths = []
+        for directory, directories, files in os.walk(self.root):
+            for name in directories + files:
+                paths.append(os.path.relpath(os.path.join(directory, name), self.root))
+        return sorted(paths)
+
+    def sweep(self, dryrun, workers):
+        sweeper = cleaner.FileSweeper(self.root, self.cutoff, "st_mtime", dryrun, workers, 1)
+        sweeper.sweep()
+        return sweeper
+
+    def test_sweep(self):
+        sweeper = self.sweep(False, 1)
+        # Directories from depth 2 go once empty, those above stay
+        self.assertEqual(self.listTree(), ["a", "a/d", "a/d/new", "a/new", "e"])
+        self.assertEqual((sweeper.files, sweeper.size, sweeper.directories), (5, 50, 3))
+
+    def test_sweep_workers(self):
+        sweeper = self.sweep(False, 4)
+        self.assertEqual(self.listTree(), ["a", "a/d", "a/d/new", "a/new", "e"])
+        self.assertEqual((sweeper.files, sweeper.size, sweeper.directories), (5, 50, 3))
+
+    def test_dry_run(self):
+        tree = self.listTree()
+        sweeper = self.sweep(True, 4)
+        self.assertEqual(self.listTree(), tree)
+        self.assertEqual((sweeper.files, sweeper.size, sweeper.directories), (5, 50, 3))
+
+    def test_recent_directory_kept(self):
+        os.utime(os.path.join(self.root, "a/b/c"), None)
+        self.sweep(False, 1)
+        self.assertEqual(self.listTree(), ["a", "a/b", "a/b/c", "a/d", "a/d/new", "a/new", "e"])
+
+    def test_held_log(self):
+        # Lines of the workers are held with those of the sweeping thread
+        capture = LogCapture()
+        buffer = cleaner.LogBuffer([capture])
+        logger = logging.getLogger()
+        self.addCleanup(logger.setLevel, logger.level)
+        self.addCleanup(logger.removeHandler, buffer)
+        logger.addHandler(buffer)
+        logger.setLevel(logging.INFO)
+        forwarded = buffer.hold(lambda: (self.sweep(True, 4), len(capture.messages))[1])
+        self.assertEqual(forwarded, 0)
+        self.assertEqual(len([message for message in capture.messages if message.startswith("File ")]), 5)
+        self.assertTrue(capture.messages[-1].startswith("%s: 5 files" % (self.root)), capture.messages)
+
+if __name__ == "__main__":
+    unittest.main()
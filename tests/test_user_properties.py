@@ -0,0 +1,40 @@
+import unittest, logging
+from StringIO import StringIO
+
+from common import cleaner, getSimulation, LogCapture
+
+class UserPropertiesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.simulation = getSimulation()
+        for name, property, value in (("tank", "cleaner:retention", "7 days"), ("tank", "cleaner:maxretention", "26 weeks"), ("tank/ds3", "cleaner:retention", "7 fortnights"), ("tank/ds9", "cleaner:retention", "30 days")):
+            self.simulation.datasets[name].properties[property] = value
+
+    def load(self, datasets=""):
+        config = cleaner.readConfig(StringIO('<zpool name="tank" userProperties="yes">%s</zpool>' % datasets)).next()
+        return cleaner.loadZpool(config, True, self.simulation)
+
+    def getPolicies(self, zpool, name):
+        dataset = zpool.getDataset(name)
+        return [str(policy) for policy in dataset.retentionPolicy], [str(policy) for policy in dataset.maxRetention]
+
+    def test_inherited(self):
+        zpool = self.load()
+        self.assertEqual(self.getPolicies(zpool, "tank/ds9"), (["30 days"], ["26 weeks"]))
+        self.assertEqual(self.getPolicies(zpool, "tank/ds9/ds10/ds21"), (["30 days"], ["26 weeks"]))
+        self.assertEqual(self.getPolicies(zpool, "tank/ds14/ds20"), (["7 days"], ["26 weeks"]))
+
+    def test_invalid_ignored(self):
+        with LogCapture(logging.ERROR) as log:
+            zpool = self.load()
+        self.assertEqual(self.getPolicies(zpool, "tank/ds3"), (["7 days"], ["26 weeks"]))
+        self.assertEqual(self.getPolicies(zpool, "tank/ds3/ds4"), (["7 days"], ["26 weeks"]))
+        self.assertEqual(len(log.messages), 1)
+        self.assertTrue(log.messages[0].startswith("Dataset 'tank/ds3': cleaner:retention='7 fortnights' is ignored"), log.messages)
+
+    def test_configuration_first(self):
+        zpool = self.load('<dataset name="tank/ds9" retentionPolicy="14 days" />')
+        self.assertEqual(self.getPolicies(zpool, "tank/ds9"), (["14 days"], ["26 weeks"]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,477 @@
+#!/usr/local/bin/python
+
+""" Benchmark zfs-snapshots-cleaner against a simulated zpool
+
+Usage: zfs-snapshots-cleaner-bench.py [options]
+
+Options:
+    -h, --help              show this help
+    -f, --force             run the phases in force mode (the simulated pool is modified)
+    -p, --channel-programs  destroy snapshots with zfs channel programs
+    -v, --verbose           show the cleaner log
+    -n, --datasets N        number of datasets in the simulated zpool (default 100)
+    -s, --snapshots N       number of snapshots in the simulated zpool (default 10000)
+    --holds RATIO           ratio of held snapshots (default 0.1)
+    --quotas RATIO          ratio of filesystems with a refquota (default 0.1)
+    --volumes RATIO         ratio of volumes among datasets (default 0.05)
+    --capacity RATIO        initial zpool capacity (default 0.9)
+    --days N                age of the oldest snapshot in days (default 365)
+    --seed N                random seed (default 0)
+    --now N                 simulated time as a timestamp, runs share snapshots (default the current time)
+    --bestEffortPolicy P    zpool bestEffortPolicy (default morerem)
+    --retentionPolicy P     retentionPolicy of the zpool root dataset
+    --maxRetention P        maxRetention of the zpool root dataset
+    -u, --userProperties    set the policies of the root dataset with user properties instead of the configuration
+    --decisionCache PATH    keep the snapshot decisions in PATH, a second run reuses them
+"""
+
+import sys, getopt, os, imp, time, random, re, json, errno
+import logging
+from StringIO import StringIO
+from hashlib import md5
+from subprocess import CalledProcessError
+from datetime import datetime
+from threading import Lock
+
+cleaner = imp.load_source("zfs_snapshots_cleaner", os.path.join(os.path.dirname(os.path.abspath(__file__)), "zfs-snapshots-cleaner.py"))
+
+class SimulatedDataset(object):
+
+    def __init__(self, name, type, creation, referenced, parent=None):
+        self.name = name
+        self.type = type
+        self.creation = creation
+        self.referenced = referenced
+        self.used = referenced
+        self.refquota = 0
+        self.quota = 0
+        self.parent = parent
+        self.children = []
+        self.snapshots = []
+        self.properties = {}
+
+class SimulatedSnapshot(object):
+
+    def __init__(self, name, dataset, creation, used, referenced, shared=0):
+        self.name = name
+        self.dataset = dataset
+        self.creation = creation
+        self.used = used
+        self.referenced = referenced
+        # Bytes only shared with the next snapshot of the dataset
+        self.shared = shared
+        self.holds = {}
+        self.deferred = False
+
+class SimulatedZfs(cleaner.CommandRunner):
+
+    # In-memory stand-in for the zfs command line, answering the commands
+    # issued by the cleaner from a generated zpool.
+
+    # Instructions and memory charged per snapshot of a channel program
+    programInstructions = 100
+    programMemory = 1024
+
+    def __init__(self, pool="tank", datasets=100, snapshots=10000, holds=0.1, quotas=0.1, volumes=0.05, capacity=0.9, days=365, seed=0, now=None, channelPrograms=True):
+        cleaner.CommandRunner.__init__(self)
+        self.commandLock = Lock()
+        self.pool = pool
+        self.channelPrograms = channelPrograms
+        self.programs = []
+        # Snapshots channel programs fail to destroy, as busy
+        self.programFailures = set()
+        self.now = now or int(time.time())
+        self.datasets = {}
+        self.snapshots = {}
+        self.random = random.Random(seed)
+        self.generate(datasets, snapshots, holds, quotas, volumes, days)
+        self.size = int(self.datasets[pool].used / capacity)
+
+    def generate(self, datasets, snapshots, holds, quotas, volumes, days):
+        root = SimulatedDataset(self.pool, "filesystem", self.now - (days + 1) * 86400, self.random.randint(1, 1 << 20))
+        self.datasets[root.name] = root
+        filesystems = [root]
+        for i in range(1, datasets):
+            parent = self.random.choice(filesystems)
+            type = "volume" if self.random.random() < volumes else "filesystem"
+            dataset = SimulatedDataset("%s/ds%d" % (parent.name, i), type, root.creation + i, self.random.randint(1 << 20, 1 << 30), parent)
+            parent.children.append(dataset)
+            self.datasets[dataset.name] = dataset
+            if type == "filesystem":
+                filesystems.append(dataset)
+
+        ordered = sorted(self.datasets.values(), key=lambda d: d.name)
+        for index, dataset in enumerate(ordered):
+            count = snapshots // len(ordered) + (1 if index < snapshots % len(ordered) else 0)
+            if count == 0:
+                continue
+            interval = days * 86400 // count
+            for i in range(count):
+                creation = self.now - (count - i) * interval
+                name = "%s@auto-%s-%d" % (dataset.name, datetime.fromtimestamp(creation).strftime("%Y%m%d-%H%M"), i)
+                shared = self.random.randint(0, dataset.referenced // 256) if i < count - 1 else 0
+                snapshot = SimulatedSnapshot(name, dataset, creation, self.random.randint(0, dataset.referenced // 256), self.random.randint(0, dataset.referenced), shared)
+                if self.random.random() < holds:
+                    snapshot.holds[self.random.choice(["keep", "backup"])] = creation
+                dataset.snapshots.append(snapshot)
+                self.snapshots[name] = snapshot
+                dataset.used += snapshot.used + snapshot.shared
+
+        # Propagate used space to ancestors, deepest datasets first
+        for dataset in sorted(ordered, key=lambda d: -d.name.count('/')):
+            if dataset.parent:
+                dataset.parent.used += dataset.used
+            if dataset.type == "filesystem" and dataset.parent and self.random.random() < quotas:
+                dataset.refquota = int(dataset.used * (1 + self.random.random()))
+
+    def getAvailable(self, dataset):
+        available = self.size - self.datasets[self.pool].used
+        if dataset.refquota:
+            available = min(available, dataset.refquota - dataset.used)
+        return max(available, 0)
+
+    def getProperty(self, object, property):
+        if property == "guid":
+            # Stable across runs of the same simulation
+            return str(int(md5(object.name).hexdigest()[:16], 16))
+        if ':' in property:
+            # User properties are inherited, snapshots show the dataset's
+            dataset = object.dataset if isinstance(object, SimulatedSnapshot) else object
+            while dataset and property not in dataset.properties:
+                dataset = dataset.parent
+            return dataset.properties[property] if dataset else "-"
+        if isinstance(object, SimulatedSnapshot):
+            if property == "type":
+                return "snapshot"
+            elif property == "userrefs":
+                return str(len(object.holds))
+            elif property in ("available", "quota", "refquota", "mountpoint"):
+                return "-"
+        elif property == "available":
+            return str(self.getAvailable(object))
+        elif property == "userrefs":
+            return "-"
+        elif property == "mountpoint":
+            return "/" + object.name
+        return str(getattr(object, property))
+
+    def iterate(self, dataset, depth=None):
+        yield dataset
+        if depth == 0 or isinstance(dataset, SimulatedSnapshot):
+            return
+        for snapshot in dataset.snapshots:
+            yield snapshot
+        for child in sorted(dataset.children, key=lambda d: d.name):
+            for object in self.iterate(child, None if depth == None else depth - 1):
+                yield object
+
+    def getObject(self, name, cmd):
+        try:
+            if '@' in name:
+                return self.snapshots[name]
+            return self.datasets[name]
+        except KeyError:
+            raise CalledProcessError(1, cmd, "cannot open '%s': dataset does not exist\n" % name)
+
+    def zfsGet(self, cmd):
+        opts, args = getopt.getopt(cmd[2:], "rHpo:t:d:s:")
+        opts = dict(opts)
+        properties = args[0].split(",")
+        lines = []
+        for name in args[1:]:
+            if "-r" in opts:
+                objects = self.iterate(self.getObject(name, cmd))
+            else:
+                objects = [self.getObject(name, cmd)]
+            for object in objects:
+                for property in properties:
+                    value = self.getProperty(object, property)
+                    if opts.get("-o") == "value":
+                        lines.append(value)
+                    else:
+                        lines.append("%s\t%s\t%s\t-" % (object.name, property, value))
+        return "".join([line + "\n" for line in lines])
+
+    def listLines(self, cmd):
+        opts, args = getopt.getopt(cmd[2:], "rHpo:t:d:s:S:")
+        opts = dict(opts)
+        properties = opts.get("-o", "name,used,available,referenced,mountpoint").split(",")
+        types = opts.get("-t", "filesystem,volume").replace("all", "filesystem,volume,snapshot").split(",")
+        # As zfs, missing datasets fail the command once the others are listed
+        error = None
+        for name in args or [self.pool]:
+            try:
+                object = self.getObject(name, cmd)
+            except CalledProcessError as e:
+                error = e
+                continue
+            if "-r" in opts:
+                objects = self.iterate(object)
+            elif "-d" in opts:
+                objects = self.iterate(object, int(opts["-d"]))
+            else:
+                objects = [object]
+            for object in objects:
+                if self.getProperty(object, "type") in types:
+                    yield "\t".join([self.getProperty(object, property) for property in properties]) + "\n"
+        if error != None:
+            raise error
+
+    def zfsList(self, cmd):
+        return "".join(self.listLines(cmd))
+
+    def zfsHolds(self, cmd):
+        lines = []
+        for name in [arg for arg in cmd[2:] if not arg.startswith("-")]:
+            snapshot = self.getObject(name, cmd)
+            for tag, timestamp in sorted(snapshot.holds.items()):
+                lines.append("%s\t%s\t%s\n" % (snapshot.name, tag, datetime.fromtimestamp(timestamp).strftime("%a %b %d %H:%M %Y")))
+        return "".join(lines)
+
+    def zfsHold(self, cmd):
+        tag = cmd[2]
+        snapshots = [self.getObject(name, cmd) for name in cmd[3:]]
+        for snapshot in snapshots:
+            if tag in snapshot.holds:
+                raise CalledProcessError(1, cmd, "cannot hold snapshot '%s': tag already exists on this dataset\n" % snapshot.name)
+        for snapshot in snapshots:
+            snapshot.holds[tag] = self.now
+        return ""
+
+    def zfsRelease(self, cmd):
+        tag = cmd[2]
+        snapshots = [self.getObject(name, cmd) for name in cmd[3:]]
+        for snapshot in snapshots:
+            if tag not in snapshot.holds:
+                raise CalledProcessError(1, cmd, "cannot release hold from snapshot '%s': no such tag on this dataset\n" % snapshot.name)
+        for snapshot in snapshots:
+            del snapshot.holds[tag]
+            if snapshot.deferred and not snapshot.holds:
+                self.destroy(snapshot)
+        return ""
+
+    def zfsDestroy(self, cmd):
+        # fs@snap, fs@a,b,c and fs@a%b ranges, all or nothing; -n estimates
+        # the space reclaimed, blocks shared by two neighbouring snapshots
+        # being only freed with both of them
+        opts, args = getopt.getopt(cmd[2:], "dnvpr")
+        opts = dict(opts)
+        if len(args) != 1 or '@' not in args[0]:
+            raise CalledProcessError(1, cmd, "cannot destroy '%s': operation not supported by the simulated zpool\n" % cmd[-1])
+        name, items = args[0].split('@', 1)
+        dataset = self.getObject(name, cmd)
+        snapshots = []
+        for item in items.split(','):
+            if '%' in item:
+                names = [snapshot.name.split('@', 1)[1] for snapshot in dataset.snapshots]
+                first, last = item.split('%', 1)
+                try:
+                    start = names.index(first) if first else 0
+                    end = names.index(last) if last else len(names) - 1
+                except ValueError:
+                    raise CalledProcessError(1, cmd, "could not find any snapshots to destroy; check snapshot names.\n")
+                snapshots.extend(dataset.snapshots[start:end + 1])
+            else:
+                snapshots.append(self.getObject("%s@%s" % (name, item), cmd))
+        if "-n" in opts:
+            doomed = set(snapshots)
+            reclaim = 0
+            lines = []
+            for index, snapshot in enumerate(dataset.snapshots):
+                if snapshot in doomed:
+                    lines.append("destroy\t%s\n" % snapshot.name)
+                    reclaim += snapshot.used
+                    if index + 1 < len(dataset.snapshots) and dataset.snapshots[index + 1] in doomed:
+                        reclaim += snapshot.shared
+            return "".join(lines) + "reclaim\t%d\n" % reclaim if "-v" in opts or "-p" in opts else ""
+        for snapshot in snapshots:
+            if snapshot.holds:
+                # zfs destroy -d defers the destruction of held snapshots
+                snapshot.deferred = True
+            elif snapshot.name in self.snapshots:
+                self.destroy(snapshot)
+        return ""
+
+    def zfsProgram(self, cmd):
+        # Record the channel program and run the snapshot destroy programs
+        # generated by the cleaner, the snapshot table being read back from
+        # the script
+        if not self.channelPrograms:
+            raise CalledProcessError(2, cmd, "unrecognized command 'program'\n")
+        opts, args = getopt.getopt(cmd[2:], "jnt:m:")
+        opts = dict(opts)
+        pool, path = args[:2]
+        script = open(path).read()
+        self.programs.append({"pool": pool, "options": opts, "script": script, "arguments": args[2:]})
+        names = re.findall('^    "(.*)",$', script, re.MULTILINE)
+        if len(names) * self.programInstructions > int(opts.get("-t", 10000000)):
+            raise CalledProcessError(1, cmd, "Channel program execution failed:\nChannel program timed out.\n")
+        if len(names) * self.programMemory > int(opts.get("-m", 10485760)):
+            raise CalledProcessError(1, cmd, "Channel program execution failed:\nMemory limit exhausted.\n")
+        failed = {}
+        for name in names:
+            snapshot = self.snapshots.get(name)
+            if snapshot == None or "-n" in opts:
+                continue
+            if name in self.programFailures:
+                failed[name] = errno.EBUSY
+                continue
+            if snapshot.holds:
+                snapshot.deferred = True
+            else:
+                self.destroy(snapshot)
+        return json.dumps({"return": failed}) + "\n"
+
+    def destroy(self, snapshot):
+        # The blocks shared with a neighbour become unique to that neighbour
+        siblings = snapshot.dataset.snapshots
+        index = siblings.index(snapshot)
+        if index > 0:
+            siblings[index - 1].used += siblings[index - 1].shared
+            siblings[index - 1].shared = 0
+        if index + 1 < len(siblings):
+            siblings[index + 1].used += snapshot.shared
+        siblings.pop(index)
+        del self.snapshots[snapshot.name]
+        dataset = snapshot.dataset
+        while dataset:
+            dataset.used -= snapshot.used
+            dataset = dataset.parent
+
+    def zpoolGet(self, cmd):
+        # Only freeing is simulated, frees are synchronous
+        opts, args = getopt.getopt(cmd[2:], "Hpo:")
+        if args[0] != "freeing" or args[1] != self.pool:
+            raise CalledProcessError(1, cmd, "bad property list or zpool\n")
+        return "0\n"
+
+    def run(self, cmd, **kwargs):
+        # Commands are applied one at a time, as zfs would
+        with self.commandLock:
+            return self.runCommand(cmd, **kwargs)
+
+    def runCommand(self, cmd, **kwargs):
+        name = cmd[0].rsplit('/', 1)[-1]
+        if name == "zfs":
+            try:
+                return getattr(self, "zfs" + cmd[1].capitalize())(cmd)
+            except AttributeError:
+                raise CalledProcessError(2, cmd, "unrecognized command '%s'\n" % cmd[1])
+        elif name == "zpool" and cmd[1] == "get":
+            return self.zpoolGet(cmd)
+        raise CalledProcessError(127, cmd, "%s: command not found\n" % name)
+
+    def runStream(self, cmd):
+        if cmd[0].rsplit('/', 1)[-1] == "zfs" and cmd[1] == "list":
+            return self.listLines(cmd)
+        return iter(self.run(cmd).splitlines(True))
+
+def getConfig(pool, bestEffortPolicy, retentionPolicy, maxRetention):
+    return cleaner.readConfig(StringIO('<zpool name="%s" maxCapacity="0.8" bestEffortPolicy="%s"><dataset name="%s" retentionPolicy="%s" maxRetention="%s" /></zpool>' % (pool, bestEffortPolicy, pool, retentionPolicy, maxRetention))).next()
+
+def getUserPropertiesConfig(pool, bestEffortPolicy):
+    return cleaner.readConfig(StringIO('<zpool name="%s" maxCapacity="0.8" bestEffortPolicy="%s" userProperties="yes" />' % (pool, bestEffortPolicy))).next()
+
+class Benchmark(object):
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.results = []
+
+    def phase(self, name, function, *args):
+        self.runner.resetCalls()
+        start = time.time()
+        result = function(*args)
+        self.results.append((name, time.time() - start, self.runner.resetCalls()))
+        return result
+
+    def report(self):
+        print "%-16s %10s %8s  %s" % ("phase", "seconds", "calls", "calls by command")
+        for name, seconds, calls in self.results:
+            detail = ", ".join(["%s=%d" % (command, count) for command, count in sorted(calls.items())])
+            print "%-16s %10.3f %8d  %s" % (name, seconds, sum(calls.values()), detail)
+
+def evaluatePolicies(zpool):
+    for dataset in zpool.datasets:
+        for snapshot in dataset.snapshots:
+            snapshot.keep
+
+def usage():
+    print __doc__
+
+def main(argv):
+
+    try:
+        opts, args = getopt.getopt(argv, "hfpvun:s:", ["help", "force", "channel-programs", "verbose", "userProperties", "datasets=", "snapshots=", "holds=", "quotas=", "volumes=", "capacity=", "days=", "seed=", "now=", "bestEffortPolicy=", "retentionPolicy=", "maxRetention=", "decisionCache="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    dryrun = True
+    channelPrograms = False
+    userProperties = False
+    decisionCache = None
+    level = logging.WARNING
+    simulation = {}
+    bestEffortPolicy = "morerem"
+    retentionPolicy = "7 days and 4 sundays and 6 1st day of the month and 12 1st monday of the month"
+    maxRetention = "26 weeks"
+
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ("-f", "--force"):
+            dryrun = False
+        elif opt in ("-p", "--channel-programs"):
+            channelPrograms = True
+        elif opt in ("-v", "--verbose"):
+            level = logging.INFO
+        elif opt in ("-u", "--userProperties"):
+            userProperties = True
+        elif opt in ("-n", "--datasets"):
+            simulation["datasets"] = int(arg)
+        elif opt in ("-s", "--snapshots"):
+            simulation["snapshots"] = int(arg)
+        elif opt in ("--days", "--seed", "--now"):
+            simulation[opt[2:]] = int(arg)
+        elif opt in ("--holds", "--quotas", "--volumes", "--capacity"):
+            simulation[opt[2:]] = float(arg)
+        elif opt == "--bestEffortPolicy":
+            bestEffortPolicy = arg
+        elif opt == "--retentionPolicy":
+            retentionPolicy = arg
+        elif opt == "--maxRetention":
+            maxRetention = arg
+        elif opt == "--decisionCache":
+            decisionCache = arg
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=level)
+
+    start = time.time()
+    runner = SimulatedZfs(**simulation)
+    print "Simulated zpool '%s': %d datasets, %d snapshots, generated in %.3fs" % (runner.pool, len(runner.datasets), len(runner.snapshots), time.time() - start)
+    print
+
+    if userProperties:
+        root = runner.datasets[runner.pool]
+        root.properties["cleaner:retention"] = retentionPolicy
+        root.properties["cleaner:maxretention"] = maxRetention
+        config = getUserPropertiesConfig(runner.pool, bestEffortPolicy)
+    else:
+        config = getConfig(runner.pool, bestEffortPolicy, retentionPolicy, maxRetention)
+    if decisionCache != None:
+        config[0]["decisionCache"] = decisionCache
+
+    benchmark = Benchmark(runner)
+    zpool = benchmark.phase("load", cleaner.loadZpool, config, dryrun, runner)
+    benchmark.phase("policy", evaluatePolicies, zpool)
+    if channelPrograms:
+        zpool.channelProgram = cleaner.ChannelProgram(zpool)
+    benchmark.phase("maxRetention", zpool.destroySnapshotsOutOfMaxRetention)
+    benchmark.phase("bestEffort", zpool.destroySnapshotsWhileOverMaxCapacity)
+    benchmark.phase("report", zpool.logSummary)
+    benchmark.report()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
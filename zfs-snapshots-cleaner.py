@@ -8,81 +8,569 @@ Options:
     -h, --help      show this help
     -d, --dry-run   don't actually commit changes
     -f, --force     commit changes
+    -l, --list      list snapshots and whether they must be destroyed
+    -p, --channel-programs
+                    destroy snapshots with zfs channel programs, one transaction per batch
+    -j, --jobs N    process up to N zpools concurrently, each in its own process (default 1)
+    --max-commands N
+                    run at most N zfs commands at once over all zpools, besides the maxCommands of each zpool
+    --max-writes N  run at most N zfs commands changing zpools at once over all zpools, besides the maxWrites of
+                    each zpool
+    --plan FILE     dry run writing what a forced run would do to FILE
+    --report FILE   write the status of every snapshot and the space used by status for each dataset to FILE,
+                    as CSV if FILE ends with .csv, JSON lines otherwise, - for stdout, without placing or
+                    releasing holds
+    --apply FILE    perform the plan in FILE instead of reading the configuration, with -f
+    --daemon        keep running, polling the zpools space and cleaning them on schedule or over maxCapacity,
+                    SIGHUP reloads the configuration
+    --metrics FILE  write the time spent by phase and dataset, the commands run and the space reclaimed by policy
+                    to FILE after each run, as JSON if FILE ends with .json, for the node_exporter textfile
+                    collector otherwise
+    --profile       print a cProfile profile of each phase
+    --record FILE   write the options, the configuration and the commands run with their output, exit status and
+                    latency to FILE, gzip compressed
+    --replay FILE   answer the commands from FILE instead of running them, with the options and configuration
+                    of the recorded run, the options given here coming after them, files are not swept
+    --replay-latencies
+                    wait the recorded latency of each command when replaying
     -c, --conffile  specify an alternate configuration file (default /usr/local/etc/zfs-snapshots-cleaner.conf)
 """
 
-import sys, getopt, re
-import logging
-from xml.dom.minidom import parse
-from subprocess import Popen, PIPE, check_output
+import sys, getopt, re, os, json, csv, tempfile, time
+import logging, sqlite3, signal, cProfile, pstats, gzip
+from bisect import bisect_left, bisect_right
+from array import array
+from collections import deque
+from heapq import heapify, heappop, heapreplace
+from shutil import copyfileobj, rmtree
+from hashlib import md5
+from threading import Lock, BoundedSemaphore, Event, Timer, local, current_thread
+from contextlib import contextmanager
+from multiprocessing import Pool, TimeoutError, BoundedSemaphore as ProcessSemaphore
+from multiprocessing.pool import ThreadPool
+from stat import S_ISDIR, S_ISREG, S_ISLNK
+from xml.etree.cElementTree import iterparse
+from subprocess import Popen, PIPE, STDOUT, CalledProcessError
 from datetime import datetime, timedelta, date
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+class CommandTimeout(CalledProcessError):
+
+    def __init__(self, timeout, cmd, output=None):
+        CalledProcessError.__init__(self, -signal.SIGKILL, cmd, output)
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Command '%s' timed out after %s seconds" % (self.cmd, self.timeout)
+
+class CommandCancelled(CalledProcessError):
+
+    def __str__(self):
+        return "Command '%s' cancelled on shutdown" % (self.cmd, )
+
+class CommandRunner(object):
+
+    # Every zfs and zpool command goes through a runner, as an argument list,
+    # so that calls can be counted and the backend swapped for a simulated
+    # one.
+    # Commands are killed after timeout seconds and retried with backoff
+    # while zfs reports a busy dataset. At most maxCommands run at once per
+    # runner, of which maxWrites changing the zpool, each zpool having its
+    # own runner. sharedCommands and sharedWrites, when set, limit the
+    # commands of all the zpools together, worker processes included.
+    # Writes wait for their own slot before taking a command slot, so that
+    # queries are not queued behind writers waiting on long destroys, and
+    # the zpool slots are taken before the shared ones. shutdown() kills the
+    # running commands and cancels the next ones. Commands are traced to the
+    # recorder when there is one, to be replayed by a ReplayRunner.
+
+    timeout = 3600
+    retries = 3
+    backoff = 1.0
+    maxCommands = 16
+    maxWrites = 2
+    sharedCommands = None
+    sharedWrites = None
+
+    processes = set()
+    stopping = Event()
+
+    # Upper bounds in seconds of the command duration histograms
+    buckets = [0.01, 0.1, 1, 10, 60, 600]
+
+    recorder = None
+
+    # Whether the files of the zpool filesystems can be swept
+    localFiles = True
+
+    def __init__(self):
+        self.calls = {}
+        self.durations = {}
+        self.lock = Lock()
+        self.commands = BoundedSemaphore(self.maxCommands)
+        self.writes = BoundedSemaphore(self.maxWrites)
+
+    @classmethod
+    def shutdown(cls):
+        cls.stopping.set()
+        for process in list(cls.processes):
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+    @classmethod
+    def setSharedLimits(cls, commands=None, writes=None):
+        # Limits over the runners of every zpool, to be set before worker
+        # processes are forked
+        cls.sharedCommands = cls.sharedWrites = None
+        if commands != None:
+            cls.sharedCommands = ProcessSemaphore(commands)
+        if writes != None:
+            cls.sharedWrites = ProcessSemaphore(writes)
+
+    def setMaxCommands(self, value):
+        self.maxCommands = value
+        self.commands = BoundedSemaphore(value)
+
+    def setMaxWrites(self, value):
+        self.maxWrites = value
+        self.writes = BoundedSemaphore(value)
+
+    def getCommandName(self, cmd):
+        name = cmd[0].rsplit('/', 1)[-1]
+        if name in ("zfs", "zpool") and len(cmd) > 1:
+            name = "%s %s" % (name, cmd[1])
+        return name
+
+    def isWrite(self, cmd):
+        # Commands changing the zpool, unless given -n
+        if self.getCommandName(cmd) not in ("zfs destroy", "zfs hold", "zfs release", "zfs program"):
+            return False
+        return not [arg for arg in cmd[2:] if re.match('^-[a-zA-Z]*n', arg)]
+
+    def getKey(self, cmd):
+        # cmd as traced, temporary channel program scripts being named by
+        # their content
+        key = list(cmd)
+        if self.getCommandName(cmd) == "zfs program":
+            script = open(cmd[-1])
+            try:
+                key[-1] = "md5:%s" % (md5(script.read()).hexdigest())
+            finally:
+                script.close()
+        return key
+
+    @contextmanager
+    def slots(self, cmd):
+        # Hold the command slots cmd needs while it runs
+        semaphores = [self.commands, self.sharedCommands]
+        if self.isWrite(cmd):
+            semaphores = [self.writes, self.sharedWrites] + semaphores
+        acquired = []
+        try:
+            for semaphore in semaphores:
+                if semaphore != None:
+                    semaphore.acquire()
+                    acquired.append(semaphore)
+            yield
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+
+    def isBusy(self, error):
+        return "busy" in (error.output or "")
+
+    def resetCalls(self):
+        calls = self.calls
+        self.calls = {}
+        return calls
+
+    def start(self, cmd, **kwargs):
+        # Popen registered for shutdown and killed past the timeout, along
+        # with the timer and a flag set when it fired
+        if self.stopping.is_set():
+            raise CommandCancelled(-1, cmd)
+        process = Popen(cmd, **kwargs)
+        self.processes.add(process)
+        expired = []
+        def expire():
+            expired.append(True)
+            try:
+                process.kill()
+            except OSError:
+                pass
+        timer = Timer(self.timeout, expire)
+        timer.daemon = True
+        timer.start()
+        return process, timer, expired
+
+    def finish(self, cmd, process, timer, expired, output):
+        timer.cancel()
+        self.processes.discard(process)
+        if expired:
+            raise CommandTimeout(self.timeout, cmd, output)
+        if process.returncode and self.stopping.is_set():
+            raise CommandCancelled(process.returncode, cmd, output)
+        if process.returncode:
+            raise CalledProcessError(process.returncode, cmd, output)
+
+    def run(self, cmd, **kwargs):
+        # check_output, stderr being kept to tell busy datasets apart
+        merged = kwargs.pop("stderr", None) == STDOUT
+        process, timer, expired = self.start(cmd, stdout=PIPE, stderr=STDOUT if merged else PIPE, **kwargs)
+        try:
+            output, errors = process.communicate()
+        finally:
+            timer.cancel()
+        try:
+            self.finish(cmd, process, timer, expired, output if merged else output + errors)
+        except CalledProcessError as e:
+            e.errors = errors
+            raise
+        return output
+
+    def countCall(self, cmd):
+        name = self.getCommandName(cmd)
+        with self.lock:
+            try:
+                self.calls[name] += 1
+            except KeyError:
+                self.calls[name] = 1
+
+    def countDuration(self, cmd, seconds):
+        # [count, sum, count by bucket] of the durations of a command, failed
+        # attempts included
+        name = self.getCommandName(cmd)
+        with self.lock:
+            if name not in self.durations:
+                self.durations[name] = [0, 0.0, [0] * len(self.buckets)]
+            duration = self.durations[name]
+            duration[0] += 1
+            duration[1] += seconds
+            index = bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                duration[2][index] += 1
+
+    def record(self, cmd, seconds, output, error=None):
+        # Trace the outcome of cmd when recording, commands cancelled on
+        # shutdown left out
+        if self.recorder == None or isinstance(error, CommandCancelled):
+            return
+        record = {"cmd": self.getKey(cmd), "seconds": seconds, "output": output, "status": 0}
+        if error != None:
+            record["status"] = error.returncode
+            record["errors"] = getattr(error, "errors", None)
+            if isinstance(error, CommandTimeout):
+                record["timeout"] = error.timeout
+        self.recorder.write(record)
+
+    def runTimed(self, cmd, **kwargs):
+        start = time.time()
+        output = error = None
+        try:
+            output = self.run(cmd, **kwargs)
+            return output
+        except CalledProcessError as e:
+            output, error = e.output, e
+            raise
+        finally:
+            seconds = time.time() - start
+            self.countDuration(cmd, seconds)
+            self.record(cmd, seconds, output, error)
+
+    def check_output(self, cmd, **kwargs):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            self.countCall(cmd)
+            try:
+                with self.slots(cmd):
+                    return self.runTimed(cmd, **kwargs)
+            except CalledProcessError as e:
+                if attempt == self.retries or isinstance(e, (CommandTimeout, CommandCancelled)) or not self.isBusy(e):
+                    # Passed on as zfs would have written it
+                    if getattr(e, "errors", None):
+                        sys.stderr.write(e.errors)
+                    raise
+            logging.warning("%s: busy, retrying in %s seconds" % (" ".join(cmd), delay))
+            if self.stopping.wait(delay):
+                raise CommandCancelled(-1, cmd)
+            delay *= 2
+
+    def runStream(self, cmd):
+        process, timer, expired = self.start(cmd, stdout=PIPE)
+        try:
+            for line in process.stdout:
+                yield line
+            process.stdout.close()
+            process.wait()
+        finally:
+            timer.cancel()
+            if process.returncode == None:
+                process.kill()
+                process.wait()
+        self.finish(cmd, process, timer, expired, None)
+
+    def stream(self, cmd):
+        # Iterate over the output lines of cmd as they are produced
+        self.countCall(cmd)
+        with self.slots(cmd):
+            start = time.time()
+            lines = [] if self.recorder != None else None
+            error = None
+            try:
+                for line in self.runStream(cmd):
+                    if lines != None:
+                        lines.append(line)
+                    yield line
+            except CalledProcessError as e:
+                error = e
+                raise
+            finally:
+                seconds = time.time() - start
+                self.countDuration(cmd, seconds)
+                if lines != None:
+                    self.record(cmd, seconds, "".join(lines), error)
+
+    def getToday(self, zpool):
+        return datetime.today()
+
+    def today(self, zpool):
+        # Time zpool is loaded at, recorded to be replayed
+        now = self.getToday(zpool)
+        if self.recorder != None:
+            self.recorder.write({"zpool": zpool, "today": now.strftime("%Y-%m-%d %H:%M:%S.%f")})
+        return now
+
+class ReplayRunner(CommandRunner):
+
+    # Answers the commands from the trace of a recorded run instead of
+    # running them, sleeping the recorded latencies when latencies is set.
+    # Commands missing from the trace fail as not found. Files are not
+    # traced, file cleanups are skipped.
+
+    replay = None
+    latencies = False
+    localFiles = False
+
+    def getToday(self, zpool):
+        today = self.replay.next(self.replay.times, zpool)
+        if today == None:
+            return datetime.today()
+        return datetime.strptime(today, "%Y-%m-%d %H:%M:%S.%f")
+
+    def getRecord(self, cmd):
+        if self.stopping.is_set():
+            raise CommandCancelled(-1, cmd)
+        record = self.replay.next(self.replay.records, self.replay.getKey(self.getKey(cmd)))
+        if record == None:
+            error = CalledProcessError(127, cmd, "%s: not in trace\n" % (" ".join(cmd)))
+            error.errors = error.output
+            raise error
+        if self.latencies and self.stopping.wait(record["seconds"]):
+            raise CommandCancelled(-1, cmd)
+        return record
+
+    def check(self, cmd, record, output):
+        # Raise the recorded failure of cmd
+        if "timeout" in record:
+            raise CommandTimeout(record["timeout"], cmd, output)
+        if record["status"]:
+            error = CalledProcessError(record["status"], cmd, output)
+            error.errors = record.get("errors")
+            raise error
+
+    def run(self, cmd, **kwargs):
+        record = self.getRecord(cmd)
+        self.check(cmd, record, record["output"])
+        return record["output"]
+
+    def runStream(self, cmd):
+        record = self.getRecord(cmd)
+        for line in (record["output"] or "").splitlines(True):
+            yield line
+        self.check(cmd, record, None)
+
+def getRunner():
+    # Runner of a zpool, answering from the trace being replayed if any
+    if ReplayRunner.replay != None:
+        return ReplayRunner()
+    return CommandRunner()
 
 class Zpool(object):
 
-    def __init__(self, name, dryrun=True):
+    def __init__(self, name, dryrun=True, runner=None, scope=None, userProperties=False, decisionCache=None):
         self.name = name
         self.dryrun = dryrun
+        self.runner = runner or getRunner()
         self.maxCapacity = 0.8
         self.bestEffortPolicy = "morerem"
-        self.__used = int(check_output(["/sbin/zfs", "get", "-H", "-p", "-o", "value", "used", self.name])) 
-        self.__available = int(check_output(["/sbin/zfs", "get", "-H", "-p", "-o", "value", "available", self.name]))
-        self.datasets = set()
+        self.now = self.runner.today(name)
+        self.pendingHolds = {"hold": [], "release": []}
+        self.channelProgram = None
+        self.plan = None
+        self.sweepWorkers = 4
+        self.indexDirectory = None
+        self.datasetWorkers = 4
+        self.userProperties = userProperties
+        self.keepHolds = True
+        self.reclaimRatios = {}
+        self.decisionCache = None
+        if decisionCache != None:
+            self.decisionCache = DecisionCache(decisionCache, self.now)
+        self.capacityTracker = CapacityTracker(self)
+        self.datasets = []
+        self.__datasets = {}
+        self.roots = [self.name]
+        self.scoped = False
+        self.metrics = Metrics(self)
         logging.info("Getting datasets information for zpool %s, this may take a while..." % (self.name))
-        for line in check_output(["/sbin/zfs", "get", "-rHp", "type,creation,used,available,referenced,userrefs", self.name]).split("\n"):
-            if line != "":
-                name = line.split()[0]
-                property = line.split()[1]
-                value = line.split()[2]
-                if property == "type":
-                    if value == "filesystem":
-                        dataset = Filesystem(name, self, self.dryrun)
-                        self.datasets.add(dataset)
-                    elif value == "volume":
-                        dataset = Volume(name, self, self.dryrun)
-                        self.datasets.add(dataset)
-                    elif value == "snapshot":
-                        if isinstance(dataset, Snapshot):
-                            parent = dataset.dataset
-                        else:
-                            parent = dataset
-                        dataset = Snapshot(name, parent, self.dryrun)
-                        parent.snapshots.append(dataset)
-                elif property == "creation":
-                    dataset.creation = datetime.fromtimestamp(int(value))
-                elif property == "used":
-                    dataset.used = int(value)
-                elif property == "available":
-                    try:
-                        dataset.available = int(value)
-                    except:
-                        pass
-                elif property == "referenced":
-                    dataset.referenced = int(value)
-                elif property == "userrefs":
-                    try:
-                        dataset.userrefs = int(value)
-                    except:
-                        pass
+        with self.metrics.phase("load"):
+            if scope == None:
+                self.loadDatasets([self.name])
+            else:
+                self.loadScope(scope)
+            root = self.getDataset(self.name)
+            self.capacityTracker.update(root.used, root.available, self.capacityTracker.getFreeing())
+
+    # Policies read from user properties, applied in this order
+    policyProperties = [("cleaner:maxretention", "maxRetention"), ("cleaner:retention", "retentionPolicy")]
+
+    def loadDatasets(self, names, recursive=True, snapshots=False):
+        # Add the datasets listed by zfs list, with their descendants and
+        # snapshots when recursive. Otherwise snapshots only adds the own
+        # snapshots of datasets already loaded.
+        if recursive:
+            cmd = ["/sbin/zfs", "list", "-rHp", "-t", "filesystem,volume,snapshot"]
+        elif snapshots:
+            cmd = ["/sbin/zfs", "list", "-Hp", "-d", "1", "-t", "snapshot"]
+        else:
+            cmd = ["/sbin/zfs", "list", "-Hp", "-t", "filesystem,volume"]
+        properties = "name,type,creation,used,available,referenced,userrefs,guid"
+        if self.userProperties:
+            properties += "".join(["," + property for property, attribute in self.policyProperties])
+        for line in self.runner.stream(cmd + ["-o", properties] + names):
+            values = line.rstrip("\n").split("\t")
+            name, type, creation, used, available, referenced, userrefs, guid = values[:8]
+            if type == "snapshot":
+                name, shortname = name.split('@', 1)
+                self.__datasets[name].addSnapshot(shortname, int(creation), int(used), int(userrefs), int(guid))
+                continue
+            elif name in self.__datasets:
+                continue
+            elif type == "filesystem":
+                object = Filesystem(name, self, self.dryrun)
+            elif type == "volume":
+                object = Volume(name, self, self.dryrun)
+            else:
+                continue
+            object.creation = datetime.fromtimestamp(int(creation))
+            object.used = int(used)
+            try:
+                object.available = int(available)
+            except ValueError:
+                pass
+            object.referenced = int(referenced)
+            self.addDataset(object)
+            if self.userProperties:
+                object.setUserProperties(dict(zip([property for property, attribute in self.policyProperties], values[8:])))
+
+    def loadScope(self, names, recursive=True):
+
+        # Only load the subtrees of the given datasets, or the datasets with
+        # their own snapshots when not recursive, and their ancestors without
+        # snapshots for the policies inheritance. Missing datasets are left
+        # out, loadZpool reports them.
+
+        roots = []
+        for name in sorted(set(names)):
+            if not recursive or not [root for root in roots if name.startswith(root + "/")]:
+                roots.append(name)
+        ancestors = set([self.name])
+        for root in roots:
+            parts = root.split("/")
+            for i in range(1, len(parts)):
+                ancestors.add("/".join(parts[:i]))
+        try:
+            self.loadDatasets(sorted(ancestors | set(roots), key=lambda name: name.count("/")), False)
+        except CalledProcessError as e:
+            logging.debug("Some configured datasets are missing: %s" % (e))
+        roots = [root for root in roots if self.getDataset(root) != None]
+        self.roots = roots if recursive else []
+        self.scoped = True
+        if roots:
+            self.loadDatasets(roots, recursive, True)
+        logging.info("%d datasets loaded for %d configured subtrees" % (len(self.datasets), len(roots)))
+
+    def refreshSnapshots(self):
+
+        # Bring the snapshots of the loaded datasets up to date with a single
+        # listing, keeping the classification of the known ones: new
+        # snapshots are added and left to classify, vanished ones dropped,
+        # used space and user references updated. Snapshots destroyed but
+        # still listed, held ones being destroyed once released, stay out. The policies keep the
+        # cutoffs they were loaded with, earlier ones that only keep more.
+        # Datasets created since are left to the next full load, as the
+        # datasets out of the loaded subtrees.
+
+        known = {}
+        views = {}
+        for dataset in self.datasets:
+            known[dataset] = dict([(guid, row) for row, guid in enumerate(dataset.snapshotGuids)])
+            views[dataset] = dict([(snapshot.row, snapshot) for snapshot in dataset.snapshots])
+        listed = set()
+        added = set()
+        if not self.roots:
+            return
+        cmd = ["/sbin/zfs", "list", "-rHp", "-t", "snapshot", "-o", "name,creation,used,userrefs,guid"] + self.roots
+        for line in self.runner.stream(cmd):
+            name, creation, used, userrefs, guid = line.rstrip("\n").split("\t")
+            name, shortname = name.split('@', 1)
+            dataset = self.getDataset(name)
+            if dataset == None:
+                continue
+            row = known[dataset].get(int(guid))
+            if row == None:
+                added.add(dataset.addSnapshot(shortname, int(creation), int(used), int(userrefs), int(guid)))
+                dataset.classified = False
+            elif row in views[dataset]:
+                snapshot = views[dataset][row]
+                snapshot.used = int(used)
+                snapshot.userrefs = int(userrefs)
+                listed.add(snapshot)
+
+        removed = 0
+        for dataset in self.datasets:
+            snapshots = [snapshot for snapshot in dataset.snapshots if snapshot in listed or snapshot in added]
+            removed += len(dataset.snapshots) - len(snapshots)
+            dataset.snapshots = snapshots
+            dataset.removableSnapshots = deque([snapshot for snapshot in dataset.removableSnapshots if snapshot in listed])
+            dataset.snapshotTags = None
+        logging.info("%d snapshots added and %d gone since zpool %s was listed" % (len(added), removed, self.name))
 
     def getUsed(self):
-        if self.dryrun:
-            return self.__used
-        else:
-            return int(check_output(["/sbin/zfs", "get", "-H", "-p", "-o", "value", "used", self.name]))
+        if not self.dryrun:
+            self.capacityTracker.refresh()
+        return self.capacityTracker.used
 
     def setUsed(self, value):
-        self.__used = value
+        self.capacityTracker.used = value
 
     used = property(getUsed, setUsed)
 
     def getAvailable(self):
-        if self.dryrun:
-            return self.__available
-        else:
-            return int(check_output(["/sbin/zfs", "get", "-H", "-p", "-o", "value", "available", self.name]))
+        if not self.dryrun:
+            self.capacityTracker.refresh()
+        return self.capacityTracker.available
 
     def setAvailable(self, value):
-        self.__available = value
+        self.capacityTracker.available = value
 
     available = property(getAvailable, setAvailable)
 
@@ -91,11 +579,12 @@ class Zpool(object):
 
     capacity = property(getCapacity)
 
+    def addDataset(self, dataset):
+        self.datasets.append(dataset)
+        self.__datasets[dataset.name] = dataset
+
     def getDataset(self, name):
-        for dataset in self.datasets:
-            if dataset.name == name:
-                return dataset
-        return None
+        return self.__datasets.get(name)
 
     def getReferenced(self):
         referenced = 0
@@ -105,32 +594,741 @@ class Zpool(object):
 
     referenced = property(getReferenced)
 
+    def classifySnapshots(self):
+        with self.metrics.phase("classify"):
+            for dataset in self.datasets:
+                if not dataset.classified:
+                    dataset.classifySnapshots()
+            if self.decisionCache != None:
+                self.decisionCache.commit(self)
+        with self.metrics.phase("holds"):
+            self.applyHolds()
+
+    def resolvePolicies(self):
+        # Datasets are listed parents first
+        for dataset in self.datasets:
+            dataset.resolvePolicies()
+
+    def loadHolds(self):
+
+        # Fetch the tags of all held snapshots at once, zfs holds accepts
+        # many snapshots but only recurses into same-named ones
+
+        with self.metrics.phase("holds"):
+            snapshots = {}
+            for dataset in self.datasets:
+                dataset.snapshotTags = {}
+                for snapshot in dataset.snapshots:
+                    if snapshot.userrefs > 0:
+                        snapshots[snapshot.name] = snapshot
+            for names in splitArguments(sorted(snapshots)):
+                for line in self.runner.stream(["/sbin/zfs", "holds", "-H"] + names):
+                    if line.strip():
+                        name, tag = line.split("\t")[:2]
+                        snapshot = snapshots[name]
+                        snapshot.dataset.snapshotTags.setdefault(snapshot.row, set()).add(tag)
+
+    def applyHolds(self, action=None, names=None):
+
+        # Place and release the keep holds queued by the classification with
+        # as few commands as possible, a failed command is split until the
+        # faulty snapshots are isolated
+
+        if action == None:
+            for action in ("release", "hold"):
+                if self.plan != None:
+                    self.plan.holds(action, self.pendingHolds[action])
+                for names in splitArguments([snapshot.name for snapshot in self.pendingHolds[action]]):
+                    self.applyHolds(action, names)
+                self.pendingHolds[action] = []
+            return
+
+        cmd = ["/sbin/zfs", action, "keep"] + names
+        if self.dryrun:
+            logging.info(" ".join(cmd))
+            return
+        try:
+            self.runner.check_output(cmd)
+        except CalledProcessError as e:
+            if len(names) > 1:
+                self.applyHolds(action, names[:len(names) // 2])
+                self.applyHolds(action, names[len(names) // 2:])
+            else:
+                logging.error("Could NOT %s keep on snapshot '%s': %s" % (action, names[0], e))
+
+    def listSnapshots(self):
+        for dataset in self.datasets:
+            for snapshot in dataset.snapshots:
+                if snapshot.keep == True:
+                    status = "must NOT be destroyed"
+                elif snapshot.keep == False:
+                    status = "must be destroyed"
+                else:
+                    status = "can be destroyed"
+                print "%s %s" % (snapshot.name, status)
+
+    def writeReport(self, report):
+        # Classify the snapshots in memory, the keep holds left as they are
+        self.keepHolds = False
+        self.classifySnapshots()
+        for dataset in sorted(self.datasets, key=lambda dataset: dataset.name):
+            report.dataset(dataset)
+
+    def clean(self):
+
+        self.classifySnapshots()
+        self.cleanDatasets()
+        self.destroySnapshotsWhileOverMaxCapacity()
+
+    def applyPlan(self, path, offset=0):
+
+        # Perform the plan of the zpool at offset in path instead of cleaning
+        # it. The plan is refused if the zpool capacity moved by more than
+        # Plan.tolerance since, only its datasets are loaded, with their own
+        # snapshots, and the snapshots missing or of another guid are left
+        # alone.
+
+        entries = readPlan(path, offset)
+        header = entries.next()
+        capacity = float(header["used"]) / (header["used"] + header["available"])
+        if abs(self.capacity - capacity) > Plan.tolerance:
+            raise ValueError("capacity moved from %s to %s since the plan was made" % (capacity, self.capacity))
+        self.maxCapacity = header["maxCapacity"]
+        self.bestEffortPolicy = header["bestEffortPolicy"].encode("utf-8")
+        self.sweepWorkers = header["sweepWorkers"]
+        if header["indexDirectory"] != None:
+            self.indexDirectory = header["indexDirectory"].encode("utf-8")
+        self.runner.timeout = header["commandTimeout"]
+        self.runner.setMaxWrites(header["maxWrites"])
+        self.runner.setMaxCommands(header.get("maxCommands", self.runner.maxCommands))
+
+        names = set()
+        for entry in entries:
+            for action in ("hold", "release", "destroy", "sweep", "removable"):
+                if action in entry:
+                    names.add(entry[action].encode("utf-8"))
+        self.loadScope(names, False)
+
+        # Snapshots are only destroyed as planned, never classified
+        for dataset in self.datasets:
+            dataset.classified = True
+            dataset.removableSnapshots = deque()
+
+        removable = []
+        for entry in readPlan(path, offset):
+            if "hold" in entry or "release" in entry:
+                action = "hold" if "hold" in entry else "release"
+                self.pendingHolds[action] = self.getPlannedSnapshots(entry[action], entry["snapshots"])
+                for snapshot in self.pendingHolds[action]:
+                    snapshot.userrefs += 1 if action == "hold" else -1
+                with self.metrics.phase("holds"):
+                    self.applyHolds()
+            elif "removable" in entry:
+                dataset = self.getDataset(entry["removable"].encode("utf-8"))
+                if dataset != None:
+                    removable.append(dataset)
+                    dataset.removableSnapshots = deque(self.getPlannedSnapshots(entry["removable"], entry["snapshots"]))
+            elif "destroy" in entry:
+                # Best effort destroys were only the dry run estimate
+                if entry["bestEffort"]:
+                    continue
+                doomed = self.getPlannedSnapshots(entry["destroy"], entry["snapshots"])
+                if doomed:
+                    dataset = doomed[0].dataset
+                    rows = set([snapshot.row for snapshot in doomed])
+                    dataset.snapshots = [snapshot for snapshot in dataset.snapshots if snapshot.row not in rows]
+                    with self.metrics.phase("maxRetention"):
+                        self.destroySnapshots(doomed)
+            elif "sweep" in entry:
+                dataset = self.getDataset(entry["sweep"].encode("utf-8"))
+                if dataset != None:
+                    with self.metrics.phase("maxFileAge" if entry["attribute"] == "st_ctime" else "maxCapacity"):
+                        dataset.sweep(FileSweeper("/%s" % (dataset.name), entry["cutoff"], str(entry["attribute"]), self.dryrun, self.sweepWorkers))
+            elif "reclaim" in entry:
+                logging.info("The plan expected %d bytes to be reclaimed" % (sum([reclaim for name, reclaim in entry["reclaim"]])))
+
+        # Best effort ties go to the first dataset in the planned order
+        if removable:
+            self.datasets = removable + [dataset for dataset in self.datasets if dataset not in removable]
+            self.destroySnapshotsWhileOverMaxCapacity()
+
+    def getPlannedSnapshots(self, name, rows):
+        # Snapshots of a dataset given as [name, guid] rows by a plan
+        name = name.encode("utf-8")
+        dataset = self.getDataset(name)
+        if dataset == None:
+            logging.warning("Dataset '%s' does NOT exist anymore, its plan is skipped" % (name))
+            return []
+        snapshots = dict([(snapshot.shortname, snapshot) for snapshot in dataset.snapshots])
+        planned = []
+        for shortname, guid in rows:
+            shortname = shortname.encode("utf-8")
+            snapshot = snapshots.get(shortname)
+            if snapshot == None or snapshot.guid != guid:
+                logging.warning("Snapshot '%s@%s' changed since the plan was made, it is left alone" % (name, shortname))
+            else:
+                planned.append(snapshot)
+        return planned
+
+    def getCleanupChains(self):
+
+        # Datasets that can be cleaned concurrently. Files of a filesystem
+        # may belong to a descendant mounted under it: a dataset with file
+        # cleanup is chained after its nearest ancestor having file cleanup,
+        # in listing order.
+
+        chains = []
+        chainOf = {}
+        for dataset in self.datasets:
+            parent = dataset.parent
+            while parent != None and not parent.hasFileCleanup():
+                parent = parent.parent
+            if dataset.hasFileCleanup() and parent != None:
+                chain = chainOf[parent.name]
+                chain.append(dataset)
+            else:
+                chain = [dataset]
+                chains.append(chain)
+            chainOf[dataset.name] = chain
+        return chains
+
+    def cleanDatasets(self):
+
+        # maxRetention, maxFileAge and maxCapacity phases of the datasets, on
+        # datasetWorkers threads. The records logged while cleaning a chain
+        # are held and logged together, an error only ends its chain.
+
+        chains = self.getCleanupChains()
+        if self.datasetWorkers <= 1 or len(chains) <= 1:
+            for chain in chains:
+                self.cleanChain(chain)
+            return
+
+        root = logging.getLogger()
+        buffer = LogBuffer(root.handlers)
+        root.handlers = [buffer]
+        pool = ThreadPool(min(self.datasetWorkers, len(chains)))
+        try:
+            waitFor(pool.map_async(lambda chain: buffer.hold(self.cleanChain, chain), chains, 1))
+        finally:
+            pool.close()
+            pool.join()
+            root.handlers = buffer.handlers
+
+    def cleanChain(self, chain):
+        for dataset in chain:
+            try:
+                self.cleanDataset(dataset)
+            except Exception:
+                logging.exception("Cleanup of dataset '%s' failed" % (dataset.name))
+                break
+
+    def cleanDataset(self, dataset):
+
+        with self.metrics.dataset(dataset):
+            with self.metrics.phase("maxRetention"):
+                self.destroySnapshots(dataset.removeSnapshotsOutOfMaxRetention())
+
+            # Delete files over maxFileAge
+            with self.metrics.phase("maxFileAge"):
+                try:
+                    dataset.deleteFilesOverMaxFileAge()
+                except AttributeError:
+                    pass
+
+            # Delete oldests files while not under maxCapacity
+            with self.metrics.phase("maxCapacity"):
+                try:
+                    dataset.deleteOldestsFilesWhileNotUnderMaxCapacity()
+                except AttributeError:
+                    pass
+
+    def destroySnapshotsOutOfMaxRetention(self):
+        # Destroy snapshots out of max retention
+        doomed = []
+        for dataset in self.datasets:
+            doomed.extend(dataset.removeSnapshotsOutOfMaxRetention())
+        self.destroySnapshots(doomed)
+
+    def destroySnapshots(self, snapshots):
+
+        # Destroy snapshots already removed from their dataset, through a
+        # channel program when enabled, the zfs command line otherwise and
+        # for whatever the channel program could not destroy
+
+        if self.plan != None:
+            self.plan.destroy(snapshots)
+        if self.channelProgram != None and self.channelProgram.available:
+            snapshots = self.channelProgram.destroy(snapshots)
+
+        doomed = {}
+        for snapshot in snapshots:
+            doomed.setdefault(snapshot.dataset, []).append(snapshot)
+        for dataset in self.datasets:
+            if dataset in doomed:
+                dataset.destroySnapshots(doomed[dataset])
+
+    def destroySnapshotsWhileOverMaxCapacity(self):
+
+        self.classifySnapshots()
+        if self.plan != None:
+            self.plan.removable(self.datasets)
+
+        with self.metrics.phase("bestEffort"):
+            # Destroy destroyable snapshot while we are over maxCapacity
+            self.reclaimRatios = {}
+            while True:
+
+                # Estimates lag behind what zfs actually frees, snapshots are
+                # only destroyed on figures read from zfs
+                if not self.dryrun and self.capacityTracker.stale:
+                    self.capacityTracker.resync()
+                if self.capacity <= self.maxCapacity:
+                    break
+
+                logging.info("Zpool capacity: %s (used: %s, available: %s)" % (self.capacity, self.used, self.available))
+
+                if self.destroyRemovableSnapshots() == 0 or self.dryrun:
+                    break
+
+    def getBestEffortKey(self, dataset, removable, picked):
+        # The smallest key goes first, ties to the first dataset in listing order
+        if self.bestEffortPolicy == "oldest":
+            return removable[picked].creation
+        elif self.bestEffortPolicy == "morerem":
+            return picked - len(removable)
+        elif self.bestEffortPolicy == "biggest":
+            return -removable[picked].used
+        elif self.bestEffortPolicy == "more":
+            return picked - len(dataset.snapshots)
+        return 0
+
+    def getBestEffortOrder(self):
+
+        # Removable snapshots in bestEffortPolicy order, left in place. The
+        # datasets are kept in a heap, a pick only changes the key of the
+        # picked dataset.
+
+        queue = []
+        for index, dataset in enumerate(self.datasets):
+            if dataset.removableSnapshots:
+                removable = list(dataset.removableSnapshots)
+                queue.append((self.getBestEffortKey(dataset, removable, 0), index, 0, removable, dataset))
+        heapify(queue)
+
+        while queue:
+            key, index, picked, removable, dataset = queue[0]
+            yield removable[picked]
+            picked += 1
+            if picked < len(removable):
+                heapreplace(queue, (self.getBestEffortKey(dataset, removable, picked), index, picked, removable, dataset))
+            else:
+                heappop(queue)
+
+    def getReclaimPrefix(self, order, needed):
+
+        # Length of the smallest prefix of order reclaiming needed bytes.
+        # Neighbouring snapshots share blocks, so destroying them together
+        # reclaims at least the sum of their used space: order is already a
+        # sufficient prefix as far as used space is concerned. zfs estimates
+        # the reclaim of the first candidates of each dataset once per best
+        # effort phase, the ratio to their used space trims order. Dry runs
+        # destroy nothing and keep order whole.
+
+        if self.dryrun:
+            return len(order)
+        doomed = {}
+        for snapshot in order:
+            if snapshot.dataset not in self.reclaimRatios:
+                doomed.setdefault(snapshot.dataset, []).append(snapshot)
+        for dataset, snapshots in doomed.iteritems():
+            used = sum([snapshot.used for snapshot in snapshots])
+            reclaim = dataset.getReclaim(snapshots)
+            self.reclaimRatios[dataset] = 1.0
+            if reclaim != None and used > 0:
+                self.reclaimRatios[dataset] = float(reclaim) / used
+        reclaim = 0
+        for length, snapshot in enumerate(order, 1):
+            reclaim += snapshot.used * self.reclaimRatios[snapshot.dataset]
+            if reclaim >= needed:
+                logging.debug("%d snapshots reclaim enough space where used space asked for %d" % (length, len(order)))
+                return length
+        return len(order)
+
+    def destroyRemovableSnapshots(self):
+
+        # Destroy the smallest prefix of the bestEffortPolicy order bringing
+        # the zpool under maxCapacity, at once. Candidates are picked on their
+        # used space, then trimmed with zfs reclaim estimates. Returns the
+        # number of snapshots destroyed.
+
+        if not self.dryrun and self.capacityTracker.stale:
+            self.capacityTracker.resync()
+        used = self.used
+        available = self.available
+        needed = used - self.maxCapacity * (used + available)
+        order = []
+        estimate = 0
+
+        for snapshot in self.getBestEffortOrder():
+            if estimate >= needed:
+                break
+            order.append(snapshot)
+            estimate += snapshot.used
+
+        doomed = order[:self.getReclaimPrefix(order, needed)]
+        for snapshot in doomed:
+            snapshot.dataset.removableSnapshots.popleft()
+            snapshot.dataset.snapshots.remove(snapshot)
+
+        self.destroySnapshots(doomed)
+        if not self.dryrun:
+            self.capacityTracker.invalidate()
+
+        return len(doomed)
+
+    def getSummary(self):
+        if not self.dryrun and self.capacityTracker.stale:
+            self.capacityTracker.resync()
+
+        totalSnapshots = 0
+        tags = {}
+        for dataset in self.datasets:
+            for snapshot in dataset.snapshots:
+                totalSnapshots += 1
+                if snapshot.tags:
+                    for tag in snapshot.tags:
+                        try:
+                            tags[tag] += 1
+                        except KeyError:
+                            tags[tag] = 1
+
+        return {"name": self.name, "referenced": self.referenced, "used": self.used, "available": self.available, "snapshots": totalSnapshots, "tags": tags}
+
+    def logSummary(self):
+        logReport([self.getSummary()])
+
+class CapacityTracker(object):
+
+    # Space accounting of a zpool and its datasets. Figures are read for the
+    # whole zpool with a single listing and adjusted in between by the
+    # expected reclaim of each destroyed snapshot, asynchronous frees being
+    # counted as available. Once stale, the best effort loops read them again
+    # before deciding on another destroy; after files have been deleted they
+    # are read again on next access.
+
+    def __init__(self, zpool):
+        self.zpool = zpool
+        self.used = None
+        self.available = None
+        self.freeing = 0
+        self.synced = False
+        self.stale = False
+        self.lock = Lock()
+
+    def update(self, used, available, freeing=0):
+        self.used = used
+        self.available = available + freeing
+        self.freeing = freeing
+        self.synced = True
+        self.stale = False
+
+    def getFreeing(self):
+        try:
+            return int(self.zpool.runner.check_output(["/sbin/zpool", "get", "-Hp", "-o", "value", "freeing", self.zpool.name]))
+        except (CalledProcessError, ValueError):
+            return 0
+
+    def resync(self):
+        # Only the loaded datasets are listed when the zpool was loaded
+        # for some subtrees, the zpool root being one of them
+        if self.zpool.scoped:
+            commands = [["/sbin/zfs", "list", "-Hp", "-t", "filesystem,volume", "-o", "name,used,available,referenced"] + names for names in splitArguments([dataset.name for dataset in self.zpool.datasets])]
+        else:
+            commands = [["/sbin/zfs", "list", "-rHp", "-t", "filesystem,volume", "-o", "name,used,available,referenced", self.zpool.name]]
+        figures = None
+        for cmd in commands:
+            try:
+                for line in self.zpool.runner.stream(cmd):
+                    name, used, available, referenced = line.rstrip("\n").split("\t")
+                    dataset = self.zpool.getDataset(name)
+                    if dataset != None:
+                        dataset.referenced = int(referenced)
+                    if name == self.zpool.name:
+                        figures = int(used), int(available)
+            except CalledProcessError as e:
+                # Datasets destroyed since they were loaded
+                if figures == None:
+                    raise
+                logging.debug("Some loaded datasets are gone: %s" % (e))
+        self.update(figures[0], figures[1], self.getFreeing())
+
+    def poll(self):
+        # Only read the zpool figures, as cheaply as zfs allows
+        used, available = self.zpool.runner.check_output(["/sbin/zfs", "list", "-Hp", "-o", "used,available", self.zpool.name]).split()
+        self.update(int(used), int(available), self.getFreeing())
+
+    def refresh(self):
+        if not self.synced:
+            self.resync()
+
+    def invalidate(self):
+        # Read again on next access, after files have been deleted
+        self.stale = True
+        self.synced = False
+
+    def destroyed(self, snapshot):
+        # Held snapshots are only marked for deferred destruction
+        if not snapshot.userrefs:
+            self.release(snapshot.used)
+            self.zpool.metrics.reclaim(1, 0, snapshot.used)
+        else:
+            self.zpool.metrics.reclaim(1)
+        self.stale = True
+
+    def release(self, size):
+        # Explicit accounting of space freed, estimates included
+        with self.lock:
+            self.used -= size
+            self.available += size
+
+class Metrics(object):
+
+    # Figures of the runs on a zpool: wall time by phase and by dataset,
+    # snapshots, files and bytes reclaimed by policy, along with the commands
+    # counted by the runner. Phases nest, the time of an inner phase is not
+    # counted in the outer one. A phase run by several threads at once counts
+    # the wall time while any of them is in it. With profile, the phases run
+    # by the main thread are each profiled with cProfile.
+
+    profile = False
+
+    def __init__(self, zpool):
+        self.zpool = zpool
+        self.lock = Lock()
+        self.local = local()
+        self.phases = {}
+        self.running = {}
+        self.datasets = {}
+        self.reclaimed = {}
+        self.profiles = {}
+        self.time = time.time()
+
+    def getStack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def getPhase(self):
+        stack = self.getStack()
+        return stack[-1] if stack else None
+
+    def pause(self, name):
+        # running holds the threads in each phase and since when one is
+        with self.lock:
+            threads, start = self.running[name]
+            if threads == 1:
+                self.phases[name] = self.phases.get(name, 0) + time.time() - start
+                del self.running[name]
+            else:
+                self.running[name] = threads - 1, start
+        if name in self.profiles and current_thread().name == "MainThread":
+            self.profiles[name].disable()
+
+    def resume(self, name):
+        if self.profile and current_thread().name == "MainThread":
+            if name not in self.profiles:
+                self.profiles[name] = cProfile.Profile()
+            self.profiles[name].enable()
+        with self.lock:
+            threads, start = self.running.get(name, (0, time.time()))
+            self.running[name] = threads + 1, start
+
+    @contextmanager
+    def phase(self, name):
+        stack = self.getStack()
+        if stack:
+            self.pause(stack[-1])
+        stack.append(name)
+        self.resume(name)
+        try:
+            yield
+        finally:
+            self.pause(stack.pop())
+            if stack:
+                self.resume(stack[-1])
+
+    @contextmanager
+    def dataset(self, dataset):
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.datasets[dataset.name] = self.datasets.get(dataset.name, 0) + time.time() - start
+
+    def reclaim(self, snapshots=0, files=0, size=0):
+        # Reclaimed by the policy of the current phase
+        policy = self.getPhase() or "other"
+        with self.lock:
+            if policy not in self.reclaimed:
+                self.reclaimed[policy] = {"snapshots": 0, "files": 0, "bytes": 0}
+            self.reclaimed[policy]["snapshots"] += snapshots
+            self.reclaimed[policy]["files"] += files
+            self.reclaimed[policy]["bytes"] += size
+
+    def getFigures(self):
+        runner = self.zpool.runner
+        with runner.lock:
+            commands = dict([(name, {"count": count, "seconds": seconds, "buckets": zip(runner.buckets, buckets)}) for name, (count, seconds, buckets) in runner.durations.items()])
+        with self.lock:
+            return {"time": self.time, "dryrun": self.zpool.dryrun, "phases": dict(self.phases), "datasets": dict(self.datasets), "reclaimed": dict([(policy, dict(reclaimed)) for policy, reclaimed in self.reclaimed.items()]), "commands": commands}
+
+    def printProfiles(self):
+        for name, profile in sorted(self.profiles.items()):
+            print "Profile of phase %s on zpool %s" % (name, self.zpool.name)
+            pstats.Stats(profile, stream=sys.stdout).sort_stats("cumulative").print_stats(20)
+
+class ChannelProgram(object):
+
+    # Destroy snapshots with ZFS channel programs (zfs program), each batch
+    # being committed in a single transaction group. Channel programs cannot
+    # place or release holds, those keep going through the command line.
+    # Batches hitting the instruction or memory limit are split, any other
+    # failure disables channel programs and leaves the work to the caller.
+
+    instructionLimit = 10000000
+    memoryLimit = 10485760
+    batchSize = 5000
+
+    destroyScript = """-- zfs-snapshots-cleaner: destroy snapshots, deferring held ones
+local snapshots = {
+%s
+}
+local failed = {}
+for i, name in ipairs(snapshots) do
+    if zfs.exists(name) then
+        local err = zfs.sync.destroy{name, defer=true}
+        if err ~= 0 then
+            failed[name] = err
+        end
+    end
+end
+return failed
+"""
+
+    def __init__(self, zpool):
+        self.zpool = zpool
+        self.available = True
+
+    def getScript(self, snapshots):
+        names = []
+        for snapshot in snapshots:
+            names.append('    "%s",' % snapshot.name.replace('\\', '\\\\').replace('"', '\\"'))
+        return self.destroyScript % "\n".join(names)
+
+    def destroy(self, snapshots):
+        # Returns the snapshots that still have to be destroyed
+        remaining = []
+        for i in range(0, len(snapshots), self.batchSize):
+            remaining.extend(self.destroyBatch(snapshots[i:i + self.batchSize]))
+        return remaining
+
+    def destroyBatch(self, snapshots):
+        if not self.available or not snapshots:
+            return snapshots
+
+        script = tempfile.NamedTemporaryFile(prefix="zfs-snapshots-cleaner-", suffix=".lua")
+        try:
+            script.write(self.getScript(snapshots))
+            script.flush()
+            cmd = ["/sbin/zfs", "program", "-j", "-t", str(self.instructionLimit), "-m", str(self.memoryLimit), self.zpool.name, script.name]
+            if self.zpool.dryrun:
+                logging.info("%s (destroy %d snapshots)" % (" ".join(cmd), len(snapshots)))
+                for snapshot in snapshots:
+                    self.zpool.capacityTracker.destroyed(snapshot)
+                return []
+            try:
+                output = self.zpool.runner.check_output(cmd, stderr=STDOUT)
+            except CalledProcessError as e:
+                if re.search("timed out|instruction limit|memory limit", e.output or "", re.IGNORECASE):
+                    if len(snapshots) == 1:
+                        return snapshots
+                    logging.debug("Channel program limit reached, splitting %d snapshots" % len(snapshots))
+                    return self.destroyBatch(snapshots[:len(snapshots) // 2]) + self.destroyBatch(snapshots[len(snapshots) // 2:])
+                logging.warning("Channel programs unavailable, falling back to zfs destroy: %s" % (e.output or e).strip())
+                self.available = False
+                return snapshots
+        finally:
+            script.close()
+
+        try:
+            failed = json.loads(output).get("return") or {}
+        except ValueError:
+            failed = {}
+        remaining = []
+        for snapshot in snapshots:
+            if snapshot.name in failed:
+                remaining.append(snapshot)
+            else:
+                logging.info("Snapshot '%s' has been destroyed" % snapshot.name)
+                self.zpool.capacityTracker.destroyed(snapshot)
+        return remaining
+
 class Dataset(object):
 
+    # Maximum length of the snapshot list given to a single zfs destroy,
+    # kept well under ARG_MAX and Linux's 128k per argument limit
+    destroyBatchSize = 65536
+
     def __init__(self, name, zpool, dryrun=True):
         self.name = name
         self.zpool = zpool
         self.dryrun = dryrun
+
+        # Snapshot columns, by row in listing order. snapshots holds the
+        # Snapshot views of the rows not destroyed, tags only the rows with
+        # tags once holds are loaded.
+        self.snapshotNames = []
+        self.snapshotCreations = array('l')
+        self.snapshotUsed = array('l')
+        self.snapshotUserrefs = array('l')
+        self.snapshotKeeps = array('b')
+        self.snapshotGuids = array('L')
+        self.snapshotTags = None
+
         self.snapshots = []
+        self.removableSnapshots = deque()
+        self.classified = False
+        self.inCreationOrder = True
         self.__maxRetention = None
         self.__retentionPolicy = None
+        self.__resolvedPolicies = None
+        self.userProperties = {}
         self.userrefs = None
         if name.count('/') > 0:
             self.parent = zpool.getDataset(name.rsplit('/', 1)[0])
         else:
             self.parent = None
 
-    def getRemovableSnapshots(self):
-        removableSnapshots = []
-        for snapshot in self.snapshots:
-            if not snapshot.keep:
-                removableSnapshots.append(snapshot)
-        return removableSnapshots
-
-    removableSnapshots = property(getRemovableSnapshots)
+    def addSnapshot(self, shortname, creation, used, userrefs, guid=0):
+        # zfs lists snapshots by creation txg, remember if creation times agree
+        if self.snapshotCreations and creation < self.snapshotCreations[-1]:
+            self.inCreationOrder = False
+        self.snapshotNames.append(intern(shortname))
+        self.snapshotCreations.append(creation)
+        self.snapshotUsed.append(used)
+        self.snapshotUserrefs.append(userrefs)
+        self.snapshotKeeps.append(Snapshot.untested)
+        self.snapshotGuids.append(guid)
+        snapshot = Snapshot(self, len(self.snapshotNames) - 1)
+        self.snapshots.append(snapshot)
+        return snapshot
 
     def getMaxRetention(self):
         if self.__maxRetention == None:
+            if self.__resolvedPolicies != None:
+                return self.__resolvedPolicies[0]
             if self.parent == None:
                 return []
             else:
@@ -138,12 +1336,14 @@ class Dataset(object):
         return self.__maxRetention
 
     def setMaxRetention(self, value):
-        self.__maxRetention = value.split(" and ")
+        self.__maxRetention = [compilePolicy(policy, self.zpool.now) for policy in value.split(" and ")]
 
     maxRetention = property(getMaxRetention, setMaxRetention)
 
     def getRetentionPolicy(self):
         if self.__retentionPolicy == None:
+            if self.__resolvedPolicies != None:
+                return self.__resolvedPolicies[1]
             if self.parent == None:
                 return []
             else:
@@ -151,32 +1351,190 @@ class Dataset(object):
         return self.__retentionPolicy
 
     def setRetentionPolicy(self, value):
-        self.__retentionPolicy = value.split(" and ")
+        self.__retentionPolicy = [compilePolicy(policy, self.zpool.now) for policy in value.split(" and ")]
 
     retentionPolicy = property(getRetentionPolicy, setRetentionPolicy)
 
+    def resolvePolicies(self):
+        # Inherited policies are looked up once, the parent being resolved
+        # first, instead of walking up the parents on every access
+        self.__resolvedPolicies = None
+        self.__resolvedPolicies = (self.maxRetention, self.retentionPolicy)
+
+    def setUserProperties(self, properties):
+
+        # Policies set on a dataset with user properties. Values are listed
+        # inherited too, only the ones differing from the parent's are set on
+        # the dataset itself so that the configuration of the datasets in
+        # between still applies. An invalid value is ignored, the dataset
+        # keeping the policy it would have without it.
+
+        self.userProperties = properties
+        for property, attribute in self.zpool.policyProperties:
+            value = properties.get(property, "-")
+            if value != "-" and (self.parent == None or self.parent.userProperties.get(property) != value):
+                try:
+                    setattr(self, attribute, value)
+                except ValueError as e:
+                    logging.error("Dataset '%s': %s='%s' is ignored, %s" % (self.name, property, value, e))
+
     def getReferenced(self):
-        if self.dryrun:
-            return self.__referenced
-        else:
-            return int(check_output(["/sbin/zfs", "get", "-H", "-p", "-o", "value", "referenced", self.name]))
+        if not self.dryrun:
+            self.zpool.capacityTracker.refresh()
+        return self.__referenced
 
     def setReferenced(self, value):
         self.__referenced = value
 
     referenced = property(getReferenced, setReferenced)
 
-    def destroySnapshotsOutOfMaxRetention(self):
-        # Destroy snapshots out of maxRetention policy
-        for snapshot in self.snapshots[:]:
-            if snapshot.keep == False:
-                cmd = ["/sbin/zfs", "destroy", "-d", snapshot.name]
-                if self.dryrun:
-                    logging.info(" ".join(cmd))
-                else:
-                    logging.debug(check_output(cmd))
-                    logging.info("Snapshot '%s' has been destroyed" % snapshot.name)
-                self.snapshots.remove(snapshot)
+    def classifySnapshots(self):
+
+        # Evaluate each policy once over the snapshots sorted by creation,
+        # the first matching policy decides as in a sequential evaluation.
+        # Snapshots already classified, added by Zpool.refresh, keep their
+        # decision. With a decision cache only the snapshots without a valid
+        # cached decision are evaluated, along with when their decision may
+        # change.
+
+        self.classified = True
+        self.snapshots.sort(key=lambda snapshot: snapshot.timestamp)
+        cache = self.zpool.decisionCache
+        decisions = {}
+        for snapshot in self.snapshots:
+            if self.snapshotKeeps[snapshot.row] != Snapshot.untested:
+                decisions[snapshot.row] = Snapshot.keepValues[self.snapshotKeeps[snapshot.row]]
+        if cache != None and not decisions:
+            decisions = cache.lookup(self)
+        snapshots = self.snapshots
+        if decisions:
+            snapshots = [snapshot for snapshot in self.snapshots if snapshot.row not in decisions]
+        creations = [snapshot.creation for snapshot in snapshots]
+        maxRetention = self.maxRetention
+        if maxRetention != []:
+            keeps = [False] * len(snapshots)
+        else:
+            keeps = [None] * len(snapshots)
+        untils = [None] * len(snapshots)
+
+        for policy in maxRetention:
+            for i in policy.matching(snapshots, creations):
+                if keeps[i] == False:
+                    logging.debug("Snapshot %s matches maxRetention policy %s, may keep it." % (snapshots[i].name, policy))
+                    keeps[i] = None
+                if cache != None:
+                    untils[i] = cache.getUntil(policy, creations[i], untils[i])
+
+        for policy in self.retentionPolicy:
+            for i in policy.matching(snapshots, creations):
+                if keeps[i] != True:
+                    logging.debug("Snapshot %s matches retentionPolicy %s, have to keep it." % (snapshots[i].name, policy))
+                    keeps[i] = True
+                if cache != None:
+                    untils[i] = cache.getUntil(policy, creations[i], untils[i])
+
+        for snapshot, keep in zip(snapshots, keeps):
+            if keep == False:
+                logging.debug("Snapshot %s does NOT match any maxRetention policy, must destroy it." % (snapshot.name))
+            decisions[snapshot.row] = keep
+        for snapshot in self.snapshots:
+            snapshot.keep = decisions[snapshot.row]
+        if cache != None:
+            cache.store(self, zip(snapshots, keeps, untils))
+        self.removableSnapshots = deque([snapshot for snapshot in self.snapshots if not snapshot.keep])
+
+    def removeSnapshotsOutOfMaxRetention(self):
+        # Remove snapshots out of maxRetention policy from the dataset and return them
+        doomed = [snapshot for snapshot in self.snapshots[:] if snapshot.keep == False]
+        if doomed:
+            self.snapshots = [snapshot for snapshot in self.snapshots if snapshot.keep != False]
+            self.removableSnapshots = deque([snapshot for snapshot in self.removableSnapshots if snapshot.keep != False])
+        return doomed
+
+    def getDestroyBatches(self, snapshots):
+
+        # Group snapshots for as few zfs destroy as possible: runs of
+        # snapshots with no other remaining one in between are given as
+        # ranges (fs@a%b), the others as a comma separated list (fs@a,b,c),
+        # each argument kept under destroyBatchSize. Ranges follow the
+        # creation txg, so they are only used when creation times are in the
+        # same order. Yields lists of (zfs destroy item, snapshots) pairs.
+
+        doomed = set(snapshots)
+        snapshots = sorted(snapshots, key=lambda snapshot: snapshot.timestamp)
+        creations = [snapshot.timestamp for snapshot in self.snapshots if snapshot not in doomed]
+        runs = []
+        for snapshot in snapshots:
+            if runs and self.inCreationOrder and bisect_left(creations, runs[-1][0].timestamp) == bisect_right(creations, snapshot.timestamp):
+                runs[-1].append(snapshot)
+            else:
+                runs.append([snapshot])
+
+        batch = []
+        length = 0
+        for run in runs:
+            if len(run) > 2:
+                item = "%s%%%s" % (run[0].shortname, run[-1].shortname)
+            else:
+                item = ",".join([snapshot.shortname for snapshot in run])
+            if batch and length + len(item) > self.destroyBatchSize:
+                yield batch
+                batch = []
+                length = 0
+            batch.append((item, run))
+            length += len(item) + 1
+        if batch:
+            yield batch
+
+    def destroySnapshots(self, snapshots):
+        for batch in self.getDestroyBatches(snapshots):
+            self.destroyBatch(batch)
+
+    def hasFileCleanup(self):
+        return False
+
+    def getReclaim(self, snapshots):
+        # Space zfs would reclaim destroying snapshots, None if it can't tell
+        reclaim = 0
+        for batch in self.getDestroyBatches(snapshots):
+            cmd = ["/sbin/zfs", "destroy", "-nvp", "%s@%s" % (self.name, ",".join([item for item, run in batch]))]
+            try:
+                output = self.zpool.runner.check_output(cmd)
+            except CalledProcessError as e:
+                logging.debug("No reclaim estimate for %s: %s" % (self.name, e))
+                return None
+            for line in output.split("\n"):
+                if line.startswith("reclaim"):
+                    reclaim += int(line.split()[1])
+        return reclaim
+
+    def destroyBatch(self, batch):
+
+        # batch is a list of (zfs destroy item, snapshots) pairs, on failure
+        # it is split until the faulty snapshots are isolated
+
+        cmd = ["/sbin/zfs", "destroy", "-d", "%s@%s" % (self.name, ",".join([item for item, run in batch]))]
+        if self.dryrun:
+            logging.info(" ".join(cmd))
+            for item, run in batch:
+                for snapshot in run:
+                    self.zpool.capacityTracker.destroyed(snapshot)
+            return
+        try:
+            logging.debug(self.zpool.runner.check_output(cmd))
+        except CalledProcessError as e:
+            if len(batch) > 1:
+                self.destroyBatch(batch[:len(batch) // 2])
+                self.destroyBatch(batch[len(batch) // 2:])
+            elif len(batch[0][1]) > 1:
+                self.destroyBatch([(snapshot.shortname, [snapshot]) for snapshot in batch[0][1]])
+            else:
+                logging.error("Snapshot '%s' could NOT be destroyed: %s" % (batch[0][1][0].name, e))
+            return
+        for item, run in batch:
+            for snapshot in run:
+                logging.info("Snapshot '%s' has been destroyed" % snapshot.name)
+                self.zpool.capacityTracker.destroyed(snapshot)
 
 class Filesystem(Dataset):
 
@@ -191,23 +1549,52 @@ class Filesystem(Dataset):
 
     maxFileAge = property(getMaxFileAge, setMaxFileAge)
 
+    fileIndex = None
+
+    def getFileIndex(self):
+        # FileIndex of the filesystem, brought up to date on first use, when
+        # the zpool has an indexDirectory
+        if self.fileIndex == None and self.zpool.indexDirectory != None:
+            self.fileIndex = FileIndex(self, os.path.join(self.zpool.indexDirectory, "%s.sqlite" % (self.name.replace("/", "%"))))
+            self.fileIndex.update()
+        return self.fileIndex
+
+    def sweep(self, sweeper):
+        if self.zpool.plan != None:
+            self.zpool.plan.sweep(self, sweeper)
+            return
+        if not self.zpool.runner.localFiles:
+            logging.info("Files of '/%s' are not swept, they are not local" % (self.name))
+            return
+        index = self.getFileIndex()
+        if index != None:
+            index.sweep(sweeper)
+        else:
+            sweeper.sweep()
+        self.zpool.metrics.reclaim(0, sweeper.files, sweeper.size)
+        if sweeper.files and not self.dryrun:
+            self.zpool.capacityTracker.invalidate()
+
+    def getAgeHistogram(self):
+        # Bytes of the files by age in days
+        if not self.zpool.runner.localFiles:
+            return {}
+        today = datetime.today().date()
+        index = self.getFileIndex()
+        if index != None:
+            return index.getAgeHistogram(today)
+        histogram = {}
+        for path, stat in walkFiles("/%s" % (self.name)):
+            days = (today - date.fromtimestamp(int(stat.st_mtime))).days
+            histogram[days] = histogram.get(days, 0) + stat.st_size
+        return histogram
+
     def deleteFilesOverMaxFileAge(self):
+        # Same selection as find -ctime +maxFileAge: changed at least
+        # maxFileAge + 1 days ago
         try:
             if self.maxFileAge != None:
-                cmd = ["/usr/bin/find", "/%s" % (self.name), "-type", "f", "-ctime", "+%s" % (self.maxFileAge), "-print", "-delete"]
-                if self.dryrun:
-                    logging.info(" ".join(cmd))
-                else:
-                    for file in check_output(cmd).split("\n"):
-                        if file != "":
-                            logging.info("File '%s' has been deleted." % file)
-                cmd = ["/usr/bin/find", "/%s" % (self.name), "-type", "d", "-ctime", "+%s" % (self.maxFileAge), "-mindepth", "2", "-empty", "-print", "-delete"]
-                if self.dryrun:
-                    logging.info(" ".join(cmd))
-                else:
-                    for directory in check_output(cmd).split("\n"):
-                        if directory != "":
-                            logging.info("Directory '%s' has been deleted." % directory)
+                self.sweep(FileSweeper("/%s" % (self.name), time.time() - (self.maxFileAge + 1) * 86400, "st_ctime", self.dryrun, self.zpool.sweepWorkers))
         except AttributeError:
             pass
 
@@ -215,7 +1602,7 @@ class Filesystem(Dataset):
         try:
             if self.maxCapacity != None:
                 logging.debug("%s, %s" % (self.name, self.maxCapacity))
-                for line in check_output(["/sbin/zfs", "get", "-H", "-p", "used,refquota,quota", self.name]).split("\n"):
+                for line in self.zpool.runner.check_output(["/sbin/zfs", "get", "-H", "-p", "used,refquota,quota", self.name]).split("\n"):
                     if line != "":
                         name = line.split()[0]
                         property = line.split()[1]
@@ -232,131 +1619,87 @@ class Filesystem(Dataset):
                 if used > self.maxCapacity * quota:
                     logging.debug("Over threshold")
 
-                    for line in check_output("find /" + self.name + " -exec stat -f \"%m %z\" {} + | sort -n -k1", shell=True).split("\n"):
-                        if line != "":
-                            modificationTime, size = line.split(" ")
-                            used -= int(size)
-                            if used < self.maxCapacity * quota:
-                                break
-                    days = (datetime.today().date() - date.fromtimestamp(int(modificationTime))).days
-
-                    cmd = ["/usr/bin/find", "/%s" % (self.name), "-type", "f", "-mtime", "+%s" % (days), "-print", "-delete"]
-                    if self.dryrun:
-                        logging.info(" ".join(cmd))
-                    else:
-                        for file in check_output(cmd).split("\n"):
-                            if file != "":
-                                logging.info("File '%s' has been deleted." % file)
-
-                    cmd = ["/usr/bin/find", "/%s" % (self.name), "-type", "d", "-mtime", "+%s" % (days), "-mindepth", "2", "-empty", "-print", "-delete"]
-                    if self.dryrun:
-                        logging.info(" ".join(cmd))
+                    # The oldest days are purged until enough space would be
+                    # freed
+                    histogram = self.getAgeHistogram()
+                    for days in sorted(histogram, reverse=True):
+                        used -= histogram[days]
+                        if used < self.maxCapacity * quota:
+                            break
+
+                    if histogram:
+                        # Same selection as find -mtime +days
+                        self.sweep(FileSweeper("/%s" % (self.name), time.time() - (days + 1) * 86400, "st_mtime", self.dryrun, self.zpool.sweepWorkers))
                     else:
-                        for directory in check_output(cmd).split("\n"):
-                            if directory != "":
-                                logging.info("Directory '%s' has been deleted." % directory)
+                        logging.info("No file to delete in '/%s'" % (self.name))
                 else:
                     logging.debug("Under threshold")
                 
         except AttributeError:
             pass
 
+    def hasFileCleanup(self):
+        try:
+            if self.maxFileAge != None:
+                return True
+        except AttributeError:
+            pass
+        return getattr(self, "maxCapacity", None) != None
+
 class Volume(Dataset):
 
     pass
 
 class Snapshot(object):
 
-    def __init__(self, name, dataset, dryrun=True):
-        self.name = name
+    # View of a row of the snapshot columns of its dataset
+
+    __slots__ = ("dataset", "row")
+
+    # Keep column codes
+    untested = -2
+    keepCodes = {None: -1, False: 0, True: 1}
+    keepValues = {-1: None, 0: False, 1: True}
+
+    def __init__(self, dataset, row):
         self.dataset = dataset
-        self.dryrun = dryrun
-        self.__keep = None
-        self.__keepTested = False
-        self.__tags = None
+        self.row = row
 
-    def __del__(self):
-        if self.dryrun:
-            self.dataset.zpool.used -= self.used
-            self.dataset.zpool.available += self.used
-
-    def match(self, policy):
-        # just for the record,
-        #
-        # if [ x for x in [ whatever() ] if cond(x) ] : process(x)
-        # is a close Python transliteration of C's assign and test:
-        #
-        # if( cond(x=whatever()) ) process(x);
-        # Pretty obscure, though.
-
-        weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
-
-        # all
-        if [ m for m in [ re.match('^all$', policy) ] if m != None ]:
-            logging.debug("Snapshot %s matches policy %s." % (self.name, policy))
-            return True
-        # none
-        elif [ m for m in [ re.match('^none$', policy) ] if m != None ]:
-            return False
-        # n hour[s]
-        elif [ m for m in [ re.match('^(\d+) hour[s]?$', policy) ] if m != None ]:
-            if self.creation >= datetime.today() - timedelta(hours=int(m.group(1))):
-                logging.debug("Snapshot %s matches policy %s." % (self.name, policy))
-                return True
-        # n day[s]
-        elif [ m for m in [ re.match('^(\d+) day[s]?$', policy) ] if m != None ]:
-            if self.creation.date() >= datetime.today().date() - timedelta(days=int(m.group(1))):
-                logging.debug("Snapshot %s matches policy %s." % (self.name, policy))
-                return True
-        # n week[s]
-        elif [ m for m in [ re.match('^(\d+) week[s]?$', policy) ] if m != None ]:
-            if self.creation.date() >= datetime.today().date() - timedelta(weeks=int(m.group(1))):
-                logging.debug("Snapshot %s matches policy %s." % (self.name, policy))
-                return True
-        # n (monday|tuesday|wednesday|thursday|friday|saturday|sunday)[s]
-        elif [ m for m in [ re.match('^(\d+) (monday|tuesday|wednesday|thursday|friday|saturday|sunday)[s]?$', policy) ] if m != None ]:
-            if weekdays[self.creation.weekday()] == m.group(2) and self.creation.date() >= datetime.today().date() - timedelta(weeks=int(m.group(1))):
-                logging.debug("Snapshot %s matches policy %s." % (self.name, policy))
-                return True
-        # n n-th weekday of the month
-        elif [ m for m in [ re.match('^(\d+) (\d+)(st|nd|rd|th) (monday|tuesday|wednesday|thursday|friday|saturday|sunday) of the month$', policy) ] if m != None ]:
-            if int(self.creation.date().strftime("%d")) <= 7:
-                weekdayofthemonth = 1
-            elif int(self.creation.date().strftime("%d")) <= 14:
-                weekdayofthemonth = 2
-            elif int(self.creation.date().strftime("%d")) <= 21:
-                weekdayofthemonth = 3
-            elif int(self.creation.date().strftime("%d")) <= 28:
-                weekdayofthemonth = 4
-            else:
-                weekdayofthemonth = 5
-            if weekdays[self.creation.weekday()] == m.group(4) and weekdayofthemonth == int(m.group(2)):
-                if int(datetime.today().date().strftime("%m")) == int(check_output(["date", "+%m", "--date", "last %s" % m.group(4)])):
-                    date = MonthDelta(datetime.today().replace(day=1), int(m.group(1)) - 1)
-                else:
-                    date = MonthDelta(datetime.today().replace(day=1), int(m.group(1)))
-                if self.creation.date() >= date.date():
-                    logging.debug("Snapshot %s matches policy %s." % (self.name, policy))
-                    return True
-        # n n-th day of the month
-        elif [ m for m in [ re.match('^(\d+) (\d+)(st|nd|rd|th) day of the month$', policy) ] if m != None ]:
-            if int(self.creation.date().strftime("%d")) == int(m.group(2)) and self.creation.date() >= MonthDelta(datetime.today().replace(day=1), int(m.group(1)) - 1).date():
-                logging.debug("Snapshot %s matches policy %s." % (self.name, policy))
-                return True
-        # n n-th day of the quarter
-        elif [ m for m in [ re.match('^(\d+) (\d+)(st|nd|rd|th) day of the quarter$', policy) ] if m != None ]:
-            if int(self.creation.date().strftime("%d")) == int(m.group(2)) and int(self.creation.date().strftime("%m")) % 3 == 1 and self.creation.date() >= MonthDelta(datetime.today().replace(day=1), int(m.group(1)) * 3).date():
-                logging.debug("Snapshot %s matches policy %s." % (self.name, policy))
-                return True
-        # @snapshot
-        elif [ m for m in [ re.match('^@([^ ]*)$', policy) ] if m != None ]:
-            if self.name.split('@')[1] == m.group(1):
-                logging.debug("Snapshot %s matches policy %s." % (self.name, policy))
-                return True
-        else:
-            logging.critical("unknown policy: %s" % policy)
-            sys.exit(1)
-        return False
+    def getName(self):
+        return "%s@%s" % (self.dataset.name, self.dataset.snapshotNames[self.row])
+
+    name = property(getName)
+
+    def getShortname(self):
+        return self.dataset.snapshotNames[self.row]
+
+    shortname = property(getShortname)
+
+    def getTimestamp(self):
+        return self.dataset.snapshotCreations[self.row]
+
+    timestamp = property(getTimestamp)
+
+    def getCreation(self):
+        return datetime.fromtimestamp(self.dataset.snapshotCreations[self.row])
+
+    creation = property(getCreation)
+
+    def getUsed(self):
+        return self.dataset.snapshotUsed[self.row]
+
+    def setUsed(self, value):
+        self.dataset.snapshotUsed[self.row] = value
+
+    used = property(getUsed, setUsed)
+
+    def getUserrefs(self):
+        return self.dataset.snapshotUserrefs[self.row]
+
+    def setUserrefs(self, value):
+        self.dataset.snapshotUserrefs[self.row] = value
+
+    userrefs = property(getUserrefs, setUserrefs)
 
     def getKeep(self):
 
@@ -364,76 +1707,1130 @@ class Snapshot(object):
         # if maxRetention is set value becomes False (mark as to be deleted), unless snapshot matches maxRetention then value becomes None
         # if snapshot matches retentionPolicy then value becomes True : always keep
 
-        if not self.__keepTested:
-
-            self.__keepTested = True
-
-            if self.dataset.maxRetention != []:
-                self.__keep = False
-                for policy in self.dataset.maxRetention:
-                    if self.match(policy):
-                        logging.debug("Snapshot %s matches maxRetention policy %s, may keep it." % (self.name, policy))
-                        self.__keep = None
-                        if 'keep' in self.tags:
-                            cmd = ["/sbin/zfs", "release", "keep", self.name]
-                            if self.dryrun:
-                                logging.info(" ".join(cmd))
-                            else:
-                                check_output(cmd)
-                            self.__tags.remove('keep')
-                            self.userrefs -= 1
-                        break
-                if self.__keep == False:
-                    logging.debug("Snapshot %s does NOT match any maxRetention policy, must destroy it." % (self.name))
-                    if 'keep' in self.tags:
-                        cmd = ["/sbin/zfs", "release", "keep", self.name]
-                        if self.dryrun:
-                            logging.info(" ".join(cmd))
-                        else:
-                            check_output(cmd)
-                        self.__tags.remove('keep')
-                        self.userrefs -= 1
-    
-            for policy in self.dataset.retentionPolicy:
-                if self.match(policy):
-                    logging.debug("Snapshot %s matches retentionPolicy %s, have to keep it." % (self.name, policy))
-                    self.__keep = True
-                    if not 'keep' in self.tags:
-                        cmd = ["/sbin/zfs", "hold", "keep", self.name]
-                        if self.dryrun:
-                            logging.info(" ".join(cmd))
-                        else:
-                            check_output(cmd)
-                        self.__tags.add('keep')
-                        self.userrefs += 1
-                    break
-    
-            if self.__keep != True:
-                if 'keep' in self.tags:
-                    cmd = ["/sbin/zfs", "release", "keep", self.name]
-                    if self.dryrun:
-                        logging.info(" ".join(cmd))
-                    else:
-                        check_output(cmd)
-                    self.__tags.remove('keep')
-                    self.userrefs -= 1
+        if self.dataset.snapshotKeeps[self.row] == self.untested:
+            self.dataset.zpool.classifySnapshots()
+        return self.keepValues[self.dataset.snapshotKeeps[self.row]]
+
+    def setKeep(self, value):
+        # The keep hold follows the value, zfs is updated by Zpool.applyHolds
+        self.dataset.snapshotKeeps[self.row] = self.keepCodes[value]
+        if not self.dataset.zpool.keepHolds:
+            return
+        if value == True:
+            if not 'keep' in self.tags:
+                self.dataset.zpool.pendingHolds["hold"].append(self)
+                self.dataset.snapshotTags.setdefault(self.row, set()).add('keep')
+                self.userrefs += 1
+        elif 'keep' in self.tags:
+            self.dataset.zpool.pendingHolds["release"].append(self)
+            self.dataset.snapshotTags[self.row].remove('keep')
+            self.userrefs -= 1
 
-        return self.__keep
+    keep = property(getKeep, setKeep)
 
-    keep = property(getKeep)
+    def getGuid(self):
+        return self.dataset.snapshotGuids[self.row]
+
+    guid = property(getGuid)
 
     def getTags(self):
-        if self.__tags == None:
-            self.__tags = set()
-            if self.userrefs > 0:
-                for line in check_output(["/sbin/zfs", "holds", "-H", self.name]).split("\n"):
-                    if line:
-                        self.__tags.add(line.split()[1])
-                        self.userrefs += 1
-        return self.__tags
+        if self.dataset.snapshotTags == None:
+            self.dataset.zpool.loadHolds()
+        return self.dataset.snapshotTags.get(self.row, frozenset())
 
     tags = property(getTags)
 
+class RetentionPolicy(object):
+
+    # A compiled policy term: a snapshot matches if it was created at or
+    # after cutoff (when set) and passes test(snapshot, creation) (when set).
+
+    def __init__(self, policy, cutoff=None, test=None):
+        self.policy = policy
+        self.cutoff = cutoff
+        self.test = test
+
+    def __str__(self):
+        return self.policy
+
+    def match(self, snapshot):
+        if self.cutoff != None and snapshot.creation < self.cutoff:
+            return False
+        return self.test == None or self.test(snapshot, snapshot.creation)
+
+    def matching(self, snapshots, creations):
+        # Indices of the matching snapshots, creations being sorted
+        start = 0
+        if self.cutoff != None:
+            start = bisect_left(creations, self.cutoff)
+        if self.test == None:
+            return xrange(start, len(snapshots))
+        return [i for i in xrange(start, len(snapshots)) if self.test(snapshots[i], creations[i])]
+
+class FileSweeper(object):
+
+    # One post-order walk of a tree deleting the regular files whose
+    # attribute (st_ctime, st_mtime) is at or before cutoff, then the
+    # directories from depth 2 with such an attribute once they are empty,
+    # as find -type f -delete then find -type d -mindepth 2 -empty -delete
+    # would. Directory attributes are read before the walk enters them.
+    # Directories above parallelDepth are walked by the calling thread, the
+    # subtrees below are spread over a pool of workers.
+
+    def __init__(self, root, cutoff, attribute="st_ctime", dryrun=True, workers=4, parallelDepth=2):
+        self.root = root
+        self.cutoff = cutoff
+        self.attribute = attribute
+        self.dryrun = dryrun
+        self.workers = workers
+        self.parallelDepth = parallelDepth
+        self.files = 0
+        self.directories = 0
+        self.size = 0
+        self.lock = Lock()
+
+    def isExpired(self, stat):
+        return getattr(stat, self.attribute) <= self.cutoff
+
+    def sweep(self):
+        pool = None
+        if self.workers > 1:
+            pool = ThreadPool(self.workers)
+        try:
+            self.sweepDirectory(self.root, 0, pool)()
+        finally:
+            if pool != None:
+                pool.close()
+                pool.join()
+        self.logSummary()
+
+    def logSummary(self):
+        logging.info("%s: %d files (%d bytes) and %d directories %s." % (self.root, self.files, self.size, self.directories, "would be deleted" if self.dryrun else "deleted"))
+
+    def sweepTree(self, path, depth):
+        return self.sweepDirectory(path, depth)()
+
+    def sweepDirectory(self, path, depth, pool=None):
+
+        # Delete the expired files of path and sweep its subdirectories.
+        # Returns a function giving the number of entries left in path, which
+        # waits for the subtrees handed to the pool.
+
+        try:
+            entries = list(listDirectory(path))
+        except OSError as e:
+            logging.error("Could NOT read directory '%s': %s" % (path, e))
+            return lambda: 1
+
+        left = 0
+        pending = []
+        for child, stat in entries:
+            if S_ISDIR(stat.st_mode):
+                if pool == None:
+                    left += not self.pruneDirectory(child, stat, depth + 1, self.sweepTree(child, depth + 1))
+                elif depth + 1 < self.parallelDepth:
+                    pending.append((child, stat, self.sweepDirectory(child, depth + 1, pool)))
+                else:
+                    result = pool.apply_async(LogBuffer.bind(self.sweepTree), (child, depth + 1))
+                    pending.append((child, stat, lambda result=result: waitFor(result)))
+            elif S_ISREG(stat.st_mode) and self.isExpired(stat):
+                left += not self.deleteFile(child, stat)
+            else:
+                left += 1
+
+        def getLeft():
+            count = left
+            for child, stat, getChildLeft in pending:
+                count += not self.pruneDirectory(child, stat, depth + 1, getChildLeft())
+            return count
+
+        return getLeft
+
+    def deleteFile(self, path, stat):
+        if self.dryrun:
+            logging.info("File '%s' would be deleted." % path)
+        else:
+            try:
+                os.unlink(path)
+            except OSError as e:
+                logging.error("Could NOT delete file '%s': %s" % (path, e))
+                return False
+            logging.info("File '%s' has been deleted." % path)
+        with self.lock:
+            self.files += 1
+            self.size += stat.st_size
+        return True
+
+    def pruneDirectory(self, path, stat, depth, left):
+        if left or depth < 2 or not self.isExpired(stat):
+            return False
+        if self.dryrun:
+            logging.info("Directory '%s' would be deleted." % path)
+        else:
+            try:
+                os.rmdir(path)
+            except OSError as e:
+                logging.error("Could NOT delete directory '%s': %s" % (path, e))
+                return False
+            logging.info("Directory '%s' has been deleted." % path)
+        with self.lock:
+            self.directories += 1
+        return True
+
+class LogBuffer(logging.Handler):
+
+    # Root logger handler holding the records logged by a thread while it
+    # runs a function with hold(), then passing them on together to the
+    # former handlers. Records of other threads are passed on at once,
+    # unless they run a function bound to a holding thread.
+
+    local = local()
+
+    def __init__(self, handlers):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+
+    def emit(self, record):
+        records = getattr(self.local, "records", None)
+        if records != None:
+            records.append(record)
+        else:
+            self.forward([record])
+
+    def forward(self, records):
+        with self.lock:
+            for record in records:
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+
+    def hold(self, function, *args):
+        self.local.records = []
+        try:
+            return function(*args)
+        finally:
+            records = self.local.records
+            self.local.records = None
+            self.forward(records)
+
+    @classmethod
+    def bind(cls, function):
+        # Function to be run by another thread, its records being held with
+        # those of the calling thread
+        records = getattr(cls.local, "records", None)
+        if records == None:
+            return function
+        def run(*args):
+            cls.local.records = records
+            try:
+                return function(*args)
+            finally:
+                cls.local.records = None
+        return run
+
+class FileIndex(object):
+
+    # SQLite table of the entries of a filesystem (path, parent, type, ctime,
+    # mtime, size), kept up to date with zfs diff from the snapshot last
+    # indexed to the live filesystem. Every path reported is stat'ed again,
+    # so changes made after the newest snapshot, which becomes the next
+    # baseline, are safely seen twice. The table is rebuilt with a full walk,
+    # not crossing into other filesystems, when the baseline snapshot is
+    # gone or zfs diff fails.
+
+    batchSize = 10000
+
+    def __init__(self, filesystem, path):
+        self.filesystem = filesystem
+        self.root = "/%s" % (filesystem.name)
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = str
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, parent TEXT, type TEXT, ctime REAL, mtime REAL, size INTEGER)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_parent ON files (parent)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_ctime ON files (type, ctime)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_mtime ON files (type, mtime)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS baseline (name TEXT, creation INTEGER)")
+        self.connection.commit()
+
+    def getRow(self, path, stat):
+        if S_ISREG(stat.st_mode):
+            type = "f"
+        elif S_ISDIR(stat.st_mode):
+            type = "d"
+        elif S_ISLNK(stat.st_mode):
+            type = "l"
+        else:
+            type = "o"
+        return (path, os.path.dirname(path), type, stat.st_ctime, stat.st_mtime, stat.st_size)
+
+    def update(self):
+        snapshots = self.filesystem.snapshots
+        newest = max(snapshots, key=lambda snapshot: snapshot.timestamp) if snapshots else None
+        baseline = self.connection.execute("SELECT name, creation FROM baseline").fetchone()
+        snapshot = None
+        if baseline != None:
+            snapshot = ([snapshot for snapshot in snapshots if (snapshot.name, snapshot.timestamp) == baseline] or [None])[0]
+        if snapshot == None:
+            logging.info("Rebuilding the file index of '%s'" % (self.filesystem.name))
+            self.rebuild()
+        else:
+            try:
+                self.applyDiff(snapshot)
+            except CalledProcessError as e:
+                logging.warning("Rebuilding the file index of '%s': %s" % (self.filesystem.name, e))
+                self.rebuild()
+        self.connection.execute("DELETE FROM baseline")
+        if newest != None:
+            self.connection.execute("INSERT INTO baseline VALUES (?, ?)", (newest.name, newest.timestamp))
+        self.connection.commit()
+
+    def decode(self, path):
+        # zfs diff escapes unprintable characters as octal
+        return re.sub(r'\\0?([0-7]{3})', lambda m: chr(int(m.group(1), 8)), path)
+
+    def applyDiff(self, snapshot):
+        changes = 0
+        for line in self.filesystem.zpool.runner.stream(["/sbin/zfs", "diff", "-FH", snapshot.name, self.filesystem.name]):
+            fields = line.rstrip("\n").split("\t")
+            path = self.decode(fields[2])
+            if fields[0] == "R":
+                self.rename(path, self.decode(fields[3]))
+                self.refresh(self.decode(fields[3]))
+            self.refresh(path)
+            changes += 1
+        logging.debug("%d changes in '%s' since %s" % (changes, self.filesystem.name, snapshot.name))
+
+    def refresh(self, path):
+        # The root is not indexed, zfs diff reports it when its entries change
+        if path == self.root:
+            return
+        try:
+            stat = os.lstat(path)
+        except OSError:
+            self.remove(path)
+            return
+        self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", self.getRow(path, stat))
+
+    def remove(self, path):
+        self.connection.execute("DELETE FROM files WHERE path = ? OR (path > ? AND path < ?)", (path, path + "/", path + "0"))
+
+    def rename(self, old, new):
+        # Move the entries below old, zfs diff only reports the renamed directory
+        self.remove(new)
+        self.connection.execute("UPDATE files SET path = ? || substr(path, ?), parent = ? || substr(parent, ?) WHERE path > ? AND path < ?", (new, len(old) + 1, new, len(old) + 1, old + "/", old + "0"))
+
+    def rebuild(self):
+        self.connection.execute("DELETE FROM files")
+        device = os.lstat(self.root).st_dev
+        directories = [self.root]
+        rows = []
+        while directories:
+            path = directories.pop()
+            try:
+                entries = list(listDirectory(path))
+            except OSError as e:
+                logging.error("Could NOT read directory '%s': %s" % (path, e))
+                continue
+            for child, stat in entries:
+                rows.append(self.getRow(child, stat))
+                if S_ISDIR(stat.st_mode) and stat.st_dev == device:
+                    directories.append(child)
+            if len(rows) >= self.batchSize:
+                self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", rows)
+                rows = []
+        self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def getAgeHistogram(self, today):
+        histogram = {}
+        for day, size in self.connection.execute("SELECT date(mtime, 'unixepoch', 'localtime') AS day, SUM(size) FROM files WHERE type = 'f' GROUP BY day"):
+            histogram[(today - datetime.strptime(day, "%Y-%m-%d").date()).days] = size
+        return histogram
+
+    def sweep(self, sweeper):
+
+        # FileSweeper selection read from the index: the expired files, then
+        # the expired directories from depth 2, deepest first, once all the
+        # entries they are indexed with are gone. Paths are stat'ed again
+        # before deletion and directories before any file is deleted, as
+        # their ctime changes then.
+
+        column = sweeper.attribute[3:]
+        directories = []
+        for path, in self.connection.execute("SELECT path FROM files WHERE type = 'd' AND %s <= ? ORDER BY length(path) DESC" % (column), (sweeper.cutoff, )).fetchall():
+            depth = path[len(self.root) + 1:].count("/") + 1
+            try:
+                directories.append((path, os.lstat(path), depth))
+            except OSError:
+                pass
+
+        removed = set()
+        for path, in self.connection.execute("SELECT path FROM files WHERE type = 'f' AND %s <= ?" % (column), (sweeper.cutoff, )).fetchall():
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                continue
+            if S_ISREG(stat.st_mode) and sweeper.isExpired(stat) and sweeper.deleteFile(path, stat):
+                removed.add(path)
+
+        for path, stat, depth in directories:
+            left = len([child for child, in self.connection.execute("SELECT path FROM files WHERE parent = ?", (path, )) if child not in removed])
+            if S_ISDIR(stat.st_mode) and sweeper.pruneDirectory(path, stat, depth, left):
+                removed.add(path)
+
+        if not sweeper.dryrun:
+            self.connection.executemany("DELETE FROM files WHERE path = ?", [(path, ) for path in removed])
+            self.connection.commit()
+        sweeper.logSummary()
+
+class Plan(object):
+
+    # Cleanup plan of a zpool written by a dry run, one JSON object per line:
+    # a header with the zpool space and settings, the holds, releases,
+    # snapshot destroys and file sweeps in the order a forced run would
+    # perform them, then the expected reclaim by dataset. Snapshots are
+    # given as [name, guid] by dataset. The best effort phase starts with
+    # the removable snapshots, its destroys only tell what the dry run
+    # expected: Zpool.applyPlan destroys removable snapshots while the zpool
+    # is actually over maxCapacity.
+
+    # Largest change of the zpool capacity between a plan and its apply
+    tolerance = 0.01
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = Lock()
+        self.reclaim = {}
+        self.bestEffort = False
+
+    def write(self, entry):
+        with self.lock:
+            self.stream.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def begin(self, zpool):
+        self.write({"zpool": zpool.name, "time": int(time.time()), "used": zpool.used, "available": zpool.available, "maxCapacity": zpool.maxCapacity, "bestEffortPolicy": zpool.bestEffortPolicy, "sweepWorkers": zpool.sweepWorkers, "indexDirectory": zpool.indexDirectory, "commandTimeout": zpool.runner.timeout, "maxCommands": zpool.runner.maxCommands, "maxWrites": zpool.runner.maxWrites})
+
+    def end(self):
+        self.write({"reclaim": sorted(self.reclaim.items())})
+
+    def getRows(self, snapshots):
+        # [name, guid] rows of snapshots by dataset, in order
+        rows = {}
+        datasets = []
+        for snapshot in snapshots:
+            if snapshot.dataset not in rows:
+                rows[snapshot.dataset] = []
+                datasets.append(snapshot.dataset)
+            rows[snapshot.dataset].append([snapshot.shortname, snapshot.guid])
+        return [(dataset, rows[dataset]) for dataset in datasets]
+
+    def holds(self, action, snapshots):
+        for dataset, rows in self.getRows(snapshots):
+            self.write({action: dataset.name, "snapshots": rows})
+
+    def removable(self, datasets):
+        self.bestEffort = True
+        for dataset in datasets:
+            if dataset.removableSnapshots:
+                self.write({"removable": dataset.name, "snapshots": self.getRows(dataset.removableSnapshots)[0][1]})
+
+    def destroy(self, snapshots):
+        # Held snapshots are only marked for deferred destruction
+        reclaim = {}
+        for snapshot in snapshots:
+            if not snapshot.userrefs:
+                reclaim[snapshot.dataset] = reclaim.get(snapshot.dataset, 0) + snapshot.used
+        for dataset, rows in self.getRows(snapshots):
+            with self.lock:
+                self.reclaim[dataset.name] = self.reclaim.get(dataset.name, 0) + reclaim.get(dataset, 0)
+            self.write({"destroy": dataset.name, "snapshots": rows, "reclaim": reclaim.get(dataset, 0), "bestEffort": self.bestEffort})
+
+    def sweep(self, filesystem, sweeper):
+        self.write({"sweep": filesystem.name, "attribute": sweeper.attribute, "cutoff": sweeper.cutoff})
+
+class Report(object):
+
+    # Snapshots status written by --report, as JSON lines or CSV: a row per
+    # snapshot, sorted by dataset and creation, then a row per dataset with
+    # the number of snapshots and the sum of their used space by status.
+    # The sums are a lower bound of what destroying them reclaims, space
+    # shared by several of them being only counted in the zfs destroy
+    # estimate.
+
+    fields = ["dataset", "snapshot", "creation", "used", "userrefs", "status", "snapshots", "keep", "destroy", "removable", "keepUsed", "destroyUsed", "removableUsed"]
+    statuses = {True: "keep", False: "destroy", None: "removable"}
+
+    def __init__(self, stream, format="jsonl"):
+        self.stream = stream
+        self.writer = None
+        if format == "csv":
+            self.writer = csv.writer(stream)
+
+    @classmethod
+    def getHeader(cls, format):
+        # Written once before the rows of all the zpools
+        if format == "csv":
+            return ",".join(cls.fields) + "\r\n"
+        return ""
+
+    @staticmethod
+    def getFormat(path):
+        if path.endswith(".csv"):
+            return "csv"
+        return "jsonl"
+
+    def write(self, row):
+        if self.writer != None:
+            self.writer.writerow([row.get(field, "") for field in self.fields])
+        else:
+            self.stream.write(json.dumps(row) + "\n")
+
+    def dataset(self, dataset):
+        totals = {"snapshots": 0, "keep": 0, "destroy": 0, "removable": 0, "keepUsed": 0, "destroyUsed": 0, "removableUsed": 0}
+        for snapshot in dataset.snapshots:
+            status = self.statuses[snapshot.keep]
+            self.write({"dataset": dataset.name, "snapshot": snapshot.shortname, "creation": snapshot.timestamp, "used": snapshot.used, "userrefs": snapshot.userrefs, "status": status})
+            totals["snapshots"] += 1
+            totals[status] += 1
+            totals[status + "Used"] += snapshot.used
+        totals["dataset"] = dataset.name
+        self.write(totals)
+
+class DecisionCache(object):
+
+    # SQLite table of the keep decisions of the snapshots, keyed by guid and
+    # a hash of the effective policies of their dataset, with the time until
+    # which each decision holds. Cutoffs only move forward in time, so a
+    # decision can only change once the cutoff of a policy matching the
+    # snapshot passes its creation. Entries of another policy, of a renamed
+    # snapshot or past their time are evaluated again.
+
+    # Days looked ahead for a cutoff passing a creation
+    horizon = 1 << 14
+
+    def __init__(self, path, now):
+        self.now = now
+        self.timestamp = time.mktime(now.timetuple())
+        self.cutoffs = {}
+        self.times = {}
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = str
+        self.connection.execute("CREATE TABLE IF NOT EXISTS decisions (guid TEXT PRIMARY KEY, dataset TEXT, name TEXT, policies TEXT, keep INTEGER, until REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS decisions_dataset ON decisions (dataset)")
+        self.connection.commit()
+
+    def getPolicies(self, dataset):
+        policies = ([str(policy) for policy in dataset.maxRetention], [str(policy) for policy in dataset.retentionPolicy])
+        return md5(repr(policies)).hexdigest()
+
+    def lookup(self, dataset):
+        # Cached keep values still valid for the snapshots of a dataset, by
+        # row. Entries of snapshots no longer there are dropped.
+        policies = self.getPolicies(dataset)
+        entries = {}
+        for guid, name, _policies, keep, until in self.connection.execute("SELECT guid, name, policies, keep, until FROM decisions WHERE dataset = ?", (dataset.name, )):
+            entries[guid] = (name, _policies, keep, until)
+        decisions = {}
+        for snapshot in dataset.snapshots:
+            entry = entries.pop(str(snapshot.guid), None)
+            if entry == None:
+                continue
+            name, _policies, keep, until = entry
+            if name == snapshot.shortname and _policies == policies and (until == None or until > self.timestamp):
+                decisions[snapshot.row] = Snapshot.keepValues[keep]
+        self.connection.executemany("DELETE FROM decisions WHERE guid = ?", [(guid, ) for guid in entries])
+        self.hits += len(decisions)
+        return decisions
+
+    def store(self, dataset, decisions):
+        # Record (snapshot, keep, until) decisions of a dataset
+        policies = self.getPolicies(dataset)
+        rows = []
+        for snapshot, keep, until in decisions:
+            rows.append((str(snapshot.guid), dataset.name, snapshot.shortname, policies, Snapshot.keepCodes[keep], until))
+        self.connection.executemany("INSERT OR REPLACE INTO decisions VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.misses += len(rows)
+
+    def getUntil(self, policy, creation, until=None):
+
+        # Earliest of until and the time up to which policy, matching a
+        # snapshot created at creation, surely still matches it. The cutoffs
+        # of the policy are compiled day after day until one passes the
+        # creation, the decision holds until the same time the day before.
+
+        if policy.cutoff == None:
+            return until
+        cutoffs = self.cutoffs.setdefault(str(policy), [])
+        while not cutoffs or cutoffs[-1] <= creation:
+            if len(cutoffs) >= self.horizon:
+                return until
+            cutoffs.append(compilePolicy(str(policy), self.now + timedelta(days=len(cutoffs))).cutoff)
+        days = bisect_right(cutoffs, creation) - 1
+        if days not in self.times:
+            self.times[days] = time.mktime((self.now + timedelta(days=days)).timetuple())
+        if until == None or self.times[days] < until:
+            return self.times[days]
+        return until
+
+    def commit(self, zpool):
+        # Drop the entries of the datasets of zpool no longer loaded
+        names = set([dataset.name for dataset in zpool.datasets])
+        for name, in self.connection.execute("SELECT DISTINCT dataset FROM decisions").fetchall():
+            if (name == zpool.name or name.startswith(zpool.name + "/")) and name not in names:
+                self.connection.execute("DELETE FROM decisions WHERE dataset = ?", (name, ))
+        self.connection.commit()
+        if self.hits or self.misses:
+            logging.info("%d snapshot decisions reused from the cache, %d evaluated" % (self.hits, self.misses))
+        self.hits = 0
+        self.misses = 0
+
+class Recorder(object):
+
+    # Trace of the commands run, written by --record as gzip compressed JSON
+    # lines: a header with the options and configuration of the run, then
+    # the command line, output, exit status and latency of each command and
+    # the times the zpools were loaded at.
+    # Outputs are kept byte for byte as latin-1. Each process writes its own
+    # parts, gzip members that save() concatenates once the run is over.
+
+    def __init__(self, path, argv, config=None):
+        self.path = path
+        self.header = {"version": 1, "time": time.time(), "host": os.uname()[1], "utcOffset": -time.timezone, "argv": argv, "config": config}
+        self.directory = tempfile.mkdtemp(prefix=".zfs-snapshots-cleaner-", dir=os.path.dirname(os.path.abspath(path)))
+        self.lock = Lock()
+        self.pid = os.getpid()
+        self.stream = None
+        self.parts = 0
+
+    def write(self, record):
+        line = json.dumps(record, encoding="latin-1") + "\n"
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked, the part of the parent is left to it
+                self.pid = os.getpid()
+                self.stream = None
+            if self.stream == None:
+                self.parts += 1
+                self.stream = gzip.open(os.path.join(self.directory, "%d-%d.gz" % (self.pid, self.parts)), "wb")
+            self.stream.write(line)
+
+    def close(self):
+        # End the part of this process, worker processes exit without
+        # flushing theirs
+        with self.lock:
+            if self.stream != None and self.pid == os.getpid():
+                self.stream.close()
+            self.stream = None
+
+    def save(self):
+        self.close()
+        fd, written = tempfile.mkstemp(prefix=".zfs-snapshots-cleaner-", dir=os.path.dirname(os.path.abspath(self.path)))
+        stream = os.fdopen(fd, "wb")
+        try:
+            header = gzip.GzipFile(fileobj=stream, mode="wb")
+            header.write(json.dumps(self.header, encoding="latin-1") + "\n")
+            header.close()
+            for name in sorted(os.listdir(self.directory)):
+                part = open(os.path.join(self.directory, name), "rb")
+                try:
+                    copyfileobj(part, stream)
+                finally:
+                    part.close()
+        finally:
+            stream.close()
+        os.rename(written, self.path)
+        rmtree(self.directory)
+        logging.info("Commands recorded to '%s'" % (self.path))
+
+class Replay(object):
+
+    # Trace written by --record, the records of each command line being
+    # replayed in the order they were recorded, the last one again once the
+    # others are used up. The recorded configuration is written to a
+    # temporary file, removed once the replay is over.
+
+    def __init__(self, path):
+        self.header = {}
+        self.records = {}
+        self.times = {}
+        self.lock = Lock()
+        self.config = None
+        stream = gzip.open(path, "rb")
+        try:
+            for line in stream:
+                record = self.decode(json.loads(line))
+                if "cmd" in record:
+                    self.records.setdefault(self.getKey(record["cmd"]), deque()).append(record)
+                elif "today" in record:
+                    self.times.setdefault(record["zpool"], deque()).append(record["today"])
+                else:
+                    self.header = record
+        finally:
+            stream.close()
+        logging.info("Replaying %d commands recorded on %s at %s with %s" % (sum([len(records) for records in self.records.values()]), self.header.get("host"), datetime.fromtimestamp(self.header.get("time", 0)), " ".join(self.header.get("argv", []))))
+        if self.header.get("utcOffset", -time.timezone) != -time.timezone:
+            logging.warning("The trace was recorded %d seconds off UTC, %d here: set TZ as on the recording host for the same retention decisions" % (self.header["utcOffset"], -time.timezone))
+
+    def getConfigFile(self):
+        # Path of the recorded configuration, None for traces without it
+        if self.header.get("config") == None:
+            return None
+        if self.config == None:
+            self.config = tempfile.NamedTemporaryFile(prefix="zfs-snapshots-cleaner-", suffix=".conf")
+            self.config.write(self.header["config"])
+            self.config.flush()
+        return self.config.name
+
+    def decode(self, value):
+        # Strings back to the bytes recorded
+        if isinstance(value, unicode):
+            return value.encode("latin-1")
+        if isinstance(value, list):
+            return [self.decode(item) for item in value]
+        if isinstance(value, dict):
+            return dict([(key.encode("latin-1"), self.decode(item)) for key, item in value.items()])
+        return value
+
+    def getKey(self, cmd):
+        return tuple(cmd)
+
+    def next(self, records, key):
+        with self.lock:
+            queue = records.get(key)
+            if not queue:
+                return None
+            if len(queue) > 1:
+                return queue.popleft()
+            return queue[0]
+
+class Daemon(object):
+
+    # Keeps the configured zpools loaded between cleanups. Every
+    # pollInterval seconds only the zpool space is read. A zpool is loaded
+    # again and fully cleaned every cleanInterval seconds, and as soon as it
+    # goes over maxCapacity in between, its snapshots are refreshed and the
+    # best effort phase runs. SIGHUP reloads the configuration, the zpools
+    # whose configuration changed being loaded again.
+
+    pollInterval = 60
+    cleanInterval = 86400
+
+    def __init__(self, conffile, dryrun=True, channelPrograms=False, metrics=None):
+        self.conffile = conffile
+        self.dryrun = dryrun
+        self.channelPrograms = channelPrograms
+        self.metrics = metrics
+        self.zpools = []
+        self.reloading = True
+        self.wakeup = Event()
+
+    def hangup(self):
+        self.reloading = True
+        self.wakeup.set()
+
+    def stop(self):
+        CommandRunner.shutdown()
+        self.wakeup.set()
+
+    def reload(self):
+        # A configuration that can't be read leaves the running one in place
+        try:
+            configs = [config for config in readConfig(self.conffile)]
+        except Exception:
+            logging.exception("Configuration '%s' could NOT be read" % (self.conffile))
+            return
+        states = dict([(state["config"][0]["name"], state) for state in self.zpools])
+        self.zpools = []
+        for config in configs:
+            state = states.get(config[0]["name"], {"zpool": None, "nextClean": 0, "nextPoll": 0})
+            if state.get("config") != config:
+                state["zpool"] = None
+            state["config"] = config
+            state["pollInterval"] = self.pollInterval
+            state["cleanInterval"] = self.cleanInterval
+            try:
+                state["pollInterval"] = float(config[0]["pollInterval"])
+            except KeyError:
+                pass
+            try:
+                state["cleanInterval"] = float(config[0]["cleanInterval"])
+            except KeyError:
+                pass
+            self.zpools.append(state)
+        logging.info("Configuration '%s' loaded, %d zpools" % (self.conffile, len(self.zpools)))
+
+    def run(self):
+        while not CommandRunner.stopping.is_set():
+            if self.reloading:
+                self.reloading = False
+                self.reload()
+            for state in self.zpools:
+                if CommandRunner.stopping.is_set() or self.reloading:
+                    break
+                self.poll(state)
+            if self.zpools and not self.reloading:
+                self.wakeup.wait(max(min([state["nextPoll"] for state in self.zpools]) - time.time(), 0))
+            elif not self.zpools:
+                self.wakeup.wait(self.pollInterval)
+            self.wakeup.clear()
+
+    def writeMetrics(self):
+        # Figures of the zpools loaded, since they were loaded
+        if self.metrics != None:
+            writeMetrics(self.metrics, dict([(state["config"][0]["name"], state["zpool"].metrics.getFigures()) for state in self.zpools if state["zpool"] != None]))
+
+    def forget(self, state):
+        # A dry run drops the snapshots it would have destroyed from the
+        # zpool model, which is loaded again on the next poll
+        if self.dryrun:
+            state["zpool"] = None
+
+    def poll(self, state):
+        now = time.time()
+        if now < state["nextPoll"] and now < state["nextClean"]:
+            return
+        state["nextPoll"] = now + state["pollInterval"]
+        name = state["config"][0]["name"]
+        try:
+            if state["zpool"] == None or now >= state["nextClean"]:
+                zpool = loadZpool(state["config"], self.dryrun, getRunner())
+                if self.channelPrograms:
+                    zpool.channelProgram = ChannelProgram(zpool)
+                state["zpool"] = zpool
+                if now >= state["nextClean"]:
+                    state["nextClean"] = now + state["cleanInterval"]
+                    zpool.clean()
+                    logReport([zpool.getSummary()])
+                    self.writeMetrics()
+                    self.forget(state)
+                return
+
+            zpool = state["zpool"]
+            zpool.capacityTracker.poll()
+            if zpool.capacity > zpool.maxCapacity:
+                logging.info("Zpool '%s' is over maxCapacity (%s)" % (name, zpool.capacity))
+                with zpool.metrics.phase("refresh"):
+                    zpool.refreshSnapshots()
+                zpool.destroySnapshotsWhileOverMaxCapacity()
+                self.writeMetrics()
+                self.forget(state)
+        except Exception:
+            logging.exception("Zpool '%s' failed" % (name))
+            state["zpool"] = None
+
+def listDirectory(path):
+    # (path, lstat) of the entries of a directory
+    if scandir != None:
+        for entry in scandir(path):
+            try:
+                yield entry.path, entry.stat(follow_symlinks=False)
+            except OSError as e:
+                logging.debug("Skipping '%s': %s" % (entry.path, e))
+    else:
+        for name in os.listdir(path):
+            child = os.path.join(path, name)
+            try:
+                yield child, os.lstat(child)
+            except OSError as e:
+                logging.debug("Skipping '%s': %s" % (child, e))
+
+def waitFor(result):
+    # Value of an AsyncResult, waited for in steps: Python 2 lock waits are
+    # not interrupted, the main thread would not handle SIGTERM meanwhile
+    while not result.ready():
+        result.wait(1)
+    return result.get()
+
+def walkFiles(root):
+    # (path, lstat) of the regular files under root, symlinks not followed
+    directories = [root]
+    while directories:
+        path = directories.pop()
+        try:
+            entries = list(listDirectory(path))
+        except OSError as e:
+            logging.error("Could NOT read directory '%s': %s" % (path, e))
+            continue
+        for child, stat in entries:
+            if S_ISDIR(stat.st_mode):
+                directories.append(child)
+            elif S_ISREG(stat.st_mode):
+                yield child, stat
+
+def logReport(summaries):
+
+    # Space and snapshot figures of each zpool summary, then their totals
+    # when there are several
+
+    if len(summaries) > 1:
+        total = {"name": None, "referenced": 0, "used": 0, "available": 0, "snapshots": 0, "tags": {}}
+        for summary in summaries:
+            for key in ("referenced", "used", "available", "snapshots"):
+                total[key] += summary[key]
+            for tag, count in summary["tags"].iteritems():
+                total["tags"][tag] = total["tags"].get(tag, 0) + count
+        summaries = summaries + [total]
+
+    for summary in summaries:
+        logging.info("Zpool '%s'" % (summary["name"]) if summary["name"] != None else "All zpools")
+        logging.info("Used by data\t\t\t%d" % (summary["referenced"]))
+        logging.info("Used by snapshots\t\t%d" % (summary["used"] - summary["referenced"]))
+        logging.info("Available\t\t\t%d" % (summary["available"]))
+        logging.info("\t\t\t\t--------------")
+        logging.info("Total size\t\t\t%d" % (summary["used"] + summary["available"]))
+        logging.info("")
+        logging.info("%d snapshots" % (summary["snapshots"]))
+        for tag, count in summary["tags"].iteritems():
+            logging.info("%s snapshots held as '%s'" % (count, tag))
+        logging.info("")
+
+def readConfig(source):
+
+    # Stream the zpools of a configuration file as (attributes, datasets)
+    # pairs, datasets being the list of the attributes of its <dataset>
+    # elements. Elements are dropped once read.
+
+    datasets = []
+    for event, element in iterparse(source, events=("start", "end")):
+        if event == "start":
+            if element.tag == "zpool":
+                datasets = []
+        elif element.tag == "dataset":
+            datasets.append(dict(element.attrib))
+            element.clear()
+        elif element.tag == "zpool":
+            yield dict(element.attrib), datasets
+            element.clear()
+
+def processZpool(arguments):
+
+    # Load and list or clean the zpool of a configuration read by
+    # readConfig, in a worker process when zpools are processed
+    # concurrently. Returns its summary, None when listing, or the error
+    # that ended it.
+
+    config, dryrun, list, channelPrograms, plan, report = arguments
+    name = config[0].get("name")
+    part = None
+    try:
+        if report != None:
+            # The decision cache is left alone along with the holds
+            config = (dict([(key, value) for key, value in config[0].items() if key != "decisionCache"]), config[1])
+        zpool = loadZpool(config, dryrun, getRunner())
+        if channelPrograms:
+            zpool.channelProgram = ChannelProgram(zpool)
+
+        # List snapshot keep flag
+        if list:
+            zpool.listSnapshots()
+            return None
+
+        # Write the report of the zpool to a part merged by main, as plans
+        if report != None:
+            fd, part = tempfile.mkstemp(prefix=".zfs-snapshots-cleaner-", dir=getPartsDirectory(report))
+            stream = os.fdopen(fd, "w")
+            try:
+                zpool.writeReport(Report(stream, Report.getFormat(report)))
+            finally:
+                stream.close()
+            return {"name": zpool.name, "report": part, "metrics": zpool.metrics.getFigures()}
+
+        # Write the plan of the zpool next to the plan file, main merges them
+        if plan != None:
+            fd, part = tempfile.mkstemp(prefix=".zfs-snapshots-cleaner-", dir=getPartsDirectory(plan))
+            stream = os.fdopen(fd, "w")
+            try:
+                zpool.plan = Plan(stream)
+                zpool.plan.begin(zpool)
+                zpool.clean()
+                zpool.plan.end()
+            finally:
+                stream.close()
+            summary = zpool.getSummary()
+            summary["plan"] = part
+        else:
+            zpool.clean()
+            summary = zpool.getSummary()
+        summary["metrics"] = zpool.metrics.getFigures()
+        if Metrics.profile:
+            zpool.metrics.printProfiles()
+        return summary
+    except Exception as e:
+        logging.exception("Zpool '%s' failed" % (name))
+        if part != None:
+            os.remove(part)
+        return {"name": name, "error": str(e)}
+    finally:
+        if CommandRunner.recorder != None:
+            CommandRunner.recorder.close()
+        sys.stdout.flush()
+
+def readPlan(path, offset=0):
+    # Entries of the zpool plan starting at offset in path, header first
+    stream = open(path)
+    try:
+        stream.seek(offset)
+        header = True
+        for line in iter(stream.readline, ""):
+            entry = json.loads(line)
+            if "zpool" in entry and not header:
+                break
+            header = False
+            yield entry
+    finally:
+        stream.close()
+
+def getPlanOffsets(path):
+    # Offsets of the zpool headers in a plan, dataset names can't hold quotes
+    offset = 0
+    stream = open(path)
+    try:
+        for line in iter(stream.readline, ""):
+            if '"zpool":' in line:
+                yield offset
+            offset += len(line)
+    finally:
+        stream.close()
+
+def getPartsDirectory(path):
+    # Where the zpool parts of path are written, the temporary directory for
+    # stdout
+    if path == "-":
+        return None
+    return os.path.dirname(os.path.abspath(path))
+
+def mergeParts(path, parts, header=""):
+    # Concatenate the zpool parts written by processZpool into path at once,
+    # or to stdout for -
+    if path == "-":
+        stream = sys.stdout
+    else:
+        fd, merged = tempfile.mkstemp(prefix=".zfs-snapshots-cleaner-", dir=getPartsDirectory(path))
+        stream = os.fdopen(fd, "w")
+    try:
+        stream.write(header)
+        for part in parts:
+            source = open(part)
+            try:
+                copyfileobj(source, stream)
+            finally:
+                source.close()
+    finally:
+        if path != "-":
+            stream.close()
+    if path != "-":
+        os.rename(merged, path)
+    for part in parts:
+        os.remove(part)
+
+def writeMetrics(path, figures):
+
+    # Write the Metrics figures of the zpools, by name, as JSON when path
+    # ends with .json and in the node_exporter textfile format otherwise.
+    # path is replaced at once, as the textfile collector expects.
+
+    if path.endswith(".json"):
+        content = json.dumps(figures, indent=2, sort_keys=True) + "\n"
+    else:
+        lines = []
+        def family(name, type, help, samples):
+            lines.append("# HELP zfs_snapshots_cleaner_%s %s" % (name, help))
+            lines.append("# TYPE zfs_snapshots_cleaner_%s %s" % (name, type))
+            for suffix, labels, value in samples:
+                lines.append("zfs_snapshots_cleaner_%s%s{%s} %s" % (name, suffix, ",".join(['%s="%s"' % label for label in labels]), value))
+        zpools = sorted(figures.items())
+        family("last_run_timestamp_seconds", "gauge", "Start of the last run.", [("", [("zpool", zpool)], f["time"]) for zpool, f in zpools])
+        family("dryrun", "gauge", "Whether the last run was a dry run.", [("", [("zpool", zpool)], int(f["dryrun"])) for zpool, f in zpools])
+        family("phase_seconds", "gauge", "Wall time spent by phase.", [("", [("zpool", zpool), ("phase", phase)], seconds) for zpool, f in zpools for phase, seconds in sorted(f["phases"].items())])
+        family("dataset_seconds", "gauge", "Wall time spent cleaning each dataset.", [("", [("zpool", zpool), ("dataset", dataset)], seconds) for zpool, f in zpools for dataset, seconds in sorted(f["datasets"].items())])
+        for kind in ("snapshots", "files", "bytes"):
+            family("reclaimed_%s" % (kind), "gauge", "%s reclaimed by policy, estimated in dry runs." % (kind.capitalize()), [("", [("zpool", zpool), ("policy", policy)], reclaimed[kind]) for zpool, f in zpools for policy, reclaimed in sorted(f["reclaimed"].items())])
+        samples = []
+        for zpool, f in zpools:
+            for command, duration in sorted(f["commands"].items()):
+                labels = [("zpool", zpool), ("command", command)]
+                count = 0
+                for bound, observed in duration["buckets"]:
+                    count += observed
+                    samples.append(("_bucket", labels + [("le", bound)], count))
+                samples.append(("_bucket", labels + [("le", "+Inf")], duration["count"]))
+                samples.append(("_sum", labels, duration["seconds"]))
+                samples.append(("_count", labels, duration["count"]))
+        family("command_seconds", "histogram", "Duration of the commands run, by command.", samples)
+        content = "\n".join(lines) + "\n"
+
+    fd, written = tempfile.mkstemp(prefix=".zfs-snapshots-cleaner-", dir=os.path.dirname(os.path.abspath(path)))
+    stream = os.fdopen(fd, "w")
+    try:
+        stream.write(content)
+    finally:
+        stream.close()
+    os.chmod(written, 0644)
+    os.rename(written, path)
+
+def applyPlan(arguments):
+
+    # Perform the plan of a zpool written by --plan, starting at offset in
+    # path. Returns its summary or the error that ended it, as
+    # processZpool.
+
+    path, offset, dryrun, channelPrograms = arguments
+    name = readPlan(path, offset).next()["zpool"].encode("utf-8")
+    try:
+        zpool = Zpool(name, dryrun, getRunner(), [])
+        if channelPrograms:
+            zpool.channelProgram = ChannelProgram(zpool)
+        zpool.applyPlan(path, offset)
+        summary = zpool.getSummary()
+        summary["metrics"] = zpool.metrics.getFigures()
+        if Metrics.profile:
+            zpool.metrics.printProfiles()
+        return summary
+    except Exception as e:
+        logging.exception("Zpool '%s' failed" % (name))
+        return {"name": name, "error": str(e)}
+    finally:
+        if CommandRunner.recorder != None:
+            CommandRunner.recorder.close()
+        sys.stdout.flush()
+
+def initializeWorker(sharedCommands, sharedWrites):
+    # Worker processes share the command limits of main. On SIGTERM, sent
+    # by main when it is terminated, they kill their commands and exit.
+    CommandRunner.sharedCommands = sharedCommands
+    CommandRunner.sharedWrites = sharedWrites
+    signal.signal(signal.SIGTERM, terminateWorker)
+
+def terminateWorker(signum, frame):
+    CommandRunner.shutdown()
+    sys.exit(1)
+
+def mapConcurrently(function, arguments, jobs):
+
+    # Results of function over arguments, computed by jobs worker
+    # processes. Results are waited for in short steps, so that SIGTERM is
+    # handled in the meantime: the workers are then terminated, the results
+    # received so far being returned.
+
+    pool = Pool(jobs, initializeWorker, (CommandRunner.sharedCommands, CommandRunner.sharedWrites))
+    results = []
+    try:
+        iterator = pool.imap(function, arguments, 1)
+        while True:
+            try:
+                results.append(iterator.next(1))
+            except TimeoutError:
+                if CommandRunner.stopping.is_set():
+                    pool.terminate()
+                    break
+            except StopIteration:
+                break
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
 def usage():
     print __doc__
 
@@ -445,20 +2842,183 @@ def MonthDelta(date, months):
         date = date.replace(year=year)
     return date.replace(month=month)
 
+def splitArguments(arguments, size=65536):
+    # Split a list of command arguments in chunks of at most size bytes,
+    # well under ARG_MAX
+    chunk = []
+    length = 0
+    for argument in arguments:
+        if chunk and length + len(argument) + 1 > size:
+            yield chunk
+            chunk = []
+            length = 0
+        chunk.append(argument)
+        length += len(argument) + 1
+    if chunk:
+        yield chunk
+
+def compilePolicy(policy, now):
+
+    # Parse a retentionPolicy/maxRetention term, with cutoffs relative to now
+
+    weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+    today = datetime.combine(now.date(), datetime.min.time())
+
+    # all
+    if re.match('^all$', policy):
+        return RetentionPolicy(policy)
+    # none
+    if re.match('^none$', policy):
+        return RetentionPolicy(policy, datetime.max)
+    # n hour[s]
+    m = re.match('^(\d+) hour[s]?$', policy)
+    if m:
+        return RetentionPolicy(policy, now - timedelta(hours=int(m.group(1))))
+    # n day[s]
+    m = re.match('^(\d+) day[s]?$', policy)
+    if m:
+        return RetentionPolicy(policy, today - timedelta(days=int(m.group(1))))
+    # n week[s]
+    m = re.match('^(\d+) week[s]?$', policy)
+    if m:
+        return RetentionPolicy(policy, today - timedelta(weeks=int(m.group(1))))
+    # n (monday|tuesday|wednesday|thursday|friday|saturday|sunday)[s]
+    m = re.match('^(\d+) (monday|tuesday|wednesday|thursday|friday|saturday|sunday)[s]?$', policy)
+    if m:
+        weekday = weekdays.index(m.group(2))
+        return RetentionPolicy(policy, today - timedelta(weeks=int(m.group(1))), lambda snapshot, creation: creation.weekday() == weekday)
+    # n n-th weekday of the month
+    m = re.match('^(\d+) (\d+)(st|nd|rd|th) (monday|tuesday|wednesday|thursday|friday|saturday|sunday) of the month$', policy)
+    if m:
+        weekday = weekdays.index(m.group(4))
+        order = int(m.group(2))
+        lastWeekday = today - timedelta(days=(today.weekday() - weekday) % 7 or 7)
+        if lastWeekday.month == today.month:
+            cutoff = MonthDelta(today.replace(day=1), int(m.group(1)) - 1)
+        else:
+            cutoff = MonthDelta(today.replace(day=1), int(m.group(1)))
+        return RetentionPolicy(policy, cutoff, lambda snapshot, creation: creation.weekday() == weekday and (creation.day - 1) // 7 + 1 == order)
+    # n n-th day of the month
+    m = re.match('^(\d+) (\d+)(st|nd|rd|th) day of the month$', policy)
+    if m:
+        day = int(m.group(2))
+        return RetentionPolicy(policy, MonthDelta(today.replace(day=1), int(m.group(1)) - 1), lambda snapshot, creation: creation.day == day)
+    # n n-th day of the quarter
+    m = re.match('^(\d+) (\d+)(st|nd|rd|th) day of the quarter$', policy)
+    if m:
+        day = int(m.group(2))
+        return RetentionPolicy(policy, MonthDelta(today.replace(day=1), int(m.group(1)) * 3), lambda snapshot, creation: creation.day == day and creation.month % 3 == 1)
+    # @snapshot
+    m = re.match('^@([^ ]*)$', policy)
+    if m:
+        name = m.group(1)
+        return RetentionPolicy(policy, test=lambda snapshot, creation: snapshot.shortname == name)
+    raise ValueError("unknown policy: %s" % policy)
+
+def loadZpool(config, dryrun=True, runner=None):
+    attributes, datasets = config
+    scope = None
+    if attributes.get("scope") == "configured":
+        scope = [_dataset["name"] for _dataset in datasets]
+    userProperties = attributes.get("userProperties") in ("yes", "true", "on")
+    zpool = Zpool(attributes["name"], dryrun, runner, scope, userProperties, attributes.get("decisionCache"))
+    try:
+        zpool.maxCapacity = float(attributes["maxCapacity"])
+    except KeyError:
+        pass
+    try:
+        zpool.bestEffortPolicy = attributes["bestEffortPolicy"]
+    except KeyError:
+        pass
+    try:
+        zpool.sweepWorkers = int(attributes["sweepWorkers"])
+    except KeyError:
+        pass
+    try:
+        zpool.indexDirectory = attributes["indexDirectory"]
+    except KeyError:
+        pass
+    try:
+        zpool.datasetWorkers = int(attributes["datasetWorkers"])
+    except KeyError:
+        pass
+    try:
+        zpool.runner.timeout = float(attributes["commandTimeout"])
+    except KeyError:
+        pass
+    try:
+        zpool.runner.setMaxWrites(int(attributes["maxWrites"]))
+    except KeyError:
+        pass
+    try:
+        zpool.runner.setMaxCommands(int(attributes["maxCommands"]))
+    except KeyError:
+        pass
+
+    # Parsing parameters
+    for _dataset in datasets:
+        dataset = zpool.getDataset(_dataset["name"])
+        if dataset != None:
+            try:
+                dataset.retentionPolicy = _dataset["retentionPolicy"]
+            except KeyError:
+                pass
+            try:
+                dataset.maxRetention =  _dataset["maxRetention"]
+            except KeyError:
+                pass
+            try:
+                dataset.maxFileAge = _dataset["maxFileAge"]
+            except KeyError:
+                pass
+            try:
+                dataset.maxCapacity = float(_dataset["maxCapacity"])
+            except KeyError:
+                pass
+        else:
+            logging.error("Dataset '%s' does NOT exist on Zpool '%s'" % (_dataset["name"], zpool.name))
+
+    zpool.resolvePolicies()
+    return zpool
+
 def main(argv):
 
     # Set logging
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
 
     # Checking args
+    shortopts = "hdflpj:c:"
+    longopts = ["help", "dry-run", "force", "list", "channel-programs", "jobs=", "max-commands=", "max-writes=", "conffile=", "plan=", "report=", "apply=", "daemon", "metrics=", "profile", "record=", "replay=", "replay-latencies"]
     try:
-        opts, args = getopt.getopt(argv, "hdflc:", ["help", "dry-run", "force", "list", "conffile"])
+        opts, args = getopt.getopt(argv, shortopts, longopts)
     except getopt.GetoptError:
         usage()
         sys.exit(2)
 
+    # A replay runs with the options of the recorded run, those given here
+    # coming after them
+    for opt, arg in opts:
+        if opt == "--replay":
+            ReplayRunner.replay = Replay(arg)
+    if ReplayRunner.replay != None:
+        try:
+            recorded = getopt.getopt(ReplayRunner.replay.header.get("argv", []), shortopts, longopts)[0]
+        except getopt.GetoptError as e:
+            logging.error("The options of the recorded run could NOT be read: %s" % (e))
+            sys.exit(2)
+        opts = [(opt, arg) for opt, arg in recorded if opt not in ("-c", "--conffile", "--record", "--replay", "--replay-latencies")] + opts
+
     dryrun = True
     list = False
+    channelPrograms = False
+    jobs = 1
+    limits = {}
+    plan = None
+    report = None
+    apply = None
+    daemon = False
+    metrics = None
+    record = None
     conffile = "/usr/local/etc/zfs-snapshots-cleaner.conf"
 
     for opt, arg in opts:
@@ -471,134 +3031,98 @@ def main(argv):
             dryrun = False
         elif opt in ("-l", "--list"):
             list = True
+        elif opt in ("-p", "--channel-programs"):
+            channelPrograms = True
+        elif opt in ("-j", "--jobs"):
+            try:
+                jobs = int(arg)
+            except ValueError:
+                usage()
+                sys.exit(2)
+        elif opt in ("--max-commands", "--max-writes"):
+            try:
+                limits[opt[6:]] = int(arg)
+            except ValueError:
+                usage()
+                sys.exit(2)
         elif opt in ("-c", "--conffile"):
             conffile = arg
-
+        elif opt == "--plan":
+            plan = arg
+        elif opt == "--report":
+            report = arg
+        elif opt == "--apply":
+            apply = arg
+        elif opt == "--daemon":
+            daemon = True
+        elif opt == "--metrics":
+            metrics = arg
+        elif opt == "--profile":
+            Metrics.profile = True
+        elif opt == "--record":
+            record = arg
+        elif opt == "--replay-latencies":
+            ReplayRunner.latencies = True
+
+    if plan != None or report != None:
+        dryrun = True
     if dryrun:
         logging.warning("Neither -f nor --force is provided, we will NOT clean anything.")
     else:
         logging.warning("-f or --force is provided, we will actually clean.")
 
-    conf = parse(conffile)
-    for _zpool in conf.getElementsByTagName("zpool"):
-        zpool = Zpool(_zpool.attributes["name"].value, dryrun)
+    if ReplayRunner.replay != None and ReplayRunner.replay.getConfigFile() != None:
+        conffile = ReplayRunner.replay.getConfigFile()
+    if record != None:
         try:
-            zpool.maxCapacity = float(_zpool.attributes["maxCapacity"].value)
-        except KeyError:
-            pass
-        try:
-            zpool.bestEffortPolicy = _zpool.attributes["bestEffortPolicy"].value
-        except KeyError:
-            pass
-
-        # Parsing parameters
-        for _dataset in _zpool.getElementsByTagName("dataset"):
-            dataset = zpool.getDataset(_dataset.attributes["name"].value)
-            if dataset != None:
-                try:
-                    dataset.retentionPolicy = _dataset.attributes["retentionPolicy"].value
-                except KeyError:
-                    pass
-                try:
-                    dataset.maxRetention =  _dataset.attributes["maxRetention"].value
-                except KeyError:
-                    pass
-                try:
-                    dataset.maxFileAge = _dataset.attributes["maxFileAge"].value
-                except KeyError:
-                    pass
-                try:
-                    dataset.maxCapacity = float(_dataset.attributes["maxCapacity"].value)
-                except KeyError:
-                    pass
-            else:
-                logging.error("Dataset '%s' does NOT exist on Zpool '%s'" % (_dataset.attributes["name"].value, zpool.name))
-
-        # List snapshot keep flag
-        if list:
-            for dataset in zpool.datasets:
-                for snapshot in dataset.snapshots:
-                    if snapshot.keep == True:
-                        status = "must NOT be destroyed"
-                    elif snapshot.keep == False:
-                        status = "must be destroyed"
-                    else:
-                        status = "can be destroyed"
-                    print "%s %s" % (snapshot.name, status)
-        else:
-
-            # Destroy snapshots out of max retention
-            for dataset in zpool.datasets:
-                dataset.destroySnapshotsOutOfMaxRetention()
-
-            # Delete files over maxFileAge
-            for dataset in zpool.datasets:
-                try:
-                    dataset.deleteFilesOverMaxFileAge()
-                except AttributeError:
-                    pass
-
-            # Delete oldests files while not under maxCapacity
-            for dataset in zpool.datasets:
-                try:
-                    dataset.deleteOldestsFilesWhileNotUnderMaxCapacity()
-                except AttributeError:
-                    pass
-
-            # Destroy destroyable snapshot while we are over maxCapacity
-            while zpool.capacity > zpool.maxCapacity:
-
-                logging.info("Zpool capacity: %s (used: %s, available: %s)" % (zpool.capacity, zpool.used, zpool.available))
-
-                dataset = None
-
-                for _dataset in zpool.datasets:
-                    if len(_dataset.removableSnapshots) > 0:
-                        if dataset == None:
-                            dataset = _dataset
-                        elif zpool.bestEffortPolicy == "oldest" and _dataset.removableSnapshots[0].creation < dataset.removableSnapshots[0].creation:
-                            dataset = _dataset
-                        elif zpool.bestEffortPolicy == "morerem" and len(_dataset.removableSnapshots) > len(dataset.removableSnapshots):
-                            dataset = _dataset
-                        elif zpool.bestEffortPolicy == "biggest" and _dataset.removableSnapshots[0].used > dataset.removableSnapshots[0].used:
-                            dataset = _dataset
-                        elif zpool.bestEffortPolicy == "more" and len(_dataset.snapshots) > len(dataset.snapshots):
-                            dataset = _dataset
-
-                if dataset == None:
-                    break
-
-                snapshot = dataset.removableSnapshots[0]
-                dataset.snapshots.remove(snapshot)
-                cmd = ["/sbin/zfs", "destroy", "-d", snapshot.name]
-                if dryrun:
-                    logging.info(" ".join(cmd))
-                else:
-                    logging.debug(check_output(cmd))
-                    logging.info("Snapshot '%s' has been destroyed" % snapshot.name)
-
-            logging.info("Used by data\t\t\t%d" % (zpool.referenced))
-            logging.info("Used by snapshots\t\t%d" % (zpool.used - zpool.referenced))
-            logging.info("Available\t\t\t%d" % (zpool.available))
-            logging.info("\t\t\t\t--------------")
-            logging.info("Total size\t\t\t%d" % (zpool.used + zpool.available))
-            logging.info("")
-
-            totalSnapshots = 0
-            tags = {}
-            for dataset in zpool.datasets:
-                for snapshot in dataset.snapshots:
-                    totalSnapshots += 1
-                    if snapshot.tags:
-                        for tag in snapshot.tags:
-                            try:
-                                tags[tag] += 1
-                            except KeyError:
-                                tags[tag] = 1
-
-            logging.info("%d snapshots" % (totalSnapshots))
-            for tag, count in tags.iteritems():
-                logging.info("%s snapshots held as '%s'" % (count, tag))
+            config = open(conffile).read()
+        except IOError:
+            config = None
+        CommandRunner.recorder = Recorder(record, argv, config)
+    CommandRunner.setSharedLimits(limits.get("commands"), limits.get("writes"))
+
+    if daemon:
+        daemon = Daemon(conffile, dryrun, channelPrograms, metrics)
+        signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+        signal.signal(signal.SIGHUP, lambda signum, frame: daemon.hangup())
+        daemon.run()
+        if record != None:
+            CommandRunner.recorder.save()
+        return
+
+    # Kill the running commands and cancel the next ones on SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: CommandRunner.shutdown())
+
+    if apply != None:
+        function = applyPlan
+        zpools = ((apply, offset, dryrun, channelPrograms) for offset in getPlanOffsets(apply))
+    else:
+        function = processZpool
+        zpools = ((config, dryrun, list, channelPrograms, plan, report) for config in readConfig(conffile))
+    if jobs > 1:
+        results = mapConcurrently(function, zpools, jobs)
+    else:
+        results = [function(arguments) for arguments in zpools]
+
+    failures = [result for result in results if result != None and "error" in result]
+    summaries = [result for result in results if result != None and "error" not in result]
+    if plan != None:
+        mergeParts(plan, [summary.pop("plan") for summary in summaries])
+    if report != None:
+        mergeParts(report, [summary.pop("report") for summary in summaries], Report.getHeader(Report.getFormat(report)))
+    if record != None:
+        CommandRunner.recorder.save()
+    figures = dict([(summary["name"], summary.pop("metrics")) for summary in summaries])
+    if metrics != None:
+        writeMetrics(metrics, figures)
+    if summaries and report == None:
+        logReport(summaries)
+    for failure in failures:
+        logging.error("Zpool '%s' was NOT cleaned: %s" % (failure["name"], failure["error"]))
+    if CommandRunner.stopping.is_set():
+        logging.error("Stopped on SIGTERM, %d zpools processed" % (len(results)))
+    if failures or CommandRunner.stopping.is_set():
+        sys.exit(1)
 
 if __name__ == "__main__":
     main(sys.argv[1:])